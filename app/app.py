@@ -2,49 +2,132 @@
 # -*- coding: utf-8 -*-
 # standard python imports
 
+import threading
+
 from flask import Flask
-from flask_jwt_extended import JWTManager
 
-from app.resources.item import item_bp
-from app.resources.store import store_bp
-from app.resources.user import user_bp
-from app.config import postgresqlConfig
+from app.config import engineOptions, postgresqlConfig, replicaConfigs
+
+
+def create_app(config=None):
+    """Create and configure an application instance.
+
+    `config` is applied over the defaults below, so tests and workers can
+    build isolated apps (e.g. each with its own database) side by side.
+    """
+    app = Flask(__name__)
+    from app.util.json_provider import FastJSONProvider
+    app.json = FastJSONProvider(app)
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = postgresqlConfig
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # Largest body accepted by PUT /items
+    app.config['BULK_MAX_ROWS'] = 50000
+    # Setup the Flask-JWT-Extended extension
+    app.config["JWT_SECRET_KEY"] = "Dese.Decent.Pups.BOOYO0OST"  # Change this!
+    # Build current_user from the token claims instead of loading the user row
+    app.config["JWT_TRUST_CLAIMS"] = False
+    app.config['METRICS_ENABLED'] = False
+    # GET requests read from these replicas, see app/replicas.py
+    app.config['SQLALCHEMY_REPLICA_URIS'] = replicaConfigs
+    app.config.update(config or {})
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engineOptions(app.config['SQLALCHEMY_DATABASE_URI']))
+    if app.config['SQLALCHEMY_REPLICA_URIS']:
+        from app.replicas import replica_binds
+        app.config['SQLALCHEMY_BINDS'] = dict(app.config.get('SQLALCHEMY_BINDS') or {},
+                                              **replica_binds(app.config['SQLALCHEMY_REPLICA_URIS']))
+
+    from app.util.logz import configure_logging
+    configure_logging(app.config.get('LOG_MODE'), app.config.get('LOG_FORMAT'), app.config.get('LOG_SAMPLE_RATES'))
+
+    from app.auth import jwt
+    jwt.init_app(app)
+
+    # Initialize database
+    from app.db import db, instrument_pool
+    db.init_app(app)
+    with app.app_context():
+        for engine in db.engines.values():
+            instrument_pool(engine)
+
+    # Reads of GET requests on the replicas, with stickiness after writes
+    from app.replicas import init_replicas
+    init_replicas(app)
+
+    # Password hashing parameters and the optional hashing thread pool
+    from app.util.passwords import init_passwords
+    init_passwords(app)
+
+    # Cache for the find_by_* lookups
+    from app.util.cache import init_cache
+    init_cache(app)
+
+    # Stored responses of requests sent with an Idempotency-Key header
+    from app.util.idempotency import init_idempotency
+    init_idempotency(app)
+
+    # Opt-in shared transactions for concurrent PUT /item/<name>
+    from app.util.group_commit import init_group_commit
+    init_group_commit(app)
+
+    # Opt-in request timing, SQL instrumentation and /metrics
+    from app.util.metrics import init_metrics
+    init_metrics(app)
+
+    # Opt-in token bucket rate limits per route and identity, after the
+    # metrics hooks so rejected requests are measured too
+    from app.util.ratelimit import init_rate_limits
+    init_rate_limits(app)
+
+    # Negotiated gzip/deflate (brotli when installed) response compression
+    from app.util.compression import init_compression
+    init_compression(app)
+
+    register_commands(app)
+
+    # Register blueprints
+    from app.resources.item import item_bp
+    from app.resources.store import store_bp
+    from app.resources.user import user_bp
+    app.register_blueprint(item_bp)
+    app.register_blueprint(store_bp)
+    app.register_blueprint(user_bp)
+
+    return app
+
 
-app = Flask(__name__)
+def register_commands(app):
+    """Add the database maintenance commands to the `flask` CLI."""
 
-app.config['SQLALCHEMY_DATABASE_URI'] = postgresqlConfig
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-# Setup the Flask-JWT-Extended extension
-app.config["JWT_SECRET_KEY"] = "Dese.Decent.Pups.BOOYO0OST"  # Change this!
-jwt = JWTManager(app)
+    @app.cli.command('upgrade-db')
+    def upgrade_db_command():
+        """Create missing tables and indexes, and widen columns, on an existing database."""
+        from app.schema import upgrade_schema
 
-# Initialize database
-from app.db import db
-db.init_app(app)
+        changed = upgrade_schema()
+        print(f"✓ Upgraded {len(changed)} indexes and columns: {', '.join(changed) or 'none'}")
 
 
-# JWT user loader callback
-@jwt.user_lookup_loader
-def user_lookup_callback(_jwt_header, jwt_data):
-    """Load user from JWT token identity."""
-    import json
-    from app.models.user import UserModel
+_app = None
+_app_lock = threading.Lock()
 
-    identity = jwt_data["sub"]
-    try:
-        user_data = json.loads(identity)
-        return UserModel.find_by_id(user_data.get('id'))
-    except (json.JSONDecodeError, KeyError, TypeError):
-        return None
 
+def __getattr__(name):
+    # `from app.app import app` (flask run, run.sh, init-db.sh) builds the
+    # default application on first use instead of at import time.
+    global _app
+    if name == 'app':
+        with _app_lock:
+            if _app is None:
+                _app = create_app()
+        return _app
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
-# Register blueprints
-app.register_blueprint(item_bp)
-app.register_blueprint(store_bp)
-app.register_blueprint(user_bp)
 
 if __name__ == '__main__':
+    app = create_app()
     # Create database tables when running directly
+    from app.db import db
     with app.app_context():
         db.create_all()
     # TODO: Add swagger integration
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""ASGI entry point with async variants of the read endpoints.
+
+    uvicorn app.asgi:app --workers 2
+
+GET /items, /item/<name>, /stores and /store/<name> run as coroutines on an
+AsyncSession (aiosqlite or asyncpg), so a slow database holds a connection
+but not a worker thread. Every other request, and NDJSON exports, go to the
+regular Flask app through asgiref's WSGI adapter. Needs `asgiref` and the
+async driver installed.
+"""
+
+import io
+import sys
+import threading
+
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.exceptions import HTTPException
+
+from app.db import async_db
+from app.resources.aio import async_views
+from app.util.streaming import wants_stream
+
+
+def build_environ(scope):
+    """Build the WSGI environ of a bodiless ASGI HTTP request."""
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if environ['PATH_INFO'].startswith(environ['SCRIPT_NAME']):
+        environ['PATH_INFO'] = environ['PATH_INFO'][len(environ['SCRIPT_NAME']):]
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        key = name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else f'HTTP_{name}'
+        value = value.decode('latin-1')
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+class AsyncReadsApp:
+    """ASGI application dispatching the routes of `async_views` to coroutines.
+
+    Async views run inside a regular Flask request context, so request
+    parsing, JWT checks, error handlers and after_request hooks (compression,
+    metrics) behave as they do on the sync stack.
+    """
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+        async_db.init_app(flask_app)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        view, view_args, environ = self._match(scope)
+        if view is None:
+            return await self.wsgi(scope, receive, send)
+
+        app = self.flask_app
+        ctx = app.request_context(environ)
+        ctx.push()
+        try:
+            if wants_stream():
+                response = None
+            else:
+                response = await self._dispatch(view, view_args)
+                headers = response.get_wsgi_headers(environ)
+        finally:
+            await async_db.remove()
+            ctx.pop()
+        if response is None:
+            return await self.wsgi(scope, receive, send)
+
+        await send({'type': 'http.response.start', 'status': response.status_code,
+                    'headers': [(key.lower().encode('latin-1'), value.encode('latin-1'))
+                                for key, value in headers.items()]})
+        body = b'' if scope['method'] == 'HEAD' else b''.join(response.iter_encoded())
+        await send({'type': 'http.response.body', 'body': body})
+        response.close()
+
+    def _match(self, scope):
+        if scope['type'] != 'http' or scope['method'] not in ('GET', 'HEAD'):
+            return None, None, None
+        environ = build_environ(scope)
+        try:
+            endpoint, view_args = self.flask_app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            return None, None, None
+        return async_views.get(endpoint), view_args, environ
+
+    async def _dispatch(self, view, view_args):
+        # Flask's full_dispatch_request() with the view awaited
+        app = self.flask_app
+        try:
+            rv = app.preprocess_request()
+            if rv is None:
+                rv = await view(**view_args)
+        except Exception as e:
+            try:
+                rv = app.handle_user_exception(e)
+            except Exception as e:
+                return app.handle_exception(e)
+        return app.finalize_request(rv)
+
+    async def dispose(self):
+        """Close the connections of the async engine, e.g. at server shutdown."""
+        with self.flask_app.app_context():
+            await async_db.engine.dispose()
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+def create_asgi_app(config=None):
+    """Create an application like create_app() and wrap it in AsyncReadsApp."""
+    from app.app import create_app
+    return AsyncReadsApp(create_app(config))
+
+
+_asgi_app = None
+_asgi_app_lock = threading.Lock()
+
+
+def __getattr__(name):
+    # `uvicorn app.asgi:app` builds the default application on first use
+    global _asgi_app
+    if name == 'app':
+        with _asgi_app_lock:
+            if _asgi_app is None:
+                from app.app import app as flask_app
+                _asgi_app = AsyncReadsApp(flask_app)
+        return _asgi_app
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
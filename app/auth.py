@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# standard python imports
+
+import json
+
+from flask import current_app, g, request
+from flask_jwt_extended import JWTManager, create_access_token, decode_token
+
+jwt = JWTManager()
+
+
+def create_user_token(user):
+    """Create an access token whose identity is just the user id.
+
+    The username travels as an extra claim so that JWT_TRUST_CLAIMS can
+    build the principal without a query.
+    """
+    return create_access_token(identity=str(user.id), additional_claims={'username': user.username})
+
+
+def request_identity():
+    """Who sent the request: 'user:<id>' with a valid bearer token, 'ip:<address>' otherwise.
+
+    The token is only decoded, loading the user is left to the views that need it.
+    """
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme == 'Bearer' and token:
+        try:
+            return f"user:{decode_token(token)['sub']}"
+        except Exception:
+            # Invalid tokens are rejected by the view, count them against the address
+            pass
+    return f'ip:{request.remote_addr}'
+
+
+def _parse_identity(jwt_data):
+    identity = json.loads(jwt_data["sub"])
+    if isinstance(identity, dict):
+        # tokens issued before the identity was reduced to the user id
+        return identity['id'], identity.get('username')
+    return int(identity), jwt_data.get('username')
+
+
+# JWT user loader callback
+@jwt.user_lookup_loader
+def user_lookup_callback(_jwt_header, jwt_data):
+    """Load user from JWT token identity.
+
+    The user row comes from the lookup cache, so most requests cost no query.
+    With JWT_TRUST_CLAIMS the token claims are used as they are, and so they
+    are for async views, whose jwt_required_async() loads the row itself.
+    """
+    from app.models.user import TokenPrincipal, UserModel
+
+    try:
+        user_id, username = _parse_identity(jwt_data)
+    except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+        return None
+    if current_app.config.get('JWT_TRUST_CLAIMS') or g.get('async_user_lookup'):
+        return TokenPrincipal(user_id, username)
+    return UserModel.find_by_id(user_id)
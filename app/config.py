@@ -17,4 +17,75 @@ postgresql = {'host': '0.0.0.0',
 
 mssqlConfig = "mssql+pyodbc://{}:{}@{}:1433/{}?driver=SQL+Server+Native+Client+10.0".format(mssql['user'], mssql['passwd'], mssql['host'], mssql['db'])
 postgresqlConfig = os.environ.get('DATABASE_URL') or "postgresql+psycopg2://{}:{}@{}/{}".format(postgresql['user'], postgresql['passwd'], postgresql['host'], postgresql['db'])
+# Read replicas of the database above, comma separated
+replicaConfigs = [uri.strip() for uri in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if uri.strip()]
 
+# Engine and pool settings per deployment profile, selected with DB_PROFILE and
+# overridden one by one with the DB_* environment variables below.
+engineProfiles = {
+    'development': {'pool_size': 5, 'max_overflow': 5, 'pool_timeout': 30, 'pool_recycle': 1800,
+                    'pool_pre_ping': True, 'statement_timeout_ms': 0, 'connect_timeout': 10},
+    'production': {'pool_size': 10, 'max_overflow': 10, 'pool_timeout': 5, 'pool_recycle': 1800,
+                   'pool_pre_ping': True, 'statement_timeout_ms': 30000, 'connect_timeout': 5},
+    'test': {'pool_size': 2, 'max_overflow': 0, 'pool_timeout': 5, 'pool_recycle': -1,
+             'pool_pre_ping': False, 'statement_timeout_ms': 0, 'connect_timeout': 5},
+}
+
+engineEnvironment = {
+    'pool_size': ('DB_POOL_SIZE', int),
+    'max_overflow': ('DB_MAX_OVERFLOW', int),
+    'pool_timeout': ('DB_POOL_TIMEOUT', float),
+    'pool_recycle': ('DB_POOL_RECYCLE', int),
+    'pool_pre_ping': ('DB_POOL_PRE_PING', lambda value: value.lower() in ('1', 'true', 'yes', 'on')),
+    'statement_timeout_ms': ('DB_STATEMENT_TIMEOUT_MS', int),
+    'connect_timeout': ('DB_CONNECT_TIMEOUT', int),
+}
+
+
+def engineSettings(environ=os.environ):
+    """Return the engine settings of the DB_PROFILE profile with the DB_* overrides applied."""
+    profile = environ.get('DB_PROFILE', 'development')
+    if profile not in engineProfiles:
+        raise ValueError(f"Unknown DB_PROFILE '{profile}', expected one of {sorted(engineProfiles)}")
+    settings = dict(engineProfiles[profile])
+    for key, (variable, convert) in engineEnvironment.items():
+        if environ.get(variable):
+            settings[key] = convert(environ[variable])
+    return settings
+
+
+def engineOptions(uri, environ=os.environ):
+    """Build SQLALCHEMY_ENGINE_OPTIONS for `uri` from the environment.
+
+    Pool sizing only applies to pooled databases (not in-memory SQLite), and
+    statement timeouts and libpq options only to PostgreSQL.
+    """
+    settings = engineSettings(environ)
+    options = {'pool_pre_ping': settings['pool_pre_ping']}
+
+    in_memory = uri.startswith('sqlite') and (':memory:' in uri or uri.rstrip('/') in ('sqlite:', 'sqlite:/'))
+    if not in_memory:
+        options.update(pool_size=settings['pool_size'], max_overflow=settings['max_overflow'],
+                       pool_timeout=settings['pool_timeout'], pool_recycle=settings['pool_recycle'])
+
+    if uri.startswith('postgresql+asyncpg'):
+        server_settings = {'application_name': environ.get('DB_APPLICATION_NAME', 'flask-restful')}
+        if settings['statement_timeout_ms']:
+            server_settings['statement_timeout'] = str(settings['statement_timeout_ms'])
+        options['connect_args'] = {'timeout': settings['connect_timeout'], 'server_settings': server_settings}
+    elif uri.startswith('postgresql'):
+        connect_args = {'connect_timeout': settings['connect_timeout'],
+                        'application_name': environ.get('DB_APPLICATION_NAME', 'flask-restful')}
+        if settings['statement_timeout_ms']:
+            connect_args['options'] = f"-c statement_timeout={settings['statement_timeout_ms']}"
+        options['connect_args'] = connect_args
+    return options
+
+
+asyncDrivers = {'sqlite': 'sqlite+aiosqlite', 'postgresql': 'postgresql+asyncpg', 'postgresql+psycopg2': 'postgresql+asyncpg'}
+
+
+def asyncDatabaseUri(uri):
+    """Return `uri` with its driver swapped for the asyncio one (aiosqlite, asyncpg)."""
+    scheme, separator, rest = uri.partition('://')
+    return asyncDrivers.get(scheme, scheme) + separator + rest
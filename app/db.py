@@ -2,7 +2,190 @@
 # -*- coding: utf-8 -*-
 # standard python imports
 
+import threading
+import weakref
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import current_app, g, has_app_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql.dml import UpdateBase
+
+
+class RoutingSession(Session):
+    """Session sending the reads of replica routed requests to that replica (see app/replicas.py).
+
+    Flushes and INSERT/UPDATE/DELETE statements always go to the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and not isinstance(clause, UpdateBase):
+            engine = replica_engine()
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+
+def replica_engine():
+    """The engine of the replica chosen for the current request, or None for the primary."""
+    key = g.get('db_replica') if has_app_context() else None
+    return db.engines[key] if key is not None else None
+
+
+def reading_from_replica():
+    """True while the queries of the current request go to a replica."""
+    return has_app_context() and g.get('db_replica') is not None
+
+_pool_counters = weakref.WeakKeyDictionary()
+_pool_counters_lock = threading.Lock()
+
+
+def instrument_pool(engine):
+    """Count connects, checkouts and invalidations on the pool of `engine`."""
+    with _pool_counters_lock:
+        if engine in _pool_counters:
+            return
+        counters = _pool_counters[engine] = Counter()
+
+    def count(name):
+        def listener(*args):
+            with _pool_counters_lock:
+                counters[name] += 1
+        return listener
+
+    for name, event_name in (('connects', 'connect'), ('checkouts', 'checkout'), ('invalidations', 'invalidate')):
+        event.listen(engine.pool, event_name, count(name))
+
+
+def pool_stats(engine=None):
+    """Return the current state and lifetime counters of the connection pool of `engine`."""
+    engine = engine or db.engine
+    pool = engine.pool
+    stats = {'pool': type(pool).__name__}
+    for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+        if hasattr(pool, name):
+            stats[name] = getattr(pool, name)()
+    with _pool_counters_lock:
+        counters = _pool_counters.get(engine, Counter())
+        for name in ('connects', 'checkouts', 'invalidations'):
+            stats[name] = counters[name]
+    return stats
+
+
+def is_unique_violation(error):
+    """Return True when the IntegrityError `error` comes from a unique constraint or index."""
+    code = getattr(error.orig, 'pgcode', None) or getattr(error.orig, 'sqlstate', None)
+    if code:
+        return code == '23505'
+    # SQLite, SQL Server and MySQL only tell in the message (MySQL: 1062 Duplicate entry)
+    message = str(error.orig).lower()
+    return 'unique' in message or 'duplicate' in message
+
+
+@contextmanager
+def unit_of_work():
+    """Commit the model changes made inside the block once, at its end.
+
+    save_to_db(), delete_from_db() and the upserts only flush while a unit
+    of work is open, so ids and constraint errors still show up at the call,
+    and the outermost block commits everything in one transaction or, on an
+    exception (a failed commit included), rolls all of it back. Inner blocks
+    are savepoints: an exception caught outside of one only undoes that
+    block. Works as a decorator too, e.g. on a view or a bulk job.
+    """
+    info = db.session.info
+    depth = info.get('unit_of_work', 0)
+    info['unit_of_work'] = depth + 1
+    try:
+        if depth:
+            with db.session.begin_nested():
+                yield db.session
+        else:
+            try:
+                yield db.session
+                db.session.commit()
+            except BaseException:
+                db.session.rollback()
+                raise
+    finally:
+        info['unit_of_work'] = depth
+
+
+def in_unit_of_work():
+    return db.session.info.get('unit_of_work', 0) > 0
+
+
+def commit_or_defer():
+    """Commit db.session, or only flush it while a unit_of_work() will commit later."""
+    if in_unit_of_work():
+        db.session.flush()
+    else:
+        db.session.commit()
+
+
+def insert_unique(obj):
+    """Insert and commit `obj`, returning False if a row with the same unique key exists.
+
+    The unique constraint decides, so there is no SELECT beforehand and two
+    concurrent inserts of the same name cannot both succeed. Other integrity
+    errors, e.g. foreign keys, are raised. Inside a unit_of_work() the insert
+    is flushed in a savepoint, leaving the rest of the unit intact.
+    """
+    deferred = in_unit_of_work()
+    try:
+        if deferred:
+            with db.session.begin_nested():
+                db.session.add(obj)
+        else:
+            db.session.add(obj)
+            db.session.commit()
+    except IntegrityError as e:
+        if not deferred:
+            db.session.rollback()
+        if is_unique_violation(e):
+            return False
+        raise
+    return True
+
+
+class AsyncDatabase:
+    """AsyncSession per request for the async read endpoints served by app/asgi.py.
+
+    The engine uses SQLALCHEMY_ASYNC_DATABASE_URI, or SQLALCHEMY_DATABASE_URI
+    with its driver swapped for aiosqlite/asyncpg, and needs that driver
+    installed. Sessions are closed by `remove()` at the end of the request.
+    """
+
+    def init_app(self, app):
+        from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+        from app.config import asyncDatabaseUri, engineOptions
+
+        uri = app.config.get('SQLALCHEMY_ASYNC_DATABASE_URI') or asyncDatabaseUri(app.config['SQLALCHEMY_DATABASE_URI'])
+        options = app.config.get('SQLALCHEMY_ASYNC_ENGINE_OPTIONS') or engineOptions(uri)
+        engine = create_async_engine(uri, **options)
+        instrument_pool(engine.sync_engine)
+        app.extensions['async_db'] = async_sessionmaker(engine, expire_on_commit=False)
+
+    @property
+    def engine(self):
+        return current_app.extensions['async_db'].kw['bind']
+
+    @property
+    def session(self):
+        if '_async_session' not in g:
+            g._async_session = current_app.extensions['async_db']()
+        return g._async_session
+
+    async def remove(self):
+        session = g.pop('_async_session', None)
+        if session is not None:
+            await session.close()
 
-db = SQLAlchemy()
 
+async_db = AsyncDatabase()
@@ -2,17 +2,27 @@
 # -*- coding: utf-8 -*-
 # standard python imports
 
-from app.db import db
+from functools import lru_cache
+
+from sqlalchemy import bindparam, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+from app.db import commit_or_defer, db, unit_of_work
+from app.util.cache import cached_lookup, invalidate_on_commit
+from app.util.json_provider import RowEncoder
+
+IN_CLAUSE_BATCH = 500
 
 
 class ItemModel(db.Model):
     __tablename__ = 'items'
+    __cache_keys__ = ('name',)
 
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(80))
+    name = db.Column(db.String(80), unique=True, index=True)
     price = db.Column(db.Float(precision=2))
 
-    store_id = db.Column(db.Integer, db.ForeignKey('stores.id'))
+    store_id = db.Column(db.Integer, db.ForeignKey('stores.id'), index=True)
     store = db.relationship('StoreModel', back_populates='items')
 
     def __init__(self, name, price, store_id):
@@ -20,17 +30,126 @@ class ItemModel(db.Model):
         self.price = price
         self.store_id = store_id
 
-    def json(self):
-        return {'name': self.name, 'price': self.price, 'store_id': self.store_id}
+    # The fields of json(), in the order they are written; `?fields=` picks a subset
+    FIELDS = ('name', 'price', 'store_id')
+
+    # Encodes rows of json_columns() into the same objects json() returns
+    row_encoder = RowEncoder(FIELDS)
+
+    def json(self, fields=FIELDS):
+        return {field: getattr(self, field) for field in fields}
+
+    @classmethod
+    def json_columns(cls, fields=FIELDS):
+        """Columns to select for `encoder_for(fields)`, followed by the primary key."""
+        return (*(getattr(cls, field) for field in fields), cls.id)
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def encoder_for(fields):
+        """The RowEncoder of json_columns(fields) rows, compiled once per field tuple."""
+        return ItemModel.row_encoder if fields == ItemModel.FIELDS else RowEncoder(fields)
 
     @classmethod
     def find_by_name(cls, name):
-        return cls.query.filter_by(name=name).first()  # simple TOP 1 select
+        return cached_lookup(cls, 'name', name)  # simple TOP 1 select on a cache miss
+
+    @classmethod
+    def upsert_many(cls, rows):
+        """Insert or update many items in one transaction.
+
+        `rows` are dicts with name, price and store_id and unique names. Like
+        PUT /item/<name>, existing items only get their price updated. On
+        PostgreSQL and SQLite this is a single INSERT ... ON CONFLICT executed
+        for all rows at once; other databases get one UPDATE and one INSERT
+        executemany. Rows are written in name order, so two batches touching
+        the same items lock them in the same order and cannot deadlock.
+        Returns the set of names that already existed.
+        """
+        rows = sorted(rows, key=lambda row: row['name'])
+        names = [row['name'] for row in rows]
+        existing = set()
+        for start in range(0, len(names), IN_CLAUSE_BATCH):
+            batch = names[start:start + IN_CLAUSE_BATCH]
+            existing.update(db.session.scalars(select(cls.name).where(cls.name.in_(batch))))
+
+        statement = cls._upsert_statement()
+        if statement is not None:
+            db.session.execute(statement, rows)
+        else:
+            updates = [{'b_name': row['name'], 'b_price': row['price']} for row in rows if row['name'] in existing]
+            inserts = [row for row in rows if row['name'] not in existing]
+            if updates:
+                db.session.execute(update(cls.__table__)
+                                   .where(cls.__table__.c.name == bindparam('b_name'))
+                                   .values(price=bindparam('b_price')), updates)
+            if inserts:
+                db.session.execute(insert(cls.__table__), inserts)
+
+        invalidate_on_commit(db.session, cls, 'name', names)
+        commit_or_defer()
+        return existing
+
+    @classmethod
+    def upsert(cls, name, price, store_id):
+        """Insert an item, or update the price of the existing one, and commit (see commit_or_defer).
+
+        On PostgreSQL and SQLite this is one INSERT ... ON CONFLICT ... RETURNING
+        statement. Elsewhere an UPDATE runs first and the INSERT only when no
+        row matched, retrying the UPDATE if a concurrent request inserted the
+        name in between. Returns the stored (name, price, store_id) row.
+        """
+        table = cls.__table__
+        columns = (table.c.name, table.c.price, table.c.store_id)
+        statement = cls._upsert_statement()
+        if statement is not None:
+            row = db.session.execute(statement.values(name=name, price=price, store_id=store_id)
+                                     .returning(*columns)).one()
+        else:
+            set_price = update(table).where(table.c.name == name).values(price=price)
+            if db.session.execute(set_price).rowcount == 0:
+                try:
+                    with db.session.begin_nested():
+                        db.session.execute(insert(table).values(name=name, price=price, store_id=store_id))
+                except IntegrityError:
+                    db.session.execute(set_price)
+            row = db.session.execute(select(*columns).where(table.c.name == name)).one()
+
+        invalidate_on_commit(db.session, cls, 'name', [name])
+        commit_or_defer()
+        return row
+
+    @classmethod
+    def upsert_batch(cls, rows):
+        """upsert() many rows in one transaction and return the stored row of each, in order.
+
+        Rows may repeat a name: the last one is written and each of them gets
+        the stored row back.
+        """
+        latest = {row['name']: row for row in rows}
+        with unit_of_work():
+            cls.upsert_many(list(latest.values()))
+            stored = {row.name: row for row in db.session.execute(
+                select(cls.name, cls.price, cls.store_id).where(cls.name.in_(latest)))}
+        return [stored[row['name']] for row in rows]
+
+    @classmethod
+    def _upsert_statement(cls):
+        """INSERT ... ON CONFLICT (name) DO UPDATE SET price, or None if the database lacks it."""
+        dialect = db.session.get_bind().dialect.name
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        elif dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            return None
+        statement = dialect_insert(cls.__table__)
+        return statement.on_conflict_do_update(index_elements=[cls.name], set_={'price': statement.excluded.price})
 
     def save_to_db(self):  # Upserting data
         db.session.add(self)
-        db.session.commit()  # Balla
+        commit_or_defer()  # Balla
 
     def delete_from_db(self):
         db.session.delete(self)
-        db.session.commit()
+        commit_or_defer()
@@ -2,31 +2,120 @@
 # -*- coding: utf-8 -*-
 # standard python imports
 
-from app.db import db
+from functools import lru_cache
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import load_only
+
+from app.db import commit_or_defer, db
+from app.util.cache import cached_lookup
+from app.models.item import ItemModel
+from app.util.json_provider import RowEncoder, encode_value
+from app.util.metrics import timed
+
+
+@lru_cache(maxsize=None)
+def _store_template(fields):
+    return '{' + ','.join(f'"{field}":%s' for field in fields) + '}'
 
 
 class StoreModel(db.Model):
     __tablename__ = 'stores'
+    __cache_keys__ = ('name',)
 
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(80))
+    name = db.Column(db.String(80), unique=True, index=True)
 
     items = db.relationship('ItemModel', lazy='dynamic', back_populates='store')
 
     def __init__(self, name):
         self.name = name
 
-    def json(self):
-        return {'id': self.id, 'name': self.name, 'items': [item.json() for item in self.items.all()]}
+    # The fields of json(), in the order they are written; `?fields=` picks a subset
+    FIELDS = ('id', 'items', 'name')
+
+    def json(self, fields=FIELDS, item_fields=ItemModel.FIELDS):
+        data = {field: getattr(self, field) for field in fields if field != 'items'}
+        if 'items' in fields:
+            # Only the item columns that are written are loaded
+            items = self.items.options(load_only(*ItemModel.json_columns(item_fields)))
+            data['items'] = [item.json(item_fields) for item in items]
+        return data
+
+    @classmethod
+    def json_columns(cls, fields=FIELDS):
+        """Columns to select for encoding `fields` of stores: the id, and the name if written."""
+        return (cls.id, cls.name) if 'name' in fields else (cls.id,)
+
+    @classmethod
+    def encode_many(cls, stores, fields=FIELDS, item_fields=ItemModel.FIELDS):
+        """Encode `fields` of `stores` as JSON text, with their items.
+
+        `items` is a dynamic relationship, so calling json() per store costs a
+        query per store. Here the items of every store are selected as plain
+        columns in a single IN query and encoded without building per-item
+        dicts, and not selected at all when `fields` leaves them out. `stores`
+        may be model instances or rows of json_columns(fields).
+        """
+        stores = list(stores)
+        rows = db.session.execute(cls.items_of(stores, item_fields)) if stores and 'items' in fields else ()
+        return cls.encode_with_items(stores, rows, fields, item_fields)
+
+    @staticmethod
+    def items_of(stores, item_fields=ItemModel.FIELDS):
+        """Select the json_columns(item_fields) of the items of `stores`, and their owner_id."""
+        return (select(*ItemModel.json_columns(item_fields), ItemModel.store_id.label('owner_id'))
+                .where(ItemModel.store_id.in_([store.id for store in stores]))
+                .order_by(ItemModel.id))
+
+    @staticmethod
+    @timed('serialize')
+    def encode_with_items(stores, item_rows, fields=FIELDS, item_fields=ItemModel.FIELDS):
+        """Encode `fields` of `stores` as JSON text, with their items taken from the rows of items_of()."""
+        encode_item = ItemModel.encoder_for(item_fields).encode
+        items_by_store = {store.id: [] for store in stores}
+        for row in item_rows:
+            items_by_store[row.owner_id].append(encode_item(row))
+        if fields == StoreModel.FIELDS:
+            return [f'{{"id":{store.id},"items":[{",".join(items_by_store[store.id])}],'
+                    f'"name":{encode_value(store.name)}}}' for store in stores]
+        template = _store_template(fields)
+        values = {'id': lambda store: encode_value(store.id),
+                  'items': lambda store: '[' + ','.join(items_by_store[store.id]) + ']',
+                  'name': lambda store: encode_value(store.name)}
+        encoders = [values[field] for field in fields]
+        return [template % tuple(encode(store) for encode in encoders) for store in stores]
+
+    # Encodes rows of summaries_of() into the objects of the /summary endpoints
+    summary_encoder = RowEncoder(('id', 'name', 'item_count', 'min_price', 'max_price', 'avg_price'))
+
+    @staticmethod
+    def summaries_of(stores):
+        """Select the item count and min/max/avg price of the stores selected by `stores`.
+
+        `stores` selects id and name, e.g. a page of keyset_query(). It is
+        aggregated in one GROUP BY that only reads the items of those stores
+        (through the items.store_id index), so a page of summaries costs the
+        same whatever the number of items, and sends one row per store.
+        """
+        page = stores.subquery()
+        price = ItemModel.price
+        return (select(page.c.id, page.c.name, func.count(ItemModel.id).label('item_count'),
+                       func.min(price).label('min_price'), func.max(price).label('max_price'),
+                       func.avg(price).label('avg_price'))
+                .select_from(page)
+                .outerjoin(ItemModel, ItemModel.store_id == page.c.id)
+                .group_by(page.c.id, page.c.name)
+                .order_by(page.c.id))
 
     @classmethod
     def find_by_name(cls, name):
-        return cls.query.filter_by(name=name).first()
+        return cached_lookup(cls, 'name', name)
 
     def save_to_db(self):
         db.session.add(self)
-        db.session.commit()
+        commit_or_defer()
 
     def delete_from_db(self):
         db.session.delete(self)
-        db.session.commit()
+        commit_or_defer()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# standard python imports
+
+from datetime import datetime, timezone
+
+from sqlalchemy import event, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+from app.db import db
+
+
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class TableVersionModel(db.Model):
+    """A change counter per table, bumped once by every transaction that writes to it.
+
+    Reads compare these counters instead of the rows themselves, see
+    app/util/conditional.py, which only bumps the tables some view reads
+    and does so as the transaction commits.
+    """
+    __tablename__ = 'table_versions'
+
+    name = db.Column(db.String(80), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=utcnow)
+
+    @classmethod
+    def bump(cls, connection, names):
+        """Increment the counters of `names` on `connection`, inside its transaction.
+
+        A missing counter is created at 1. On PostgreSQL and SQLite that is one
+        INSERT ... ON CONFLICT DO UPDATE per table; elsewhere the INSERT runs in
+        a savepoint after an UPDATE matched nothing, and the UPDATE is retried
+        when a concurrent transaction created the row first.
+        """
+        table = cls.__table__
+        now = utcnow()
+        statement = cls._bump_statement(connection.dialect.name)
+        for name in sorted(names):
+            if statement is not None:
+                connection.execute(statement.values(name=name, version=1, updated_at=now))
+                continue
+            bump = update(table).where(table.c.name == name).values(version=table.c.version + 1, updated_at=now)
+            if connection.execute(bump).rowcount == 0:
+                try:
+                    with connection.begin_nested():
+                        connection.execute(insert(table).values(name=name, version=1, updated_at=now))
+                except IntegrityError:
+                    connection.execute(bump)
+
+    @classmethod
+    def _bump_statement(cls, dialect):
+        """INSERT ... ON CONFLICT (name) DO UPDATE SET version + 1, or None if the database lacks it."""
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        elif dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            return None
+        table = cls.__table__
+        statement = dialect_insert(table)
+        return statement.on_conflict_do_update(index_elements=[table.c.name],
+                                               set_={'version': table.c.version + 1,
+                                                     'updated_at': statement.excluded.updated_at})
+
+    @classmethod
+    def find_versions(cls, names):
+        """Return {name: (version, updated_at)}, with (0, None) for tables never written."""
+        return cls.as_versions(names, db.session.execute(cls.versions_of(names)))
+
+    @classmethod
+    def versions_of(cls, names):
+        return select(cls.name, cls.version, cls.updated_at).where(cls.name.in_(names))
+
+    @staticmethod
+    def as_versions(names, rows):
+        versions = {name: (0, None) for name in names}
+        versions.update((name, (version, updated_at)) for name, version, updated_at in rows)
+        return versions
+
+
+@event.listens_for(TableVersionModel.__table__, 'after_create')
+def _seed_versions(target, connection, **kw):
+    # Start every table at version 0, so bumping is a plain UPDATE from then on
+    now = utcnow()
+    rows = [{'name': table.name, 'version': 0, 'updated_at': now}
+            for table in target.metadata.sorted_tables if table is not target]
+    if rows:
+        connection.execute(insert(target), rows)
@@ -2,33 +2,61 @@
 # -*- coding: utf-8 -*-
 # standard python imports
 
-from app.db import db
-from werkzeug.security import hmac
+from app.db import commit_or_defer, db
+from app.util.cache import cached_lookup
+from app.util.passwords import dummy_hash, hash_method, hash_password, needs_rehash, run_password_task, verify_password
 
 
 class UserModel(db.Model):
     __tablename__ = 'users'
+    __cache_keys__ = ('id', 'username')
+    __serializer_exclude__ = ('password',)
 
     id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(80))
-    password = db.Column(db.String(80))
+    username = db.Column(db.String(80), unique=True, index=True)
+    # A werkzeug salted hash: method$salt$hash
+    password = db.Column(db.String(255))
 
     def __init__(self, username, password):
         self.username = username
-        self.password = password
+        self.set_password(password)
 
     def save_to_db(self):
         db.session.add(self)
-        db.session.commit()
+        commit_or_defer()
+
+    def set_password(self, password):
+        self.password = run_password_task(hash_password, password, hash_method())
 
     def check_password(self, password):
-        return hmac.compare_digest(self.password, password)
+        return run_password_task(verify_password, self.password, password)
+
+    def password_needs_rehash(self):
+        return needs_rehash(self.password)
+
+    @staticmethod
+    def reject_password(password):
+        """Verify `password` against a dummy hash, for logins with an unknown username."""
+        run_password_task(verify_password, dummy_hash(hash_method()), password)
+        return False
 
     @classmethod
     def find_by_username(cls, username):
-        return cls.query.filter_by(username=username).first()
+        return cached_lookup(cls, 'username', username)
 
     @classmethod
     def find_by_id(cls, _id):
-        return cls.query.filter_by(id=_id).first()
+        return cached_lookup(cls, 'id', _id)
+
+
+class TokenPrincipal:
+    """The user described by the claims of a verified token, loaded from the database only on demand."""
+
+    def __init__(self, _id, username):
+        self.id = _id
+        self.username = username
+
+    @property
+    def user(self):
+        return UserModel.find_by_id(self.id)
 
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Read replica routing.
+
+With SQLALCHEMY_REPLICA_URIS set, each replica becomes a bind of `db` and
+the queries of GET and HEAD requests go to one of them, picked round robin
+per request. Everything else, and every flush or INSERT/UPDATE/DELETE
+statement, goes to the primary. A client that just wrote reads from the
+primary for REPLICA_STICKY_SECONDS, so it sees its own writes, and a
+replica that fails to connect is skipped for REPLICA_RETRY_SECONDS while
+the failed request is run again on the primary.
+"""
+
+import itertools
+import threading
+import time
+
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
+
+from app.auth import request_identity
+from app.config import engineOptions
+from app.db import db
+from app.util.cache import MISSING, LRUCache, SharedCache
+
+READ_METHODS = ('GET', 'HEAD')
+
+
+def replica_binds(uris):
+    """SQLALCHEMY_BINDS entries for the replica `uris`, named replica0, replica1, ..."""
+    return {f'replica{index}': dict(engineOptions(uri), url=uri) for index, uri in enumerate(uris)}
+
+
+def use_primary(view):
+    """Run `view` against the primary even on a GET, e.g. when it must not see replication lag."""
+    view.db_route = 'primary'
+    return view
+
+
+def use_replica(view):
+    """Let `view` read from a replica whatever its method, e.g. a read-only POST search."""
+    view.db_route = 'replica'
+    return view
+
+
+class ReplicaSet:
+    """The replica binds of an app, with their health and the clients currently pinned to the primary."""
+
+    def __init__(self, keys, retry_seconds, sticky):
+        self.keys = list(keys)
+        self.retry_seconds = retry_seconds
+        self.sticky = sticky
+        self._lock = threading.Lock()
+        self._down_until = {}
+        self._next = itertools.cycle(self.keys)
+
+    def healthy(self, key):
+        return self._down_until.get(key, 0) <= time.monotonic()
+
+    def mark_down(self, key):
+        with self._lock:
+            self._down_until[key] = time.monotonic() + self.retry_seconds
+
+    def pick(self):
+        """The next healthy replica, or None when all of them are down."""
+        with self._lock:
+            for _ in range(len(self.keys)):
+                key = next(self._next)
+                if self._down_until.get(key, 0) <= time.monotonic():
+                    return key
+        return None
+
+    def route(self):
+        """Choose the replica the queries of the current request go to, if any."""
+        view = current_app.view_functions.get(request.endpoint)
+        route = getattr(view, 'db_route', None) or ('replica' if request.method in READ_METHODS else 'primary')
+        if route == 'primary' or self.sticky.get(request_identity()) is not MISSING:
+            return None
+        return self.pick()
+
+
+def _choose_replica():
+    g.pop('db_wrote', None)
+    g.db_replica = current_app.extensions['replicas'].route()
+
+
+def _pin_writer(response):
+    if g.pop('db_wrote', False):
+        current_app.extensions['replicas'].sticky.set(request_identity(), True)
+    return response
+
+
+def _forget_replica(exc):
+    g.pop('db_replica', None)
+    g.pop('db_replica_failed', None)
+
+
+def _retry_on_primary(error):
+    # Only errors of a replica connection are retried, and only once
+    if not g.pop('db_replica_failed', False):
+        raise error
+    db.session.rollback()
+    g.db_replica = None
+    view = current_app.view_functions[request.endpoint]
+    return current_app.ensure_sync(view)(**request.view_args)
+
+
+def _watch_replica(replicas, key, engine):
+    def handle_error(context):
+        # A failed connect (no connection yet) or a dropped connection
+        if context.connection is None or context.is_disconnect:
+            replicas.mark_down(key)
+            if has_app_context():
+                g.db_replica_failed = True
+
+    event.listen(engine, 'handle_error', handle_error)
+
+
+@event.listens_for(Session, 'after_flush')
+def _note_flush(session, flush_context):
+    session.info['wrote'] = True
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _note_statement(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info['wrote'] = True
+
+
+def note_write():
+    """Pin the client to the primary, for writes committed by another session on its behalf."""
+    if has_app_context():
+        g.db_wrote = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _note_commit(session):
+    if session.info.pop('wrote', False):
+        note_write()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_writes(session):
+    session.info.pop('wrote', None)
+
+
+def init_replicas(app):
+    """Route the reads of GET requests to the replica binds created from SQLALCHEMY_REPLICA_URIS.
+
+    Clients that wrote are pinned to the primary for REPLICA_STICKY_SECONDS,
+    tracked per worker or, with REPLICA_STICKY_CLIENT (a Redis client), for
+    all workers.
+    """
+    app.config.setdefault('REPLICA_STICKY_SECONDS', 5)
+    app.config.setdefault('REPLICA_RETRY_SECONDS', 30)
+    keys = [key for key in app.config.get('SQLALCHEMY_BINDS') or {} if str(key).startswith('replica')]
+    if not keys:
+        return None
+
+    ttl = app.config['REPLICA_STICKY_SECONDS']
+    client = app.config.get('REPLICA_STICKY_CLIENT')
+    sticky = SharedCache(client, ttl=ttl, prefix='flask-restful:sticky:') if client else LRUCache(ttl=ttl)
+    replicas = app.extensions['replicas'] = ReplicaSet(keys, app.config['REPLICA_RETRY_SECONDS'], sticky)
+    with app.app_context():
+        for key in keys:
+            _watch_replica(replicas, key, db.engines[key])
+            # Replicas get their tables from the primary: keep create_all() and drop_all() off them
+            db.metadatas.pop(key, None)
+
+    app.before_request(_choose_replica)
+    app.after_request(_pin_writer)
+    app.teardown_request(_forget_replica)
+    app.register_error_handler(DBAPIError, _retry_on_primary)
+    return replicas
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# standard python imports
+
+from functools import wraps
+
+from flask import current_app, g, jsonify
+from flask_jwt_extended import get_current_user, verify_jwt_in_request
+from flask_jwt_extended.exceptions import UserLookupError
+from sqlalchemy import select
+
+from app.db import async_db
+from app.models.item import ItemModel
+from app.models.store import StoreModel
+from app.models.user import UserModel
+from app.resources.item import filter_items, items_page_response
+from app.resources.store import filter_stores, store_fields, stores_page_response, summaries_page_response
+from app.util.cache import cached_columns_async
+from app.util.conditional import conditional_async
+from app.util.json_provider import raw_json_response
+from app.util.logz import get_logger
+from app.util.pagination import PaginationError, keyset_query, parse_fields, parse_page_args, split_page
+
+logger = get_logger()
+
+# Blueprint endpoint -> async view, used by app/asgi.py in place of the sync view
+async_views = {}
+
+
+def async_view(endpoint):
+    def decorator(view):
+        async_views[endpoint] = view
+        return view
+    return decorator
+
+
+def jwt_required_async(view):
+    """jwt_required() for async views, which it would run in a nested event loop.
+
+    The user lookup callback only reads the token claims here; unless
+    JWT_TRUST_CLAIMS is set, the user row is then loaded through the
+    AsyncSession, so a cache miss does not block the event loop.
+    """
+    @wraps(view)
+    async def wrapper(*args, **kwargs):
+        g.async_user_lookup = True
+        jwt_header, jwt_data = verify_jwt_in_request()
+        if not current_app.config.get('JWT_TRUST_CLAIMS'):
+            user = await cached_columns_async(async_db.session, UserModel, 'id', get_current_user().id)
+            if user is None:
+                raise UserLookupError(f"user_lookup returned None for {jwt_data['sub']}", jwt_header, jwt_data)
+        return await view(*args, **kwargs)
+    return wrapper
+
+
+@async_view('item.get_item')
+@jwt_required_async
+async def get_item(name):
+    """Get an item by name."""
+    try:
+        fields, _ = parse_fields(ItemModel.FIELDS)
+    except PaginationError as e:
+        return jsonify({'message': str(e)}), 400
+    data = await cached_columns_async(async_db.session, ItemModel, 'name', name)
+    if data:
+        payload = {field: data[field] for field in fields}
+        logger.info('returning item: %s', payload)
+        return jsonify(payload)
+    return jsonify({'message': 'Item not found'}), 404
+
+
+@async_view('item.get_items')
+@jwt_required_async
+@conditional_async('items')
+async def get_items():
+    """Get a page of items, optionally filtered by store, price range or name prefix."""
+    try:
+        limit, after = parse_page_args()
+        fields, _ = parse_fields(ItemModel.FIELDS)
+        statement = filter_items(select(*ItemModel.json_columns(fields)))
+    except PaginationError as e:
+        return jsonify({'message': str(e)}), 400
+
+    rows = (await async_db.session.execute(keyset_query(statement, ItemModel.id, limit, after))).all()
+    return items_page_response(*split_page(rows, ItemModel.id, limit), ItemModel.encoder_for(fields))
+
+
+@async_view('store.get_store')
+@conditional_async('stores', 'items')
+async def get_store(name):
+    """Get a store by name."""
+    try:
+        fields, item_fields = store_fields()
+    except PaginationError as e:
+        return jsonify({'message': str(e)}), 400
+    session = async_db.session
+    store = (await session.execute(select(StoreModel.id, StoreModel.name).where(StoreModel.name == name))).first()
+    if store is None:
+        return jsonify({'message': 'Store not found'}), 404
+    items = await session.execute(StoreModel.items_of([store], item_fields)) if 'items' in fields else ()
+    return raw_json_response(StoreModel.encode_with_items([store], items, fields, item_fields)[0])
+
+
+@async_view('store.get_stores')
+@conditional_async('stores', 'items')
+async def get_stores():
+    """Get a page of stores, optionally filtered by name prefix."""
+    try:
+        limit, after = parse_page_args()
+        fields, item_fields = store_fields()
+        statement = filter_stores(select(*StoreModel.json_columns(fields)))
+    except PaginationError as e:
+        return jsonify({'message': str(e)}), 400
+
+    session = async_db.session
+    rows = (await session.execute(keyset_query(statement, StoreModel.id, limit, after))).all()
+    stores, next_cursor = split_page(rows, StoreModel.id, limit)
+    items = await session.execute(StoreModel.items_of(stores, item_fields)) if stores and 'items' in fields else ()
+    return stores_page_response(StoreModel.encode_with_items(stores, items, fields, item_fields), next_cursor)
+
+
+@async_view('store.get_store_summary')
+@conditional_async('stores', 'items')
+async def get_store_summary(name):
+    """Get the item count and min/max/avg item price of a store."""
+    statement = StoreModel.summaries_of(select(StoreModel.id, StoreModel.name).where(StoreModel.name == name))
+    row = (await async_db.session.execute(statement)).first()
+    if row is None:
+        return jsonify({'message': 'Store not found'}), 404
+    return raw_json_response(StoreModel.summary_encoder.encode_one(row))
+
+
+@async_view('store.get_stores_summary')
+@conditional_async('stores', 'items')
+async def get_stores_summary():
+    """Get a page of store summaries, optionally filtered by name prefix."""
+    try:
+        limit, after = parse_page_args()
+        stores = filter_stores(select(StoreModel.id, StoreModel.name))
+    except PaginationError as e:
+        return jsonify({'message': str(e)}), 400
+
+    statement = StoreModel.summaries_of(keyset_query(stores, StoreModel.id, limit, after))
+    rows = (await async_db.session.execute(statement)).all()
+    return summaries_page_response(*split_page(rows, StoreModel.id, limit))
@@ -1,28 +1,46 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 # standard python imports
-from flask import Blueprint, request, jsonify
+import json
+
+from flask import Blueprint, current_app, request, jsonify
 from flask_jwt_extended import jwt_required
+from app.db import db, insert_unique
 from app.models.item import ItemModel
-from app.util.logz import create_logger
+from app.replicas import note_write
+from app.search import search_backend, search_page
+from app.util.conditional import conditional
+from app.util.idempotency import idempotent
+from app.util.json_provider import encode_document, encode_value, raw_json_response
+from app.util.logz import get_logger
+from app.util.pagination import (PaginationError, keyset_page, page_links, parse_fields, parse_filter,
+                                 parse_page_args)
+from app.util.streaming import NDJSON_MIMETYPE, iter_query, ndjson_response, wants_stream
 
 item_bp = Blueprint('item', __name__)
-logger = create_logger()
+logger = get_logger()
 
 
 @item_bp.route('/item/<string:name>', methods=['GET'])
 @jwt_required()
 def get_item(name):
-    """Get an item by name."""
+    """Get an item by name, with only the `?fields=` given if any."""
+    try:
+        fields, _ = parse_fields(ItemModel.FIELDS)
+    except PaginationError as e:
+        return jsonify({'message': str(e)}), 400
+    # A single row comes from the lookup cache, so it is narrowed when serialized
     item = ItemModel.find_by_name(name)
     if item:
-        logger.info(f'returning item: {item.json()}')
-        return jsonify(item.json())
+        payload = item.json(fields)
+        logger.info('returning item: %s', payload)
+        return jsonify(payload)
     return jsonify({'message': 'Item not found'}), 404
 
 
 @item_bp.route('/item/<string:name>', methods=['POST'])
 @jwt_required()
+@idempotent
 def create_item(name):
     """Create a new item."""
     data = request.get_json()
@@ -36,10 +54,7 @@ def create_item(name):
     if 'store_id' not in data:
         return jsonify({'message': 'Must enter the store id'}), 400
 
-    logger.info(f'parsed data: {data}')
-
-    if ItemModel.find_by_name(name):
-        return jsonify({'message': f"An item with name '{name}' already exists."}), 400
+    logger.info('parsed data: %s', data)
 
     try:
         price = float(data['price'])
@@ -49,11 +64,14 @@ def create_item(name):
 
     item = ItemModel(name, price, store_id)
 
+    # The unique index on name rejects duplicates, even concurrent ones
     try:
-        item.save_to_db()
+        created = insert_unique(item)
     except Exception as e:
-        logger.error(f'Error inserting item: {e}')
+        logger.error('Error inserting item: %s', e)
         return jsonify({"message": "An error occurred inserting the item."}), 500
+    if not created:
+        return jsonify({'message': f"An item with name '{name}' already exists."}), 400
 
     return jsonify(item.json()), 201
 
@@ -71,6 +89,7 @@ def delete_item(name):
 
 @item_bp.route('/item/<string:name>', methods=['PUT'])
 @jwt_required()
+@idempotent
 def update_item(name):
     """Create or update an item."""
     data = request.get_json()
@@ -90,20 +109,189 @@ def update_item(name):
     except (ValueError, TypeError):
         return jsonify({'message': 'Invalid data types for price or store_id'}), 400
 
-    item = ItemModel.find_by_name(name)
+    committer = current_app.extensions.get('item_group_commit')
+    try:
+        if committer is not None:
+            # Written along with the PUTs of other requests, possibly by their thread
+            row = committer.submit({'name': name, 'price': price, 'store_id': store_id})
+            note_write()
+        else:
+            row = ItemModel.upsert(name, price, store_id)
+    except Exception as e:
+        logger.error('Error upserting item: %s', e)
+        return jsonify({"message": "An error occurred upserting the item."}), 500
+
+    return jsonify(row._asdict())
 
-    if item is None:
-        item = ItemModel(name, price, store_id)
-    else:
-        item.price = price
 
-    item.save_to_db()
+def _parse_bulk_body():
+    """Read the rows of a bulk request: a JSON array, {"items": [...]} or NDJSON."""
+    if request.mimetype == NDJSON_MIMETYPE:
+        lines = request.get_data(as_text=True).splitlines()
+        return [json.loads(line) for line in lines if line.strip()]
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        data = data.get('items')
+    if not isinstance(data, list):
+        raise ValueError('Expected a JSON array of items')
+    return data
 
-    return jsonify(item.json())
+
+def _validate_row(row, seen):
+    """Return the normalized row, or an error message if it cannot be applied."""
+    if not isinstance(row, dict):
+        return None, 'Item must be an object'
+    name = row.get('name')
+    if not isinstance(name, str) or not name:
+        return None, 'name field cannot be left blank'
+    if 'price' not in row:
+        return None, 'price field cannot be left blank'
+    if 'store_id' not in row:
+        return None, 'Must enter the store id'
+    try:
+        price = float(row['price'])
+        store_id = int(row['store_id'])
+    except (ValueError, TypeError):
+        return None, 'Invalid data types for price or store_id'
+    if name in seen:
+        return None, f"Duplicate of row {seen[name]}"
+    return {'name': name, 'price': price, 'store_id': store_id}, None
+
+
+@item_bp.route('/items', methods=['PUT'])
+@jwt_required()
+def bulk_upsert_items():
+    """Create or update many items at once.
+
+    Rows are validated in one pass and the valid ones are written in a single
+    transaction. The response has one result per input row, in order.
+    """
+    try:
+        data = _parse_bulk_body()
+    except ValueError as e:
+        return jsonify({'message': str(e) or 'Invalid request body'}), 400
+
+    max_rows = current_app.config.get('BULK_MAX_ROWS', 50000)
+    if len(data) > max_rows:
+        return jsonify({'message': f'At most {max_rows} items per request'}), 413
+
+    results = []
+    rows = []
+    seen = {}
+    for index, row in enumerate(data):
+        values, error = _validate_row(row, seen)
+        if error:
+            name = row.get('name') if isinstance(row, dict) else None
+            results.append({'name': name, 'status': 'invalid', 'message': error})
+        else:
+            seen[values['name']] = index
+            rows.append(values)
+            results.append({'name': values['name'], 'status': None})
+
+    if not rows:
+        return jsonify({'message': 'No valid items provided', 'results': results}), 400
+
+    try:
+        existing = ItemModel.upsert_many(rows)
+    except Exception as e:
+        logger.error('Error upserting items: %s', e)
+        return jsonify({'message': 'An error occurred upserting the items.'}), 500
+
+    for result in results:
+        if result['status'] is None:
+            result['status'] = 'updated' if result['name'] in existing else 'created'
+    return jsonify({'results': results})
+
+
+def filter_items(query=None):
+    """Apply the filters in the query string to `query`, ItemModel.query by default."""
+    store_id = parse_filter('store_id', int)
+    min_price = parse_filter('min_price', float)
+    max_price = parse_filter('max_price', float)
+    name_prefix = parse_filter('name_prefix')
+
+    if query is None:
+        query = ItemModel.query
+    if store_id is not None:
+        query = query.filter(ItemModel.store_id == store_id)
+    if min_price is not None:
+        query = query.filter(ItemModel.price >= min_price)
+    if max_price is not None:
+        query = query.filter(ItemModel.price <= max_price)
+    if name_prefix is not None:
+        query = query.filter(ItemModel.name.startswith(name_prefix, autoescape=True))
+    return query
 
 
 @item_bp.route('/items', methods=['GET'])
 @jwt_required()
+@conditional('items')
 def get_items():
-    """Get all items."""
-    return jsonify({'items': [item.json() for item in ItemModel.query.all()]})
+    """Get a page of items, optionally filtered by store, price range or name prefix.
+
+    With `?stream=1` or `Accept: application/x-ndjson` every matching item is
+    streamed as NDJSON instead. `?fields=name,price` selects and returns only
+    those fields of the items.
+    """
+    try:
+        limit, after = parse_page_args()
+        fields, _ = parse_fields(ItemModel.FIELDS)
+        query = filter_items()
+    except PaginationError as e:
+        return jsonify({'message': str(e)}), 400
+
+    # Select plain columns and encode them directly, no ORM objects or dicts
+    query = query.with_entities(*ItemModel.json_columns(fields))
+    encoder = ItemModel.encoder_for(fields)
+
+    if wants_stream():
+        if after is not None:
+            query = query.filter(ItemModel.id > after)
+        return ndjson_response(iter_query(query.order_by(ItemModel.id)), encode=encoder.encode)
+
+    rows, next_cursor = keyset_page(query, ItemModel.id, limit, after)
+    return items_page_response(rows, next_cursor, encoder)
+
+
+def items_page_response(rows, next_cursor, encoder=ItemModel.row_encoder):
+    """Encode a page of json_columns() rows as the GET /items response."""
+    next_url, headers = page_links(next_cursor)
+    body = encode_document([('items', encoder.encode_many(rows)),
+                            ('next', encode_value(next_url)),
+                            ('next_cursor', encode_value(next_cursor))])
+    return raw_json_response(body, headers=headers)
+
+
+@item_bp.route('/items/search', methods=['GET'])
+@jwt_required()
+@conditional('items')
+def search_items():
+    """Find items by name, best matches first.
+
+    Names containing `?q=` match: those starting with it first, then those
+    with a word starting with it. When none does, names sharing enough of
+    its letters match instead (`"match": "fuzzy"`), so typos still find
+    items. Results are paginated with `limit` and `after`, the number of
+    results already returned, and take `fields` like GET /items.
+    """
+    try:
+        limit, after = parse_page_args()
+        fields, _ = parse_fields(ItemModel.FIELDS)
+        q = (parse_filter('q') or '').strip()
+    except PaginationError as e:
+        return jsonify({'message': str(e)}), 400
+    if not q:
+        return jsonify({'message': "'q' is required"}), 400
+    offset = after or 0
+    if offset < 0:
+        return jsonify({'message': "'after' must not be negative"}), 400
+
+    rows, match = search_page(db.session, search_backend(db.session.connection()), q, offset, limit, fields)
+
+    next_cursor = offset + limit if len(rows) > limit else None
+    next_url, headers = page_links(next_cursor)
+    body = encode_document([('items', ItemModel.encoder_for(fields).encode_many(rows[:limit])),
+                            ('match', encode_value(match)),
+                            ('next', encode_value(next_url)),
+                            ('next_cursor', encode_value(next_cursor))])
+    return raw_json_response(body, headers=headers)
@@ -3,36 +3,50 @@
 # standard python imports
 
 from flask import Blueprint, request, jsonify
+from sqlalchemy import select
+from app.db import db, insert_unique
+from app.models.item import ItemModel
 from app.models.store import StoreModel
 from flask_jwt_extended import jwt_required
-from app.util.logz import create_logger
+from app.util.logz import get_logger
+from app.util.conditional import conditional
+from app.util.idempotency import idempotent
+from app.util.json_provider import encode_document, encode_value, raw_json_response
+from app.util.pagination import (PaginationError, keyset_page, keyset_query, page_links, parse_fields,
+                                 parse_filter, parse_page_args, split_page)
+from app.util.streaming import iter_batches, iter_query, ndjson_response, wants_stream
 
 store_bp = Blueprint('store', __name__)
-logger = create_logger()
+logger = get_logger()
 
 
 @store_bp.route('/store/<string:name>', methods=['GET'])
+@conditional('stores', 'items')
 def get_store(name):
-    """Get a store by name."""
+    """Get a store by name, with only the `?fields=` given if any."""
+    try:
+        fields, item_fields = store_fields()
+    except PaginationError as e:
+        return jsonify({'message': str(e)}), 400
     store = StoreModel.find_by_name(name)
     if store:
-        return jsonify(store.json())
+        return raw_json_response(StoreModel.encode_many([store], fields, item_fields)[0])
     return jsonify({'message': 'Store not found'}), 404
 
 
 @store_bp.route('/store/<string:name>', methods=['POST'])
 @jwt_required()
+@idempotent
 def create_store(name):
     """Create a new store."""
-    if StoreModel.find_by_name(name):
-        return jsonify({'message': f"A store with name '{name}' already exists."}), 400
-
     store = StoreModel(name)
     try:
-        store.save_to_db()
+        created = insert_unique(store)
     except Exception as e:
-        logger.error(f'Error creating store: {e}')
+        logger.error('Error creating store: %s', e)
         return jsonify({"message": "An error occurred creating the store."}), 500
+    if not created:
+        return jsonify({'message': f"A store with name '{name}' already exists."}), 400
 
     return jsonify(store.json()), 201
 
@@ -49,6 +63,88 @@ def delete_store(name):
 
 
 @store_bp.route('/stores', methods=['GET'])
+@conditional('stores', 'items')
 def get_stores():
-    """Get all stores."""
-    return jsonify({'stores': [store.json() for store in StoreModel.query.all()]})
+    """Get a page of stores, optionally filtered by name prefix.
+
+    With `?stream=1` or `Accept: application/x-ndjson` every matching store is
+    streamed as NDJSON instead, loading items one batch of stores at a time.
+    `?fields=id,name` leaves the items out, so they are not queried at all.
+    """
+    try:
+        limit, after = parse_page_args()
+        fields, item_fields = store_fields()
+        query = filter_stores(StoreModel.query.with_entities(*StoreModel.json_columns(fields)))
+    except PaginationError as e:
+        return jsonify({'message': str(e)}), 400
+
+    if wants_stream():
+        if after is not None:
+            query = query.filter(StoreModel.id > after)
+        batches = iter_batches(iter_query(query.order_by(StoreModel.id)))
+        return ndjson_response((store for batch in batches
+                                for store in StoreModel.encode_many(batch, fields, item_fields)), encode=str)
+
+    stores, next_cursor = keyset_page(query, StoreModel.id, limit, after)
+    return stores_page_response(StoreModel.encode_many(stores, fields, item_fields), next_cursor)
+
+
+def store_fields():
+    """Read `fields` and `include` for stores: the store fields and the fields of their items."""
+    fields, nested = parse_fields(StoreModel.FIELDS, {'items': ItemModel.FIELDS})
+    return fields, nested.get('items', ())
+
+
+def stores_page_response(encoded_stores, next_cursor):
+    """Build the GET /stores response from stores encoded by StoreModel.encode_many()."""
+    next_url, headers = page_links(next_cursor)
+    body = encode_document([('next', encode_value(next_url)),
+                            ('next_cursor', encode_value(next_cursor)),
+                            ('stores', '[' + ','.join(encoded_stores) + ']')])
+    return raw_json_response(body, headers=headers)
+
+
+def filter_stores(query):
+    """Apply the name_prefix filter of the query string to a query or select() of stores."""
+    name_prefix = parse_filter('name_prefix')
+    if name_prefix is not None:
+        query = query.filter(StoreModel.name.startswith(name_prefix, autoescape=True))
+    return query
+
+
+@store_bp.route('/store/<string:name>/summary', methods=['GET'])
+@conditional('stores', 'items')
+def get_store_summary(name):
+    """Get the item count and min/max/avg item price of a store."""
+    row = db.session.execute(StoreModel.summaries_of(select(StoreModel.id, StoreModel.name)
+                                                     .where(StoreModel.name == name))).first()
+    if row is None:
+        return jsonify({'message': 'Store not found'}), 404
+    return raw_json_response(StoreModel.summary_encoder.encode_one(row))
+
+
+@store_bp.route('/stores/summary', methods=['GET'])
+@conditional('stores', 'items')
+def get_stores_summary():
+    """Get a page of store summaries, optionally filtered by name prefix.
+
+    Each store comes with its item count and min/max/avg item price, computed
+    by the database instead of sending every item.
+    """
+    try:
+        limit, after = parse_page_args()
+        stores = filter_stores(select(StoreModel.id, StoreModel.name))
+    except PaginationError as e:
+        return jsonify({'message': str(e)}), 400
+
+    rows = db.session.execute(StoreModel.summaries_of(keyset_query(stores, StoreModel.id, limit, after))).all()
+    return summaries_page_response(*split_page(rows, StoreModel.id, limit))
+
+
+def summaries_page_response(rows, next_cursor):
+    """Encode a page of summaries_of() rows as the GET /stores/summary response."""
+    next_url, headers = page_links(next_cursor)
+    body = encode_document([('next', encode_value(next_url)),
+                            ('next_cursor', encode_value(next_cursor)),
+                            ('stores', StoreModel.summary_encoder.encode_many(rows))])
+    return raw_json_response(body, headers=headers)
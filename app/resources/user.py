@@ -3,15 +3,21 @@
 # standard python imports
 
 from flask import Blueprint, request, jsonify
-from flask_jwt_extended import create_access_token, jwt_required
+from flask_jwt_extended import jwt_required
 from flask_jwt_extended import current_user
+from app.auth import create_user_token
+from app.db import insert_unique
 from app.models.user import UserModel
-from app.util.encoder import AlchemyEncoder
-import json
-from app.util.logz import create_logger
+from app.util.idempotency import idempotent
+from app.util.logz import get_logger
+from app.util.passwords import PasswordWorkersBusy
 
 user_bp = Blueprint('user', __name__)
-logger = create_logger()
+logger = get_logger()
+
+
+def _busy():
+    return jsonify({'message': 'Too many password checks in progress, try again shortly.'}), 503, {'Retry-After': '1'}
 
 
 @user_bp.route('/user', methods=['POST'])
@@ -31,12 +37,19 @@ def login():
     username = data['username']
     password = data['password']
 
+    # Not find_by_username(): cached users lack the password hash
     user = UserModel.query.filter_by(username=username).one_or_none()
-    if not user or not user.check_password(password):
+    try:
+        valid = user.check_password(password) if user else UserModel.reject_password(password)
+        if valid and user.password_needs_rehash():
+            # Stored with older hash parameters (or in plaintext)
+            user.set_password(password)
+            user.save_to_db()
+    except PasswordWorkersBusy:
+        return _busy()
+    if not valid:
         return jsonify({'message': 'Wrong username or password.'}), 401
-    # Notice that we are passing in the actual sqlalchemy user object here
-    access_token = create_access_token(
-        identity=json.dumps(user, cls=AlchemyEncoder))
+    access_token = create_user_token(user)
     return jsonify(access_token=access_token)
 
 
@@ -52,6 +65,7 @@ def get_current_user():
 
 
 @user_bp.route('/register', methods=['POST'])
+@idempotent
 def register():
     """User registration endpoint."""
     data = request.get_json()
@@ -65,10 +79,12 @@ def register():
     if 'password' not in data:
         return jsonify({'message': 'password field cannot be left blank'}), 400
 
-    if UserModel.find_by_username(data['username']):
+    try:
+        user = UserModel(**data)
+    except PasswordWorkersBusy:
+        return _busy()
+    # The unique index on username rejects duplicates, even concurrent ones
+    if not insert_unique(user):
         return jsonify({'message': 'UserModel has already been created, aborting.'}), 400
 
-    user = UserModel(**data)
-    user.save_to_db()
-
     return jsonify({'message': 'user has been created successfully.'}), 201
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# standard python imports
+
+from sqlalchemy import func, inspect, select
+
+from app.db import db
+from app.search import create_search_index, get_indexes
+
+
+class SchemaUpgradeError(Exception):
+    """Raised when an existing database cannot be brought up to date."""
+
+
+def _duplicates(connection, table, columns):
+    query = (select(*columns, func.count())
+             .select_from(table)
+             .group_by(*columns)
+             .having(func.count() > 1)
+             .limit(5))
+    return connection.execute(query).all()
+
+
+def widen_column_ddl(dialect, table, column):
+    """Return the statement changing `column` to its declared, longer, type (or None)."""
+    preparer = dialect.identifier_preparer
+    table_name, column_name = preparer.format_table(table), preparer.quote(column.name)
+    column_type = column.type.compile(dialect=dialect)
+    if dialect.name == 'postgresql':
+        return f'ALTER TABLE {table_name} ALTER COLUMN {column_name} TYPE {column_type}'
+    if dialect.name == 'mssql':
+        return f'ALTER TABLE {table_name} ALTER COLUMN {column_name} {column_type}'
+    if dialect.name in ('mysql', 'mariadb'):
+        return f'ALTER TABLE {table_name} MODIFY {column_name} {column_type}'
+    # SQLite does not enforce VARCHAR lengths
+    return None
+
+
+def _short_columns(inspector, table):
+    existing = {column['name']: column['type'] for column in inspector.get_columns(table.name)}
+    for column in table.columns:
+        length = getattr(column.type, 'length', None)
+        current = getattr(existing.get(column.name), 'length', None)
+        if length and current and current < length:
+            yield column
+
+
+def upgrade_schema(engine=None):
+    """Create missing tables and indexes on an existing database.
+
+    `db.create_all()` only creates tables that do not exist yet, so databases
+    created before an index was declared on a model never get it. This adds
+    every declared index that is missing, widens string columns declared
+    longer than they were created (e.g. users.password for hashes), adds the
+    item name search index of app/search.py and returns the names of the
+    indexes and columns changed. Unique indexes are refused while the column
+    still holds duplicate values.
+    """
+    engine = engine or db.engine
+    db.metadata.create_all(engine)
+
+    created = []
+    with engine.begin() as connection:
+        inspector = inspect(connection)
+        for table in db.metadata.sorted_tables:
+            for column in _short_columns(inspector, table):
+                ddl = widen_column_ddl(connection.dialect, table, column)
+                if ddl:
+                    connection.exec_driver_sql(ddl)
+                    created.append(f'{table.name}.{column.name}')
+            existing = {index['name'] for index in get_indexes(inspector, table.name)}
+            for index in sorted(table.indexes, key=lambda i: i.name):
+                if index.name in existing:
+                    continue
+                if index.unique:
+                    duplicates = _duplicates(connection, table, list(index.columns))
+                    if duplicates:
+                        raise SchemaUpgradeError(
+                            f'Cannot create unique index {index.name}: duplicate values {duplicates}')
+                index.create(connection)
+                created.append(index.name)
+        created.extend(create_search_index(connection))
+    return created
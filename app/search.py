@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Item name search.
+
+Matches are ranked in tiers: names starting with the query, then names
+with a word starting with it, then names containing it anywhere else.
+On SQLite each tier is read in index order, so a page stops after `limit`
+rows however many items match, instead of ranking every match first.
+
+SQLite gets `items_search`, an FTS5 table with the trigram tokenizer that
+indexes items.name (as external content, kept in sync by triggers), and
+PostgreSQL a GIN pg_trgm index on items.name; both also get an index on
+lower(name) for the first tier, in byte order ("C" collation) on
+PostgreSQL so that the tier sorts by it whatever the database collation.
+A query without any match falls back to names sharing trigrams with it,
+best first, so typos still find items. Other databases scan with LIKE and
+have no fuzzy match.
+
+Latency was measured on SQLite only (benchmarks/bench_search.py); the
+PostgreSQL plans, for the later tiers especially, are unverified.
+"""
+
+import sqlite3
+import warnings
+import weakref
+
+from sqlalchemy import column, event, func, inspect, literal, not_, select, table
+from sqlalchemy.exc import SAWarning
+
+from app.models.item import ItemModel
+
+SQLITE_TABLE = 'items_search'
+POSTGRES_INDEX = 'ix_items_name_trgm'
+LOWER_NAME_INDEX = 'ix_items_name_lower'
+# Trigrams need three characters; shorter queries only match name prefixes
+MIN_INDEXED_LENGTH = 3
+# Names ranked by a fuzzy search at most
+FUZZY_CANDIDATES = 1000
+
+_items_search = table(SQLITE_TABLE, column('rowid'), column('name'))
+# Engine -> whether its database has the search index
+_indexed = weakref.WeakKeyDictionary()
+
+
+def search_index_ddl(dialect):
+    """The statements creating the search index of `dialect`, empty when it has none."""
+    if dialect.name == 'sqlite' and sqlite3.sqlite_version_info >= (3, 34):
+        return [
+            f"CREATE INDEX {LOWER_NAME_INDEX} ON items (lower(name))",
+            f"CREATE VIRTUAL TABLE {SQLITE_TABLE} USING fts5(name, content='items', content_rowid='id', "
+            f"tokenize='trigram')",
+            f"CREATE TRIGGER {SQLITE_TABLE}_ai AFTER INSERT ON items BEGIN "
+            f"INSERT INTO {SQLITE_TABLE}(rowid, name) VALUES (new.id, new.name); END",
+            f"CREATE TRIGGER {SQLITE_TABLE}_ad AFTER DELETE ON items BEGIN "
+            f"INSERT INTO {SQLITE_TABLE}({SQLITE_TABLE}, rowid, name) VALUES ('delete', old.id, old.name); END",
+            f"CREATE TRIGGER {SQLITE_TABLE}_au AFTER UPDATE OF name ON items BEGIN "
+            f"INSERT INTO {SQLITE_TABLE}({SQLITE_TABLE}, rowid, name) VALUES ('delete', old.id, old.name); "
+            f"INSERT INTO {SQLITE_TABLE}(rowid, name) VALUES (new.id, new.name); END",
+            # Index the items already there, e.g. when added by upgrade_schema()
+            f"INSERT INTO {SQLITE_TABLE}({SQLITE_TABLE}) VALUES ('rebuild')",
+        ]
+    if dialect.name == 'postgresql':
+        return [
+            'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+            f'CREATE INDEX {LOWER_NAME_INDEX} ON items (lower(name) COLLATE "C")',
+            f'CREATE INDEX {POSTGRES_INDEX} ON items USING gin (name gin_trgm_ops)',
+        ]
+    return []
+
+
+def get_indexes(inspector, table_name):
+    """inspector.get_indexes(), without warning that the lower(name) index is skipped.
+
+    SQLAlchemy does not reflect expression indexes and warns about each one.
+    """
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', 'Skipped unsupported reflection of expression-based index',
+                                SAWarning)
+        return inspector.get_indexes(table_name)
+
+
+def has_search_index(connection):
+    inspector = inspect(connection)
+    if connection.dialect.name == 'sqlite':
+        return SQLITE_TABLE in inspector.get_table_names()
+    if connection.dialect.name == 'postgresql':
+        return POSTGRES_INDEX in {index['name'] for index in get_indexes(inspector, 'items')}
+    return False
+
+
+def create_search_index(connection):
+    """Create the search index if the database supports one and lacks it; return the names created."""
+    statements = search_index_ddl(connection.dialect)
+    if not statements or has_search_index(connection):
+        return []
+    for statement in statements:
+        connection.exec_driver_sql(statement)
+    _indexed.pop(connection.engine, None)
+    return [LOWER_NAME_INDEX, SQLITE_TABLE if connection.dialect.name == 'sqlite' else POSTGRES_INDEX]
+
+
+def drop_search_index(connection):
+    # The triggers and the indexes go with the items table
+    if connection.dialect.name == 'sqlite':
+        connection.exec_driver_sql(f'DROP TABLE IF EXISTS {SQLITE_TABLE}')
+    _indexed.pop(connection.engine, None)
+
+
+@event.listens_for(ItemModel.__table__, 'after_create')
+def _create_with_items(target, connection, **kw):
+    create_search_index(connection)
+
+
+@event.listens_for(ItemModel.__table__, 'before_drop')
+def _drop_with_items(target, connection, **kw):
+    drop_search_index(connection)
+
+
+def search_backend(connection):
+    """'sqlite' or 'postgresql' when the database of `connection` has the search index, else 'like'."""
+    engine = connection.engine
+    if engine not in _indexed:
+        _indexed[engine] = has_search_index(connection)
+    return connection.dialect.name if _indexed[engine] else 'like'
+
+
+def _fts_phrase(text):
+    return '"' + text.replace('"', '""') + '"'
+
+
+def trigrams(text):
+    """The distinct lower cased trigrams of `text`, in order."""
+    text = text.lower()
+    return list(dict.fromkeys(text[i:i + 3] for i in range(len(text) - 2)))
+
+
+def _lower_name(backend):
+    # The expression of the lower(name) index, collation included
+    lower_name = func.lower(ItemModel.name)
+    return lower_name.collate('C') if backend == 'postgresql' else lower_name
+
+
+def _starts_with(backend, q):
+    lower_name = _lower_name(backend)
+    if backend in ('sqlite', 'postgresql'):
+        # A range, so the lower(name) index is used; lowered by the database like the index
+        lower_q = func.lower(literal(q))
+        return (lower_name >= lower_q) & (lower_name < lower_q + '\U0010ffff')
+    return lower_name.startswith(q.lower(), autoescape=True)
+
+
+def search_tiers(backend, q, fields=ItemModel.FIELDS):
+    """Select the json_columns(fields) of the items matching `q`, one select() per rank, best first.
+
+    The tiers do not overlap. The first is ordered by the lower(name) index,
+    the others by the row id. Queries shorter than three characters only
+    have the first tier.
+    """
+    columns = ItemModel.json_columns(fields)
+    prefix = _starts_with(backend, q)
+    tiers = [select(*columns).where(prefix).order_by(_lower_name(backend), ItemModel.id)]
+    if len(q) < MIN_INDEXED_LENGTH:
+        return tiers
+    if backend == 'sqlite':
+        matches = (_fts_phrase(' ' + q), f'{_fts_phrase(q)} NOT {_fts_phrase(" " + q)}')
+        return tiers + [select(*columns)
+                        .select_from(_items_search)
+                        .join(ItemModel, ItemModel.id == _items_search.c.rowid)
+                        .where(_items_search.c.name.match(match), not_(prefix))
+                        .order_by(_items_search.c.rowid)
+                        for match in matches]
+    word = ItemModel.name.icontains(' ' + q, autoescape=True)
+    inner = ItemModel.name.icontains(q, autoescape=True)
+    return tiers + [select(*columns).where(condition, not_(prefix)).order_by(ItemModel.id)
+                    for condition in (word, inner & not_(word))]
+
+
+def _selective_trigrams(session, q):
+    # The rarest trigrams of q, in at most FUZZY_CANDIDATES names together (or
+    # the rarest one); counting stops there, so common trigrams cost little
+    grams = trigrams(q)
+    counts = session.execute(select(*(
+        select(func.count()).select_from(
+            select(_items_search.c.rowid).where(_items_search.c.name.match(_fts_phrase(gram)))
+            .limit(FUZZY_CANDIDATES).subquery()).scalar_subquery()
+        for gram in grams))).one()
+    chosen, total = [], 0
+    for count, gram in sorted((count, gram) for count, gram in zip(counts, grams) if count):
+        if chosen and total + count > FUZZY_CANDIDATES:
+            break
+        chosen.append(gram)
+        total += count
+    return chosen
+
+
+def similarity(grams, name):
+    """The share of the trigrams of `name` and of the query trigrams `grams` they have in common."""
+    name = name.lower()
+    name_grams = {name[i:i + 3] for i in range(len(name) - 2)}
+    return len(grams & name_grams) / len(grams | name_grams)
+
+
+def fuzzy_page(session, backend, q, offset, limit, fields=ItemModel.FIELDS):
+    """Fetch up to `limit` + 1 items from position `offset` of those sharing trigrams with `q`, most similar first.
+
+    On SQLite the candidates are at most FUZZY_CANDIDATES names sharing the
+    rarest trigrams of `q`, ranked here by trigram similarity, so a typo
+    does not rank every name that shares a common trigram with it.
+    PostgreSQL ranks with pg_trgm's word_similarity(). None without an index.
+    """
+    columns = ItemModel.json_columns(fields)
+    if backend == 'postgresql':
+        return session.execute(select(*columns)
+                               .where(ItemModel.name.op('%>')(q))
+                               .order_by(func.word_similarity(q, ItemModel.name).desc(), ItemModel.id)
+                               .offset(offset).limit(limit + 1)).all()
+    if backend != 'sqlite':
+        return None
+    chosen = _selective_trigrams(session, q)
+    if not chosen:
+        return []
+    candidates = session.execute(select(ItemModel.id, ItemModel.name)
+                                 .join_from(_items_search, ItemModel, ItemModel.id == _items_search.c.rowid)
+                                 .where(_items_search.c.name.match(' OR '.join(map(_fts_phrase, chosen))))
+                                 .limit(FUZZY_CANDIDATES)).all()
+    grams = set(trigrams(q))
+    ranked = sorted(candidates, key=lambda row: (-similarity(grams, row.name), row.id))
+    ids = [row.id for row in ranked[offset:offset + limit + 1]]
+    position = {item_id: index for index, item_id in enumerate(ids)}
+    rows = session.execute(select(*columns).where(ItemModel.id.in_(ids))).all()
+    return sorted(rows, key=lambda row: position[row.id])
+
+
+def _read_tiers(session, tiers, offset, limit):
+    # A page may span tiers; tiers wholly before `offset` are only counted
+    rows = []
+    for tier in tiers:
+        if len(rows) > limit:
+            break
+        page = session.execute(tier.offset(offset).limit(limit + 1 - len(rows))).all()
+        if page:
+            rows.extend(page)
+            offset = 0
+        elif offset:
+            offset -= session.scalar(select(func.count()).select_from(tier.order_by(None).subquery()))
+    return rows, offset
+
+
+def search_page(session, backend, q, offset, limit, fields=ItemModel.FIELDS):
+    """Fetch up to `limit` + 1 search results of `q` from position `offset`.
+
+    Returns the rows and how they matched: 'prefix' (queries shorter than
+    three characters), 'substring' or 'fuzzy' when no name contains `q`.
+    """
+    rows, remaining = _read_tiers(session, search_tiers(backend, q, fields), offset, limit)
+    if len(q) < MIN_INDEXED_LENGTH:
+        return rows, 'prefix'
+    # Nothing read and nothing skipped: no name contains q
+    fuzzy = None if rows or remaining != offset else fuzzy_page(session, backend, q, offset, limit, fields)
+    if fuzzy is None:
+        return rows, 'substring'
+    return fuzzy, 'fuzzy'
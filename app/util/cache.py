@@ -0,0 +1,462 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# standard python imports
+
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+
+from app.db import db, reading_from_replica
+from app.util.encoder import serialize
+
+MISSING = object()
+# Seconds a lookup may take between lease() and fill() before its lease lapses
+LEASE_TTL = 5
+
+
+class CacheStats:
+    """Hit and miss counters, overall and per key namespace."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+
+    def record(self, key, hit):
+        namespace = key.rsplit(':', 1)[0]
+        with self._lock:
+            (self.hits if hit else self.misses)[namespace] += 1
+
+    def reset(self):
+        with self._lock:
+            self.hits.clear()
+            self.misses.clear()
+
+    def as_dict(self):
+        with self._lock:
+            namespaces = sorted(set(self.hits) | set(self.misses))
+            return {
+                'hits': sum(self.hits.values()),
+                'misses': sum(self.misses.values()),
+                'namespaces': {ns: {'hits': self.hits[ns], 'misses': self.misses[ns]} for ns in namespaces},
+            }
+
+
+class NullCache:
+    """Cache that never stores anything."""
+
+    def __init__(self):
+        self.counters = CacheStats()
+
+    def get(self, key):
+        self.counters.record(key, False)
+        return MISSING
+
+    def set(self, key, value):
+        pass
+
+    def add(self, key, value, ttl=None):
+        return True
+
+    def lease(self, key):
+        return None
+
+    def fill(self, key, lease, value):
+        return False
+
+    def delete(self, *keys):
+        pass
+
+    def clear(self):
+        pass
+
+    def stats(self):
+        return dict(self.counters.as_dict(), type='null', size=0)
+
+
+class _Lease:
+    __slots__ = ()
+
+
+class LRUCache:
+    """In-process least recently used cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, max_entries=10000, ttl=300.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.counters = CacheStats()
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > now:
+                self._data.move_to_end(key)
+                value = MISSING if isinstance(entry[1], _Lease) else entry[1]
+            else:
+                if entry is not None:
+                    del self._data[key]
+                value = MISSING
+        self.counters.record(key, value is not MISSING)
+        return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._store(key, value, time.monotonic() + self.ttl)
+
+    def add(self, key, value, ttl=None):
+        """Set `key` for `ttl` seconds (default self.ttl) only if it holds no live entry. Returns whether it was set."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > now:
+                return False
+            self._store(key, value, now + (self.ttl if ttl is None else ttl))
+        return True
+
+    def lease(self, key):
+        """Reserve the empty `key` for a fill(); returns the lease, or None if `key` holds an entry or a lease."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > now:
+                return None
+            lease = _Lease()
+            self._store(key, lease, now + LEASE_TTL)
+        return lease
+
+    def fill(self, key, lease, value):
+        """Set `key` to `value` if it still holds `lease`, i.e. was not deleted since. Returns whether it was set."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[1] is not lease or entry[0] <= now:
+                return False
+            self._store(key, value, now + self.ttl)
+        return True
+
+    def _store(self, key, value, expires):
+        # Called holding the lock
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            size = len(self._data)
+        return dict(self.counters.as_dict(), type='lru', size=size, max_entries=self.max_entries)
+
+
+class LocalSharedClient:
+    """Stand-in for a shared key/value server, implementing the Redis client calls we use.
+
+    Lua scripts cannot run here; `register_script` instead returns the Python
+    emulation registered for the script with `emulate_script`.
+    """
+
+    _script_emulations = {}
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._data = {}
+
+    @classmethod
+    def emulate_script(cls, script, emulation):
+        """Run `emulation(client, keys, args)` for `script`, atomically like Redis would."""
+        cls._script_emulations[script] = emulation
+
+    def register_script(self, script):
+        emulation = self._script_emulations[script]
+
+        def run(keys=(), args=()):
+            with self._lock:
+                return emulation(self, list(keys), list(args))
+        return run
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires is not None and expires <= time.monotonic():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, ex=None, nx=False):
+        with self._lock:
+            if nx and self.get(key) is not None:
+                return None
+            self._data[key] = (time.monotonic() + ex if ex else None, value)
+        return True
+
+    def delete(self, *keys):
+        with self._lock:
+            return sum(self._data.pop(key, None) is not None for key in keys)
+
+    def flushdb(self):
+        with self._lock:
+            self._data.clear()
+
+
+# KEYS[1] = key, ARGV = lease, value, ttl. Sets the key only while it holds the lease.
+FILL_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  redis.call('SET', KEYS[1], ARGV[2], 'EX', tonumber(ARGV[3]))
+  return 1
+end
+return 0
+"""
+
+
+def _emulate_fill(client, keys, args):
+    lease, value, ttl = args
+    if client.get(keys[0]) != lease:
+        return 0
+    client.set(keys[0], value, ex=int(ttl))
+    return 1
+
+
+LocalSharedClient.emulate_script(FILL_SCRIPT, _emulate_fill)
+
+# Leases are stored as 'lease:<token>', which no JSON value starts with
+LEASE_PREFIX = 'lease:'
+
+
+class SharedCache:
+    """Cache kept in a shared backend (e.g. a Redis client) so all workers see it.
+
+    `client` needs `get(key)`, `set(key, value, ex=seconds, nx=False)` and `delete(*keys)`,
+    and for fill() redis-py's `register_script`. Values are stored JSON encoded
+    under `prefix`.
+    """
+
+    def __init__(self, client, ttl=300.0, prefix='flask-restful:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.counters = CacheStats()
+        self._fill_script = None
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        if isinstance(raw, bytes):
+            raw = raw.decode()
+        if raw is not None and raw.startswith(LEASE_PREFIX):
+            raw = None
+        self.counters.record(key, raw is not None)
+        return MISSING if raw is None else json.loads(raw)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, json.dumps(value), ex=max(1, int(self.ttl)))
+
+    def add(self, key, value, ttl=None):
+        """Set `key` for `ttl` seconds (default self.ttl) only if absent (SET NX). Returns whether it was set."""
+        ttl = self.ttl if ttl is None else ttl
+        return bool(self.client.set(self.prefix + key, json.dumps(value), ex=max(1, int(ttl)), nx=True))
+
+    def lease(self, key):
+        """Reserve the empty `key` for a fill() (SET NX); returns the lease, or None if `key` is taken."""
+        lease = LEASE_PREFIX + uuid.uuid4().hex
+        return lease if self.client.set(self.prefix + key, lease, ex=LEASE_TTL, nx=True) else None
+
+    def fill(self, key, lease, value):
+        """Set `key` to `value` if it still holds `lease`, in one script call. Returns whether it was set."""
+        if self._fill_script is None:
+            self._fill_script = self.client.register_script(FILL_SCRIPT)
+        return bool(int(self._fill_script(keys=[self.prefix + key],
+                                          args=[lease, json.dumps(value), max(1, int(self.ttl))])))
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        if hasattr(self.client, 'flushdb'):
+            self.client.flushdb()
+
+    def stats(self):
+        return dict(self.counters.as_dict(), type='shared')
+
+
+def init_cache(app):
+    """Create the lookup cache described by the app config.
+
+    CACHE_TYPE is one of 'lru' (default), 'shared' or 'null'. The shared cache
+    talks to CACHE_SHARED_CLIENT, falling back to an in-process stand-in.
+    """
+    cache_type = app.config.setdefault('CACHE_TYPE', 'lru')
+    ttl = app.config.setdefault('CACHE_TTL', 300)
+    max_entries = app.config.setdefault('CACHE_MAX_ENTRIES', 10000)
+    if cache_type == 'lru':
+        cache = LRUCache(max_entries=max_entries, ttl=ttl)
+    elif cache_type == 'shared':
+        client = app.config.get('CACHE_SHARED_CLIENT') or LocalSharedClient()
+        cache = SharedCache(client, ttl=ttl)
+    elif cache_type == 'null':
+        cache = NullCache()
+    else:
+        raise ValueError(f'Unknown CACHE_TYPE: {cache_type}')
+    app.extensions['cache'] = cache
+    return cache
+
+
+def get_cache():
+    """Return the cache of the current app, or a NullCache outside of one."""
+    if has_app_context():
+        cache = current_app.extensions.get('cache')
+        if cache is not None:
+            return cache
+    return NullCache()
+
+
+def cache_key(model, column, value):
+    return f'{model.__tablename__}:{column}:{value}'
+
+
+def _to_cache(obj):
+    # Without the __serializer_exclude__ columns: password hashes stay out of
+    # the cache, a cached row loads them from the database when read
+    return serialize(obj)
+
+
+def _session_instance(session, model, column, value):
+    # The row already loaded in `session`, whose state may be ahead of the cache
+    for state in session.identity_map.all_states():
+        if state.class_ is model and state.dict.get(column, MISSING) == value:
+            return state.obj()
+    return None
+
+
+def _from_cache(session, model, column, data):
+    mapper = model.__mapper__
+    identity = mapper.identity_key_from_primary_key([data[pk.key] for pk in mapper.primary_key])
+    existing = session.identity_map.get(identity)
+    if existing is not None:
+        # Never copy the cached values over the session's instance; None when
+        # a pending change moved it off the looked up value
+        return None if column in inspect(existing).dict else existing
+    obj = mapper.class_manager.new_instance()
+    for key, value in data.items():
+        set_committed_value(obj, key, value)
+    make_transient_to_detached(obj)
+    # load=False attaches the instance to the session without a SELECT
+    return session.merge(obj, load=False)
+
+
+def cached_lookup(model, column, value):
+    """Return the `model` row whose `column` equals `value`, going to the database on a miss.
+
+    `column` must be listed in the model's `__cache_keys__` so that writes to
+    the row invalidate the entry. A row already in the session is returned
+    as it is there, and rows the session wrote but has not committed are
+    read from the database, never from the cache. A miss leases the key
+    before querying and fills it only if the lease survived, so a write
+    committed during the query cannot leave the older row cached for a
+    whole TTL.
+    """
+    session = db.session
+    obj = _session_instance(session, model, column, value)
+    if obj is not None:
+        return obj
+    key = cache_key(model, column, value)
+    if key in session.info.get('stale_cache_keys', ()):
+        return model.query.filter_by(**{column: value}).first()
+    cache = get_cache()
+    data = cache.get(key)
+    if data is not MISSING:
+        obj = _from_cache(session, model, column, data)
+        if obj is not None:
+            return obj
+        return model.query.filter_by(**{column: value}).first()
+    # Leased before the query: a write committed meanwhile deletes the lease,
+    # so the row read, possibly older than the write, is not cached
+    lease = cache.lease(key)
+    obj = model.query.filter_by(**{column: value}).first()
+    # A lagging replica could put back a row the primary just invalidated
+    if obj is not None and lease is not None and not reading_from_replica():
+        cache.fill(key, lease, _to_cache(obj))
+    elif lease is not None:
+        cache.delete(key)
+    return obj
+
+
+async def cached_columns_async(session, model, column, value):
+    """Like cached_lookup(), but through an AsyncSession and returning the column values.
+
+    Returns a dict of the row's columns, or None, sharing cache entries with
+    cached_lookup().
+    """
+    cache = get_cache()
+    key = cache_key(model, column, value)
+    data = cache.get(key)
+    if data is not MISSING:
+        return data
+    lease = cache.lease(key)
+    obj = (await session.scalars(select(model).filter_by(**{column: value}).limit(1))).first()
+    if obj is None:
+        if lease is not None:
+            cache.delete(key)
+        return None
+    data = _to_cache(obj)
+    if lease is not None:
+        cache.fill(key, lease, data)
+    return data
+
+
+def invalidate_on_commit(session, model, column, values):
+    """Drop the cached lookups of rows written with Core statements once `session` commits.
+
+    Bulk statements bypass the ORM flush, so the keys they touch have to be
+    registered by hand.
+    """
+    stale = session.info.setdefault('stale_cache_keys', set())
+    stale.update(cache_key(model, column, value) for value in values)
+
+
+def _stale_keys(obj):
+    model = type(obj)
+    state = inspect(obj)
+    keys = set()
+    for column in model.__cache_keys__:
+        history = state.attrs[column].history
+        for value in (*history.added, *history.unchanged, *history.deleted):
+            if value is not None:
+                keys.add(cache_key(model, column, value))
+    return keys
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_stale_keys(session, flush_context):
+    stale = session.info.setdefault('stale_cache_keys', set())
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if hasattr(type(obj), '__cache_keys__'):
+            stale |= _stale_keys(obj)
+
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_rollback')
+def _invalidate_stale_keys(session):
+    stale = session.info.pop('stale_cache_keys', None)
+    if stale:
+        get_cache().delete(*stale)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# standard python imports
+
+import time
+import zlib
+
+from flask import current_app, request
+
+from app.util.cache import MISSING, LRUCache
+from app.util.metrics import record_timing
+
+try:
+    import brotli
+except ImportError:  # optional, only gzip and deflate are offered without it
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson', 'text/plain')
+# Headers rebuilt on every response, everything else is kept with cached bodies
+_UNCACHED_HEADERS = {'content-length', 'content-encoding', 'etag', 'last-modified', 'cache-control',
+                     'vary', 'server-timing'}
+
+
+class _ZlibCodec:
+    def __init__(self, wbits):
+        self.wbits = wbits
+
+    def compress(self, data, level):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, self.wbits)
+        return compressor.compress(data) + compressor.flush()
+
+    def stream(self, chunks, level):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, self.wbits)
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+
+class _BrotliCodec:
+    def compress(self, data, level):
+        # brotli qualities go up to 11, map the zlib 1-9 levels onto them
+        return brotli.compress(data, quality=min(11, level + 2))
+
+    def stream(self, chunks, level):
+        compressor = brotli.Compressor(quality=min(11, level + 2))
+        for chunk in chunks:
+            data = compressor.process(chunk)
+            if data:
+                yield data
+        yield compressor.finish()
+
+
+# In order of preference when the client accepts several equally
+CODECS = {'gzip': _ZlibCodec(31), 'deflate': _ZlibCodec(15)}
+if brotli is not None:
+    CODECS = {'br': _BrotliCodec(), **CODECS}
+
+
+def negotiate_encoding():
+    """Return the best encoding of CODECS the client accepts, or None."""
+    return request.accept_encodings.best_match(list(CODECS))
+
+
+def _compressible(response):
+    return (response.status_code == 200
+            and response.mimetype in current_app.config['COMPRESS_MIMETYPES'])
+
+
+def _weaken_etag(response):
+    # The compressed body is a different representation, the ETag can only
+    # claim semantic equivalence now; If-None-Match compares weakly anyway
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+
+
+def _set_encoding(response, encoding):
+    response.headers['Content-Encoding'] = encoding
+    response.headers.pop('Content-Length', None)
+    _weaken_etag(response)
+
+
+def _stream(response, codec, level):
+    chunks = response.response
+
+    def generate():
+        try:
+            for chunk in codec.stream((c.encode() if isinstance(c, str) else c for c in chunks), level):
+                yield chunk
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+    return generate()
+
+
+def cached_response(etag):
+    """Return a response built from compressed bytes cached for `etag`, or None.
+
+    Lets views tagged by ETag skip loading and serializing a payload that was
+    already compressed for another client.
+    """
+    cache = current_app.extensions.get('compression_cache')
+    encoding = negotiate_encoding()
+    if cache is None or encoding is None:
+        return None
+    entry = cache.get(f'{encoding}:{etag}')
+    if entry is MISSING:
+        return None
+    mimetype, headers, body = entry
+    response = current_app.response_class(body, mimetype=mimetype, headers=headers)
+    _set_encoding(response, encoding)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def compress_response(response):
+    """Compress a response body with the encoding negotiated with the client.
+
+    Bodies smaller than COMPRESS_MIN_SIZE are sent as they are, streamed
+    bodies are compressed chunk by chunk as they are produced, and compressed
+    bodies of responses with a strong ETag are kept for `cached_response`.
+    """
+    if not _compressible(response):
+        return response
+    response.vary.add('Accept-Encoding')
+    if 'Content-Encoding' in response.headers:
+        # e.g. from cached_response(), tagged again by the view decorator
+        _weaken_etag(response)
+        return response
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return response
+
+    codec = CODECS[encoding]
+    level = current_app.config['COMPRESS_LEVEL']
+    if response.is_streamed:
+        response.response = _stream(response, codec, level)
+        response.direct_passthrough = False
+        _set_encoding(response, encoding)
+        return response
+
+    data = response.get_data()
+    if len(data) < current_app.config['COMPRESS_MIN_SIZE']:
+        return response
+
+    start = time.perf_counter()
+    body = codec.compress(data, level)
+    record_timing('compress', time.perf_counter() - start)
+
+    etag, weak = response.get_etag()
+    cache = current_app.extensions.get('compression_cache')
+    if cache is not None and etag and not weak and len(body) <= current_app.config['COMPRESS_CACHE_MAX_SIZE']:
+        headers = [(key, value) for key, value in response.headers.items()
+                   if key.lower() not in _UNCACHED_HEADERS and key.lower() != 'content-type']
+        cache.set(f'{encoding}:{etag}', (response.mimetype, headers, body))
+
+    response.set_data(body)
+    _set_encoding(response, encoding)
+    return response
+
+
+def init_compression(app):
+    """Compress responses for clients that accept it, unless COMPRESS_ENABLED is False.
+
+    COMPRESS_CACHE_ENTRIES compressed bodies (0 disables the cache) are kept
+    in an LRU cache for COMPRESS_CACHE_TTL seconds.
+    """
+    app.config.setdefault('COMPRESS_ENABLED', True)
+    app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+    app.config.setdefault('COMPRESS_LEVEL', 6)
+    app.config.setdefault('COMPRESS_MIMETYPES', COMPRESSIBLE_MIMETYPES)
+    app.config.setdefault('COMPRESS_CACHE_ENTRIES', 256)
+    app.config.setdefault('COMPRESS_CACHE_TTL', 300.0)
+    app.config.setdefault('COMPRESS_CACHE_MAX_SIZE', 1024 * 1024)
+    if not app.config['COMPRESS_ENABLED']:
+        return
+    if app.config['COMPRESS_CACHE_ENTRIES']:
+        app.extensions['compression_cache'] = LRUCache(app.config['COMPRESS_CACHE_ENTRIES'],
+                                                       app.config['COMPRESS_CACHE_TTL'])
+    app.after_request(compress_response)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# standard python imports
+
+import hashlib
+from functools import wraps
+
+from flask import current_app, make_response, request
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from werkzeug.http import is_resource_modified
+
+from app.db import async_db
+from app.models.table_version import TableVersionModel
+from app.util.compression import cached_response
+from app.util.streaming import wants_stream
+
+
+# The tables some view is conditional() on; writes to other tables bump no counter
+_versioned_tables = set()
+
+
+def conditional(*tables):
+    """Answer conditional GETs of a view from the change counters of `tables`.
+
+    The ETag hashes the request path and query string with the versions of the
+    tables the response is built from, and Last-Modified is the latest of
+    their write times. Both are computed with a single primary key query
+    before the view runs, so a matching `If-None-Match` (or, without one,
+    `If-Modified-Since`) gets a 304 without loading or serializing any row,
+    and a body already compressed under the same ETag is sent as it is.
+    Disabled with `CONDITIONAL_GET = False`.
+    """
+    _versioned_tables.update(tables)
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not current_app.config.get('CONDITIONAL_GET', True):
+                return view(*args, **kwargs)
+
+            # Read the versions before the rows: a write in between makes the
+            # ETag older than the body, which only costs the client a refetch
+            etag, last_modified = _validators(tables, TableVersionModel.find_versions(tables))
+            response = _short_circuit(etag, last_modified)
+            if response is None:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            return _tag(response, etag, last_modified)
+        return wrapper
+    return decorator
+
+
+def conditional_async(*tables):
+    """conditional() for the async views of app/resources/aio.py."""
+    _versioned_tables.update(tables)
+
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(*args, **kwargs):
+            if not current_app.config.get('CONDITIONAL_GET', True):
+                return await view(*args, **kwargs)
+
+            rows = await async_db.session.execute(TableVersionModel.versions_of(tables))
+            etag, last_modified = _validators(tables, TableVersionModel.as_versions(tables, rows))
+            response = _short_circuit(etag, last_modified)
+            if response is None:
+                response = make_response(await view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            return _tag(response, etag, last_modified)
+        return wrapper
+    return decorator
+
+
+def _validators(tables, versions):
+    key = '|'.join([request.full_path, str(wants_stream()),
+                    *(f'{name}:{versions[name][0]}' for name in tables)])
+    modified = [updated_at for _, updated_at in versions.values() if updated_at is not None]
+    return hashlib.sha1(key.encode()).hexdigest(), max(modified) if modified else None
+
+
+def _short_circuit(etag, last_modified):
+    # A 304, or a body compressed earlier under the same ETag, or None
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return current_app.response_class(status=304)
+    return cached_response(etag)
+
+
+def _tag(response, etag, last_modified):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    response.vary.add('Accept')
+    if current_app.config.get('COMPRESS_ENABLED'):
+        # The encoding varies too, and a 304 has to say so as the 200 would
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+def _versioned_table(table):
+    return table is not None and table.name in _versioned_tables
+
+
+def _note_written(session, names):
+    session.info.setdefault('written_tables', set()).update(names)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_flushed_tables(session, flush_context):
+    _note_written(session, {
+        type(obj).__table__.name for obj in (*session.new, *session.deleted, *session.dirty)
+        if _versioned_table(getattr(type(obj), '__table__', None))
+        and (obj not in session.dirty or session.is_modified(obj))})
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _collect_statement_table(orm_execute_state):
+    # INSERT/UPDATE/DELETE statements run with session.execute() skip the flush
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        table = getattr(orm_execute_state.statement, 'table', None)
+        if _versioned_table(table):
+            _note_written(orm_execute_state.session, {table.name})
+
+
+@event.listens_for(Session, 'before_commit')
+def _bump_written_tables(session):
+    # Bumped last, so the counter rows are locked only while the commit runs.
+    # The commit's own flush comes after this event, so it is done here first.
+    # Released savepoints fire this too; their tables wait for the outer commit.
+    if session.in_nested_transaction():
+        return
+    if session.new or session.deleted or session.dirty:
+        session.flush()
+    names = session.info.pop('written_tables', None)
+    if names:
+        TableVersionModel.bump(session.connection(), names)
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _forget_written_tables(session, transaction):
+    # Only the outermost transaction: a rolled back savepoint keeps the
+    # tables written before it, which are bumped all the same
+    if transaction.parent is None:
+        session.info.pop('written_tables', None)
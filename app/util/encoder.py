@@ -3,26 +3,36 @@
 # standard python imports
 
 import json
+from functools import lru_cache
 
-from sqlalchemy.ext.declarative import DeclarativeMeta
+from sqlalchemy import inspect
+
+
+@lru_cache(maxsize=None)
+def model_columns(model):
+    """Return the column attribute names of `model`, introspected once per class.
+
+    Names listed in the model's `__serializer_exclude__` (e.g. password) are
+    left out.
+    """
+    exclude = set(getattr(model, '__serializer_exclude__', ()))
+    return tuple(attr.key for attr in inspect(model).column_attrs if attr.key not in exclude)
+
+
+def is_model(obj):
+    return hasattr(type(obj), '__mapper__')
+
+
+def serialize(obj):
+    """Return the column values of a model instance as a dict."""
+    return {key: getattr(obj, key) for key in model_columns(type(obj))}
 
 
 class AlchemyEncoder(json.JSONEncoder):
 
     def default(self, obj):
-        if isinstance(obj.__class__, DeclarativeMeta):
+        if is_model(obj):
             # an SQLAlchemy class
-            fields = {}
-            for field in [x for x in dir(obj) if
-                          not x.startswith('_') and x != 'metadata']:
-                data = obj.__getattribute__(field)
-                try:
-                    json.dumps(
-                        data)  # this will fail on non-encodable values, like other classes
-                    fields[field] = data
-                except TypeError:
-                    fields[field] = None
-            # a json-encodable dict
-            return fields
+            return serialize(obj)
 
         return json.JSONEncoder.default(self, obj)
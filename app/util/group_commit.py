@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# standard python imports
+
+import threading
+import time
+
+PENDING, LEADING, DONE = 'pending', 'leading', 'done'
+
+
+class _Write:
+    __slots__ = ('payload', 'state', 'result', 'error')
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.state = PENDING
+        self.result = None
+        self.error = None
+
+
+class GroupCommitter:
+    """Writes the payloads of concurrent requests together, one transaction per group.
+
+    The first request to submit leads: it waits up to `window` seconds for
+    others to join, at most `max_batch` in all, runs `write_batch(payloads)`,
+    which returns one result per payload, and hands each waiting request its
+    result. Writes arriving meanwhile gather behind the next leader. When a
+    batch fails, every payload of it is retried alone with `write_one`, so a
+    bad row only fails its own request; `write_one` must leave the session
+    usable when it raises.
+    """
+
+    def __init__(self, write_batch, write_one, window=0.002, max_batch=256):
+        self.write_batch = write_batch
+        self.write_one = write_one
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = 0
+        self.writes = 0
+        self._changed = threading.Condition()
+        self._pending = []
+        self._leading = False
+
+    def submit(self, payload):
+        """Write `payload` with the current group and return its result, or raise its error."""
+        write = _Write(payload)
+        with self._changed:
+            self._pending.append(write)
+            if not self._leading:
+                self._leading = True
+                write.state = LEADING
+            elif len(self._pending) >= self.max_batch:
+                self._changed.notify_all()
+            while write.state == PENDING:
+                self._changed.wait()
+            batch = self._take_batch() if write.state == LEADING else None
+        if batch is not None:
+            self._run(batch)
+        if write.error is not None:
+            raise write.error
+        return write.result
+
+    def _take_batch(self):
+        # Called by the leader, holding the lock
+        deadline = time.monotonic() + self.window
+        while len(self._pending) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self._changed.wait(remaining)
+        batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+        if self._pending:
+            self._pending[0].state = LEADING
+            self._changed.notify_all()
+        else:
+            self._leading = False
+        return batch
+
+    def _run(self, batch):
+        payloads = [write.payload for write in batch]
+        try:
+            outcomes = [(result, None) for result in self.write_batch(payloads)]
+        except Exception:
+            outcomes = []
+            for payload in payloads:
+                try:
+                    outcomes.append((self.write_one(payload), None))
+                except Exception as e:
+                    outcomes.append((None, e))
+        with self._changed:
+            for write, (result, error) in zip(batch, outcomes):
+                write.result, write.error, write.state = result, error, DONE
+            self.batches += 1
+            self.writes += len(batch)
+            self._changed.notify_all()
+
+
+def init_group_commit(app):
+    """Group concurrent PUT /item/<name> writes into shared transactions.
+
+    Off unless GROUP_COMMIT_WINDOW_MS is set: the time the first write of a
+    group waits for others, at most GROUP_COMMIT_MAX_BATCH per group. Each
+    write then costs one commit per group instead of one per request.
+    """
+    app.config.setdefault('GROUP_COMMIT_WINDOW_MS', 0)
+    app.config.setdefault('GROUP_COMMIT_MAX_BATCH', 256)
+    if not app.config['GROUP_COMMIT_WINDOW_MS']:
+        return None
+    from app.db import unit_of_work
+    from app.models.item import ItemModel
+
+    def write_one(row):
+        # A transaction per row, rolled back when it fails, so the rows after it do not
+        # run in a failed transaction of the same session
+        with unit_of_work():
+            return ItemModel.upsert(**row)
+
+    committer = GroupCommitter(ItemModel.upsert_batch, write_one,
+                               app.config['GROUP_COMMIT_WINDOW_MS'] / 1000, app.config['GROUP_COMMIT_MAX_BATCH'])
+    app.extensions['item_group_commit'] = committer
+    return committer
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# standard python imports
+
+import hashlib
+from functools import wraps
+
+from flask import current_app, jsonify, request
+
+from app.auth import request_identity
+from app.util.cache import MISSING, LocalSharedClient, LRUCache, SharedCache
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+# Response headers worth replaying, the rest are rebuilt by the app
+REPLAYED_HEADERS = ('Location', 'Retry-After')
+
+
+def _store_key(key):
+    # Keys are scoped to the client and the route, so they cannot collide or leak
+    scope = '\n'.join((request_identity(), request.method, request.path, key))
+    return 'idempotency:' + hashlib.sha256(scope.encode()).hexdigest()
+
+
+def _replay(saved):
+    response = current_app.response_class(saved['body'], status=saved['status'], mimetype=saved['mimetype'])
+    response.headers.extend([tuple(header) for header in saved['headers']])
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(view):
+    """Replay the stored response when a request repeats an `Idempotency-Key` header.
+
+    The first request with a key runs the view and its response is kept for
+    IDEMPOTENCY_TTL seconds; retries with the same key and body get that
+    response back without running the view. A retry arriving while the first
+    request still runs gets 409, and reusing a key with another body 422.
+    Responses with a 5xx status are not kept, so those can be retried. The
+    claim of a running request only lasts IDEMPOTENCY_CLAIM_TTL seconds, so
+    a worker dying mid-request does not block its key for a whole TTL.
+    """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(HEADER)
+        store = current_app.extensions.get('idempotency')
+        if key is None or store is None:
+            return view(*args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            return jsonify({'message': f'{HEADER} must be 1 to {MAX_KEY_LENGTH} characters'}), 400
+
+        store_key = _store_key(key)
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+        # Claim the key atomically, so concurrent retries cannot both run the view
+        if not store.add(store_key, {'fingerprint': fingerprint}, ttl=current_app.config['IDEMPOTENCY_CLAIM_TTL']):
+            saved = store.get(store_key)
+            if saved is not MISSING and saved['fingerprint'] != fingerprint:
+                return jsonify({'message': f'{HEADER} was already used with another request body'}), 422
+            if saved is MISSING or 'status' not in saved:
+                return (jsonify({'message': f'A request with this {HEADER} is in progress'}), 409,
+                        {'Retry-After': '1'})
+            return _replay(saved)
+
+        try:
+            response = current_app.make_response(view(*args, **kwargs))
+        except BaseException:
+            store.delete(store_key)
+            raise
+        if response.status_code >= 500 or response.is_streamed:
+            store.delete(store_key)
+        else:
+            store.set(store_key, {
+                'fingerprint': fingerprint,
+                'status': response.status_code,
+                'mimetype': response.mimetype,
+                'headers': [(name, value) for name, value in response.headers if name in REPLAYED_HEADERS],
+                'body': response.get_data(as_text=True),
+            })
+        return response
+
+    return wrapper
+
+
+def init_idempotency(app):
+    """Keep the responses of requests sent with an Idempotency-Key header.
+
+    IDEMPOTENCY_STORAGE is 'memory' (per process, at most
+    IDEMPOTENCY_MAX_ENTRIES responses) or 'shared', which talks to
+    IDEMPOTENCY_SHARED_CLIENT so a retry may reach any worker. Set it to
+    None to ignore the header.
+    """
+    app.config.setdefault('IDEMPOTENCY_STORAGE', 'memory')
+    app.config.setdefault('IDEMPOTENCY_TTL', 86400)
+    app.config.setdefault('IDEMPOTENCY_CLAIM_TTL', 30)
+    app.config.setdefault('IDEMPOTENCY_MAX_ENTRIES', 10000)
+    storage = app.config['IDEMPOTENCY_STORAGE']
+    if storage is None:
+        return None
+    if storage == 'memory':
+        store = LRUCache(max_entries=app.config['IDEMPOTENCY_MAX_ENTRIES'], ttl=app.config['IDEMPOTENCY_TTL'])
+    elif storage == 'shared':
+        client = app.config.get('IDEMPOTENCY_SHARED_CLIENT') or LocalSharedClient()
+        store = SharedCache(client, ttl=app.config['IDEMPOTENCY_TTL'])
+    else:
+        raise ValueError(f'Unknown IDEMPOTENCY_STORAGE: {storage}')
+    app.extensions['idempotency'] = store
+    return store
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# standard python imports
+
+import json
+import math
+import time
+from json.encoder import encode_basestring_ascii
+
+from flask import current_app
+from flask.json.provider import DefaultJSONProvider
+
+from app.util.metrics import record_timing
+
+try:
+    import orjson
+except ImportError:  # optional, the stdlib json module is used without it
+    orjson = None
+
+_ORJSON_KWARGS = {'default', 'ensure_ascii', 'sort_keys', 'indent', 'separators'}
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """JSON provider that serializes with orjson when it is installed.
+
+    Output matches the default provider (sorted keys, compact separators out
+    of debug mode) except that non-ASCII characters are written as UTF-8
+    instead of escape sequences. Calls with options orjson does not have, and
+    values it cannot encode, go through the stdlib implementation.
+    """
+
+    def dumps(self, obj, **kwargs):
+        if orjson is not None and kwargs.keys() <= _ORJSON_KWARGS:
+            # dates go through `default` to keep the HTTP date format of Flask
+            option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+            if kwargs.get('sort_keys', self.sort_keys):
+                option |= orjson.OPT_SORT_KEYS
+            if kwargs.get('indent'):
+                option |= orjson.OPT_INDENT_2
+            try:
+                return orjson.dumps(obj, default=kwargs.get('default', self.default), option=option).decode()
+            except (orjson.JSONEncodeError, TypeError):
+                pass
+        return super().dumps(obj, **kwargs)
+
+    def response(self, *args, **kwargs):
+        start = time.perf_counter()
+        response = super().response(*args, **kwargs)
+        record_timing('serialize', time.perf_counter() - start)
+        return response
+
+    def loads(self, s, **kwargs):
+        if orjson is not None and not kwargs:
+            try:
+                return orjson.loads(s)
+            except orjson.JSONDecodeError:
+                pass
+        return super().loads(s, **kwargs)
+
+
+def encode_value(value):
+    if value is None:
+        return 'null'
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+    value_type = type(value)
+    if value_type is str:
+        return encode_basestring_ascii(value)
+    if value_type is int:
+        return int.__repr__(value)
+    if value_type is float and math.isfinite(value):
+        return float.__repr__(value)
+    return json.dumps(value)
+
+
+class RowEncoder:
+    """Encode result rows (tuples of column values) straight into JSON objects.
+
+    The object template is built once from `keys`; encoding a row then only
+    formats its values, without building an intermediate dict. The first `len(keys)` values of each row are used, so
+    rows may carry extra columns (e.g. the pagination key) that are not written.
+    """
+
+    def __init__(self, keys):
+        self.keys = tuple(keys)
+        template = '{' + ','.join(f"{encode_basestring_ascii(key).replace('%', '%%')}:%s"
+                                  for key in self.keys) + '}'
+        n = len(self.keys)
+        self.encode = lambda row: template % tuple(map(encode_value, row[:n]))
+
+    def encode_one(self, row):
+        """encode() a single row, timed as serialization like encode_many()."""
+        start = time.perf_counter()
+        text = self.encode(row)
+        record_timing('serialize', time.perf_counter() - start)
+        return text
+
+    def encode_many(self, rows):
+        start = time.perf_counter()
+        text = '[' + ','.join(map(self.encode, rows)) + ']'
+        record_timing('serialize', time.perf_counter() - start)
+        return text
+
+
+def encode_document(fields):
+    """Join (key, already encoded JSON) pairs into a JSON object."""
+    return '{' + ','.join(f'{encode_basestring_ascii(key)}:{value}' for key, value in fields) + '}'
+
+
+def raw_json_response(text, status=200, headers=None):
+    """Return already encoded JSON text as a response, like jsonify() would."""
+    response = current_app.response_class(f'{text}\n', status=status, mimetype='application/json')
+    response.headers.update(headers or {})
+    return response
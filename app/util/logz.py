@@ -2,19 +2,173 @@
 # -*- coding: utf-8 -*-
 # standard python imports
 
+import atexit
+import json
 import logging
-from rich.console import Console
-from rich.logging import RichHandler
-from rich.traceback import install
 import os
-install()
+import queue
+import random
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+LOGGER_NAME = 'rich'
+
+_configured = False
+_configure_lock = threading.Lock()
+_listener = None
+
+# Attributes every LogRecord has; anything else was passed through `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line, including `extra` fields."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keep only a fraction of the records below WARNING, per logger name.
+
+    `rates` maps logger names to the fraction of records kept; a logger uses
+    the rate of its closest configured ancestor and is not sampled without one.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def rate_for(self, name):
+        while name:
+            if name in self.rates:
+                return self.rates[name]
+            name = name.rpartition('.')[0]
+        return self.rates.get('', 1.0)
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rate_for(record.name)
+        return rate >= 1.0 or random.random() < rate
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Queue records without formatting them on the calling thread.
+
+    The stock QueueHandler merges the message and its arguments before
+    queueing; here that is left to the listener thread, so logging from a
+    request costs little more than a queue put. Arguments must therefore not
+    be mutated after the logging call. Records are dropped (and counted) when
+    the queue is full rather than blocking the request.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def parse_sample_rates(value):
+    """Parse 'name=rate,other.name=rate' into a dict."""
+    rates = {}
+    for item in filter(None, (part.strip() for part in (value or '').split(','))):
+        name, _, rate = item.partition('=')
+        rates[name.strip()] = float(rate)
+    return rates
+
+
+def _output_handler(log_format):
+    if log_format == 'json':
+        handler = logging.StreamHandler()
+        handler.setFormatter(JsonFormatter())
+        return handler
+    from rich.logging import RichHandler
+    from rich.traceback import install
+
+    install()
+    handler = RichHandler(rich_tracebacks=True, markup=True)
+    handler.setFormatter(logging.Formatter('%(message)s', datefmt="[%Y/%m/%d %H:%M;%S]"))
+    return handler
+
+
+def configure_logging(mode=None, log_format=None, sample_rates=None, queue_size=None, force=False):
+    """Set up the root logger, once per process unless `force` is given.
+
+    mode        'console' (default) writes on the logging thread, 'queue' hands
+                records to a background listener (LOG_MODE)
+    log_format  'rich' (default) or 'json' (LOG_FORMAT)
+    sample_rates fraction of sub-WARNING records kept per logger, as a dict
+                or 'name=rate,...' (LOG_SAMPLE_RATES)
+    queue_size  records buffered in queue mode before dropping (LOG_QUEUE_SIZE)
+    """
+    global _configured, _listener
+    with _configure_lock:
+        if _configured and not force:
+            return
+        _stop_listener()
+
+        mode = mode or os.environ.get('LOG_MODE', 'console')
+        log_format = log_format or os.environ.get('LOG_FORMAT', 'rich')
+        if sample_rates is None:
+            sample_rates = os.environ.get('LOG_SAMPLE_RATES')
+        if isinstance(sample_rates, str):
+            sample_rates = parse_sample_rates(sample_rates)
+        queue_size = queue_size or int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+        loglevel = os.environ.get('LOGLEVEL', 'INFO').upper()
+
+        output = _output_handler(log_format)
+        if mode == 'queue':
+            handler = DeferredQueueHandler(queue.Queue(queue_size))
+            _listener = QueueListener(handler.queue, output, respect_handler_level=True)
+            _listener.start()
+        elif mode == 'console':
+            handler = output
+        else:
+            raise ValueError(f'Unknown LOG_MODE: {mode}')
+        if sample_rates:
+            handler.addFilter(SamplingFilter(sample_rates))
+
+        logging.basicConfig(level=loglevel, handlers=[handler], force=force)
+        _configured = True
+
+
+def _stop_listener():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(_stop_listener)
+
+
+def get_logger():
+    """Return the application logger without configuring logging."""
+    return logging.getLogger(LOGGER_NAME)
 
 
 def create_logger():
     """Create a logger for use in all cases."""
-    loglevel = os.environ.get('LOGLEVEL', 'INFO').upper()
-    rich_handler = RichHandler(rich_tracebacks=True, markup=True)
-    logging.basicConfig(level=loglevel, format='%(message)s',
-                        datefmt="[%Y/%m/%d %H:%M;%S]",
-                        handlers=[rich_handler])
-    return logging.getLogger('rich')
+    configure_logging()
+    return get_logger()
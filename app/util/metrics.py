@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# standard python imports
+
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from functools import wraps
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    """Cumulative histogram in the Prometheus format."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip((*self.buckets, '+Inf'), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+def _labels(**labels):
+    return ','.join(f'{key}="{str(value)}"' for key, value in labels.items())
+
+
+class Metrics:
+    """Per-route request latency, query and serialization measurements."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.queries = defaultdict(lambda: Histogram(QUERY_COUNT_BUCKETS))
+        self.db_time = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.serialization = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+
+    def observe(self, endpoint, method, status, duration, queries, db_time, serialization):
+        route = (endpoint, method)
+        with self._lock:
+            self.latency[(endpoint, method, status)].observe(duration)
+            self.queries[route].observe(queries)
+            self.db_time[route].observe(db_time)
+            self.serialization[route].observe(serialization)
+
+    def render(self):
+        """Return all measurements in the Prometheus text exposition format."""
+        families = (
+            ('http_request_duration_seconds', 'Request latency by route and status.', self.latency,
+             ('endpoint', 'method', 'status')),
+            ('http_request_db_queries', 'SQL statements executed per request.', self.queries,
+             ('endpoint', 'method')),
+            ('http_request_db_duration_seconds', 'Time spent executing SQL per request.', self.db_time,
+             ('endpoint', 'method')),
+            ('http_request_serialization_seconds', 'Time spent encoding JSON per request.', self.serialization,
+             ('endpoint', 'method')),
+        )
+        lines = []
+        with self._lock:
+            for name, help_text, histograms, label_names in families:
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} histogram')
+                for key, histogram in sorted(histograms.items()):
+                    lines.extend(histogram.render(name, _labels(**dict(zip(label_names, key)))))
+        return lines
+
+
+def _render_gauges(name, help_text, metric_type, samples):
+    lines = [f'# HELP {name} {help_text}', f'# TYPE {name} {metric_type}']
+    lines.extend(f'{name}{{{labels}}} {value}' if labels else f'{name} {value}' for labels, value in samples)
+    return lines
+
+
+def render_metrics(app):
+    """Render request metrics plus lookup cache, rate limiter, group commit, replica and connection pool state."""
+    from app.db import db, pool_stats
+
+    lines = app.extensions['metrics'].render()
+
+    cache = app.extensions.get('cache')
+    if cache is not None:
+        stats = cache.stats()
+        namespaces = stats['namespaces'].items()
+        lines += _render_gauges('cache_hits_total', 'Lookup cache hits.', 'counter',
+                                [(_labels(namespace=ns), counts['hits']) for ns, counts in namespaces])
+        lines += _render_gauges('cache_misses_total', 'Lookup cache misses.', 'counter',
+                                [(_labels(namespace=ns), counts['misses']) for ns, counts in namespaces])
+        if 'size' in stats:
+            lines += _render_gauges('cache_entries', 'Entries in the lookup cache.', 'gauge', [('', stats['size'])])
+
+    limiter = app.extensions.get('rate_limiter')
+    if limiter is not None:
+        lines += _render_gauges('ratelimit_rejected_total', 'Requests rejected by the rate limiter.', 'counter',
+                                [(_labels(endpoint=endpoint), count) for endpoint, count in sorted(limiter.rejected.items())])
+
+    committer = app.extensions.get('item_group_commit')
+    if committer is not None:
+        lines += _render_gauges('group_commit_batches_total', 'Transactions written by the group committer.',
+                                'counter', [('', committer.batches)])
+        lines += _render_gauges('group_commit_writes_total', 'Writes grouped into those transactions.',
+                                'counter', [('', committer.writes)])
+
+    replicas = app.extensions.get('replicas')
+    if replicas is not None:
+        lines += _render_gauges('db_replica_up', 'Whether the replica is in use, 0 while it is skipped after errors.',
+                                'gauge', [(_labels(bind=key), int(replicas.healthy(key))) for key in replicas.keys])
+
+    for bind, engine in db.engines.items():
+        stats = pool_stats(engine)
+        labels = _labels(bind=bind or 'default')
+        for key in ('size', 'checkedin', 'checkedout', 'overflow'):
+            if key in stats:
+                lines += _render_gauges(f'db_pool_{key}', f'Connection pool {key}.', 'gauge', [(labels, stats[key])])
+        for key in ('connects', 'checkouts', 'invalidations'):
+            lines += _render_gauges(f'db_pool_{key}_total', f'Connection pool {key}.', 'counter',
+                                    [(labels, stats[key])])
+    return '\n'.join(lines) + '\n'
+
+
+def record_timing(name, seconds):
+    """Add `seconds` to the `name` timer of the current request, if it is instrumented."""
+    if has_request_context():
+        timings = g.get('_metrics')
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + seconds
+
+
+def timed(name):
+    """Decorator adding the run time of each call to the `name` timer of the request (see record_timing)."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record_timing(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('_query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('_query_start')
+    if starts:
+        elapsed = time.perf_counter() - starts.pop()
+        record_timing('db', elapsed)
+        record_timing('queries', 1)
+
+
+def _handle_error(exception_context):
+    connection = exception_context.connection
+    if connection is not None and connection.info.get('_query_start'):
+        connection.info['_query_start'].pop()
+
+
+def _start_timer():
+    g._metrics = {'start': time.perf_counter(), 'db': 0.0, 'queries': 0, 'serialize': 0.0}
+
+
+def _finish_timer(response):
+    timings = g.get('_metrics')
+    if timings is None:
+        return response
+    duration = time.perf_counter() - timings['start']
+    metrics = current_app.extensions['metrics']
+    route = (request.endpoint or 'unmatched', request.method, response.status_code)
+    if response.is_streamed:
+        # Rows are queried and encoded while the body streams, with the
+        # request context kept: observed once the body has been sent
+        def observe():
+            metrics.observe(*route, time.perf_counter() - timings['start'], timings['queries'],
+                            timings['db'], timings['serialize'])
+        response.call_on_close(observe)
+    else:
+        g.pop('_metrics')
+        metrics.observe(*route, duration, timings['queries'], timings['db'], timings['serialize'])
+    if current_app.config.get('METRICS_SERVER_TIMING', True):
+        entries = [f'db;dur={timings["db"] * 1000:.3f};desc="{timings["queries"]} queries"',
+                   f'ser;dur={timings["serialize"] * 1000:.3f}']
+        if 'compress' in timings:
+            entries.append(f'cmp;dur={timings["compress"] * 1000:.3f}')
+        entries.append(f'app;dur={duration * 1000:.3f}')
+        response.headers.add('Server-Timing', ', '.join(entries))
+    return response
+
+
+def init_metrics(app):
+    """Instrument requests and SQL execution when METRICS_ENABLED is set.
+
+    Latency, query count/time and serialization time are recorded per route,
+    sent back in a Server-Timing header and served on /metrics.
+    """
+    if not app.config.get('METRICS_ENABLED'):
+        return
+    from app.db import db
+
+    app.extensions['metrics'] = Metrics()
+    with app.app_context():
+        for engine in db.engines.values():
+            if not event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+                event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+                event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+                event.listen(engine, 'handle_error', _handle_error)
+    app.before_request(_start_timer)
+    app.after_request(_finish_timer)
+
+    def metrics_view():
+        return current_app.response_class(render_metrics(current_app), mimetype='text/plain; version=0.0.4')
+
+    app.add_url_rule(app.config.get('METRICS_PATH', '/metrics'), 'metrics', metrics_view)
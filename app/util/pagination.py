@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# standard python imports
+
+from flask import request, url_for
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+class PaginationError(ValueError):
+    """Raised when the paging, filter or field query parameters are invalid."""
+
+
+def _parse(name, convert):
+    value = request.args.get(name)
+    if value is None or value == '':
+        return None
+    try:
+        return convert(value)
+    except (ValueError, TypeError):
+        raise PaginationError(f"Invalid value for '{name}'")
+
+
+def parse_page_args():
+    """Read `limit` and `after` from the query string."""
+    limit = _parse('limit', int)
+    after = _parse('after', int)
+    if limit is None:
+        limit = DEFAULT_PAGE_SIZE
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise PaginationError(f"'limit' must be between 1 and {MAX_PAGE_SIZE}")
+    return limit, after
+
+
+def parse_filter(name, convert=str):
+    """Read an optional filter value from the query string."""
+    return _parse(name, convert)
+
+
+def _split_list(value):
+    return [part.strip() for part in value.split(',') if part.strip()]
+
+
+def parse_fields(allowed, relations=None):
+    """Read the sparse fieldset of `fields` and `include` from the query string.
+
+    `allowed` lists the fields of the resource in the order they are written
+    and `relations` maps the embedded lists among them to their own fields,
+    e.g. {'items': ItemModel.FIELDS}. `?fields=name,items.price` picks fields,
+    `relation.field` narrowing an embedded list, and `?include=items` adds a
+    whole relation. Without `fields` every allowed field is returned.
+
+    Returns the fields in `allowed` order and a dict of the fields of each
+    relation returned.
+    """
+    relations = relations or {}
+    requested = _parse('fields', _split_list)
+    included = _parse('include', _split_list) or ()
+    if requested is None:
+        fields = set(allowed)
+        nested = {name: set(relations[name]) for name in relations if name in fields}
+    else:
+        fields, nested = set(), {}
+        for field in requested:
+            name, _, sub = field.partition('.')
+            if name not in allowed or (sub and sub not in relations.get(name, ())):
+                raise PaginationError(f"Unknown field '{field}', expected some of: {', '.join(allowed)}")
+            fields.add(name)
+            if name in relations:
+                nested.setdefault(name, set()).update([sub] if sub else relations[name])
+    for name in included:
+        if name not in relations:
+            raise PaginationError(f"Unknown include '{name}', expected some of: {', '.join(relations) or 'none'}")
+        fields.add(name)
+        nested[name] = set(relations[name])
+    if not fields:
+        raise PaginationError("'fields' must name at least one field")
+    return (tuple(field for field in allowed if field in fields),
+            {name: tuple(field for field in relations[name] if field in sub) for name, sub in nested.items()})
+
+
+def keyset_page(query, key, limit, after):
+    """Fetch one page of `query` ordered by the primary key column `key`.
+
+    Rows are selected with `key > after` instead of an OFFSET, so the cost of
+    a page does not depend on how deep into the table it is. One extra row is
+    fetched to know whether a next page exists.
+
+    Returns the rows of the page and the cursor of the next page (or None).
+    """
+    return split_page(keyset_query(query, key, limit, after).all(), key, limit)
+
+
+def keyset_query(query, key, limit, after):
+    """Restrict a Query or select() to the rows keyset_page() fetches."""
+    if after is not None:
+        query = query.filter(key > after)
+    return query.order_by(key).limit(limit + 1)
+
+
+def split_page(rows, key, limit):
+    """Split the rows of keyset_query() into the page and the next cursor (or None)."""
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, getattr(rows[-1], key.key)
+    return rows, None
+
+
+def page_links(next_cursor):
+    """Return the URL of the next page (or None) and the matching Link header."""
+    if next_cursor is None:
+        return None, {}
+    args = request.args.to_dict()
+    args['after'] = next_cursor
+    next_url = url_for(request.endpoint, **args)
+    return next_url, {'Link': f'<{next_url}>; rel="next"'}
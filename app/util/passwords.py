@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# standard python imports
+
+import hmac
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from flask import current_app, has_app_context
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# werkzeug's method string: scrypt:n:r:p or pbkdf2:hash:iterations
+DEFAULT_HASH_METHOD = 'scrypt:32768:8:1'
+HASH_PREFIXES = ('scrypt:', 'pbkdf2:')
+
+
+class PasswordWorkersBusy(Exception):
+    """Raised when every password worker is busy and the wait queue is full."""
+
+
+def hash_method():
+    if has_app_context():
+        return current_app.config.get('PASSWORD_HASH_METHOD', DEFAULT_HASH_METHOD)
+    return DEFAULT_HASH_METHOD
+
+
+@lru_cache(maxsize=16)
+def _full_method(method):
+    # werkzeug fills in the default parameters ('scrypt' -> 'scrypt:32768:8:1')
+    return generate_password_hash('', method, salt_length=1).split('$', 1)[0]
+
+
+@lru_cache(maxsize=16)
+def dummy_hash(method):
+    """A hash to verify against for unknown users, so they take as long to reject."""
+    return generate_password_hash('', method)
+
+
+def is_hashed(stored):
+    return stored.startswith(HASH_PREFIXES) and stored.count('$') == 2
+
+
+def hash_password(password, method=None):
+    """Return a salted hash of `password` with PASSWORD_HASH_METHOD, or `method`."""
+    return generate_password_hash(password, method or hash_method())
+
+
+def verify_password(stored, password):
+    """Check `password` against a stored hash, or a legacy plaintext password."""
+    if is_hashed(stored):
+        return check_password_hash(stored, password)
+    return hmac.compare_digest(stored.encode(), password.encode())
+
+
+def needs_rehash(stored, method=None):
+    """Return True when `stored` is plaintext or was hashed with other parameters."""
+    return not is_hashed(stored) or stored.split('$', 1)[0] != _full_method(method or hash_method())
+
+
+class PasswordWorkers:
+    """A bounded thread pool for password hashing and verification.
+
+    At most `workers` hashes run at once, whatever the number of request
+    threads, and at most `queue_size` more wait for a worker. Further calls
+    fail right away with PasswordWorkersBusy, so a burst of logins is shed
+    instead of taking the CPU from every other route.
+    """
+
+    def __init__(self, workers, queue_size, timeout=None):
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='password')
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+
+    def run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise PasswordWorkersBusy()
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future.result(self.timeout)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def run_password_task(fn, *args):
+    """Run `fn` on the app's password workers when PASSWORD_WORKERS is set, inline otherwise."""
+    workers = current_app.extensions.get('password_workers') if has_app_context() else None
+    if workers is None:
+        return fn(*args)
+    return workers.run(fn, *args)
+
+
+def init_passwords(app):
+    """Start PASSWORD_WORKERS threads (0 hashes on the request thread) for hashing.
+
+    PASSWORD_QUEUE_SIZE calls may wait for a worker before logins and
+    registrations are answered with 503.
+    """
+    app.config.setdefault('PASSWORD_HASH_METHOD', DEFAULT_HASH_METHOD)
+    app.config.setdefault('PASSWORD_WORKERS', 0)
+    app.config.setdefault('PASSWORD_QUEUE_SIZE', 16)
+    if app.config['PASSWORD_WORKERS']:
+        app.extensions['password_workers'] = PasswordWorkers(app.config['PASSWORD_WORKERS'],
+                                                             app.config['PASSWORD_QUEUE_SIZE'])
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# standard python imports
+
+import math
+import re
+import threading
+import time
+from collections import Counter, OrderedDict, namedtuple
+
+from flask import current_app, jsonify, request
+
+from app.auth import request_identity
+from app.util.cache import LocalSharedClient
+
+_PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+_LIMIT_RE = re.compile(r'^\s*(\d+)\s*/\s*(\d*)\s*(second|minute|hour|day)s?\s*(?:burst\s*=?\s*(\d+))?\s*$')
+
+
+class Limit(namedtuple('Limit', 'rate burst')):
+    """`rate` requests per second on average, up to `burst` at once."""
+
+    @property
+    def interval(self):
+        return 1 / self.rate
+
+
+def parse_limit(value):
+    """Parse '5/minute', '100/second burst 200' or '10/30seconds' into a Limit.
+
+    The burst defaults to the number of requests of the period.
+    """
+    match = _LIMIT_RE.match(value)
+    if not match:
+        raise ValueError(f"Invalid rate limit '{value}', expected e.g. '5/minute' or '100/second burst 200'")
+    count, multiple, period, burst = match.groups()
+    seconds = int(multiple or 1) * _PERIODS[period]
+    return Limit(int(count) / seconds, int(burst or count))
+
+
+def _gcra(tat, now, limit, cost):
+    """One step of the generic cell rate algorithm, a token bucket kept as a single timestamp.
+
+    `tat` is the theoretical arrival time of the next request with an empty
+    bucket. Returns (allowed, new tat, seconds until allowed).
+    """
+    tat = max(tat or now, now)
+    new_tat = tat + limit.interval * cost
+    allow_at = new_tat - limit.interval * limit.burst
+    if allow_at > now:
+        return False, tat, allow_at - now
+    return True, new_tat, 0.0
+
+
+class MemoryBucketStore:
+    """Token buckets of this process, at most `max_keys` of them (least recently used are dropped)."""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._tats = OrderedDict()
+
+    def take(self, key, limit, cost=1):
+        now = time.monotonic()
+        with self._lock:
+            allowed, tat, retry_after = _gcra(self._tats.get(key), now, limit, cost)
+            self._tats[key] = tat
+            self._tats.move_to_end(key)
+            if len(self._tats) > self.max_keys:
+                self._tats.popitem(last=False)
+        return allowed, retry_after
+
+
+# KEYS[1] = bucket, ARGV = interval, burst, cost. Uses the server clock so
+# every worker agrees; returns {allowed, retry_after} with the float as text.
+GCRA_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local interval, burst, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local tat = tonumber(redis.call('GET', KEYS[1]) or now)
+if tat < now then tat = now end
+local new_tat = tat + interval * cost
+local allow_at = new_tat - interval * burst
+if allow_at > now then return {0, tostring(allow_at - now)} end
+redis.call('SET', KEYS[1], tostring(new_tat), 'PX', math.ceil((new_tat - now) * 1000))
+return {1, '0'}
+"""
+
+
+def _emulate_gcra(client, keys, args):
+    interval, burst, cost = (float(arg) for arg in args)
+    now = time.time()
+    stored = client.get(keys[0])
+    allowed, tat, retry_after = _gcra(float(stored) if stored else None, now,
+                                      Limit(1 / interval, burst), cost)
+    if allowed:
+        client.set(keys[0], repr(tat), ex=max(1, math.ceil(tat - now)))
+    return [int(allowed), repr(retry_after)]
+
+
+LocalSharedClient.emulate_script(GCRA_SCRIPT, _emulate_gcra)
+
+
+class SharedBucketStore:
+    """Token buckets in a shared server (a Redis client), so limits hold across workers.
+
+    `client` needs redis-py's `register_script`; the check is one script call.
+    """
+
+    def __init__(self, client, prefix='flask-restful:rl:'):
+        self.prefix = prefix
+        self._script = client.register_script(GCRA_SCRIPT)
+
+    def take(self, key, limit, cost=1):
+        allowed, retry_after = self._script(keys=[self.prefix + key], args=[limit.interval, limit.burst, cost])
+        return bool(int(allowed)), float(retry_after)
+
+
+class RateLimiter:
+    """Applies a Limit per endpoint and identity before each request.
+
+    `rules` map endpoints ('item.get_items'), blueprints ('user') or '*' to
+    limits. The identity is the JWT subject when a valid token is sent and
+    the client address otherwise.
+    """
+
+    def __init__(self, store, rules):
+        self.store = store
+        self.rules = {name: parse_limit(value) if isinstance(value, str) else value
+                      for name, value in rules.items()}
+        self.rejected = Counter()
+
+    def limit_for(self, endpoint):
+        if endpoint in self.rules:
+            return self.rules[endpoint]
+        blueprint = endpoint.rpartition('.')[0]
+        return self.rules.get(blueprint) or self.rules.get('*')
+
+    def check(self):
+        endpoint = request.endpoint
+        if endpoint is None or endpoint in ('static', 'metrics'):
+            return None
+        limit = self.limit_for(endpoint)
+        if limit is None:
+            return None
+        allowed, retry_after = self.store.take(f'{endpoint}:{request_identity()}', limit)
+        if allowed:
+            return None
+        self.rejected[endpoint] += 1
+        seconds = max(1, math.ceil(retry_after))
+        response = jsonify({'message': f'Too many requests, retry in {seconds} seconds.'})
+        return response, 429, {'Retry-After': str(seconds)}
+
+
+def init_rate_limits(app):
+    """Throttle requests per route and identity when RATELIMIT_ENABLED is set.
+
+    RATELIMIT_RULES maps endpoints or blueprints to limits like '5/minute'
+    ('*' for every other route). RATELIMIT_STORAGE is 'memory' (per process,
+    at most RATELIMIT_MAX_KEYS buckets) or 'shared', which talks to
+    RATELIMIT_SHARED_CLIENT, falling back to an in-process stand-in.
+    """
+    app.config.setdefault('RATELIMIT_ENABLED', False)
+    app.config.setdefault('RATELIMIT_RULES', {'user.login': '10/minute burst 5', '*': '50/second burst 100'})
+    app.config.setdefault('RATELIMIT_STORAGE', 'memory')
+    app.config.setdefault('RATELIMIT_MAX_KEYS', 100000)
+    if not app.config['RATELIMIT_ENABLED']:
+        return None
+    storage = app.config['RATELIMIT_STORAGE']
+    if storage == 'memory':
+        store = MemoryBucketStore(app.config['RATELIMIT_MAX_KEYS'])
+    elif storage == 'shared':
+        store = SharedBucketStore(app.config.get('RATELIMIT_SHARED_CLIENT') or LocalSharedClient())
+    else:
+        raise ValueError(f'Unknown RATELIMIT_STORAGE: {storage}')
+    limiter = app.extensions['rate_limiter'] = RateLimiter(store, app.config['RATELIMIT_RULES'])
+
+    def check_rate_limit():
+        return current_app.extensions['rate_limiter'].check()
+
+    app.before_request(check_rate_limit)
+    return limiter
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# standard python imports
+
+import time
+from itertools import islice
+
+from flask import Response, json, request, stream_with_context
+
+from app.util.metrics import record_timing
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+STREAM_BATCH_SIZE = 1000
+
+
+def wants_stream():
+    """Return True when the client asked for a streamed NDJSON export."""
+    if request.args.get('stream', '').lower() in ('1', 'true', 'yes'):
+        return True
+    return request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+
+def iter_query(query, batch_size=STREAM_BATCH_SIZE):
+    """Iterate a query with a server side cursor, `batch_size` rows at a time."""
+    return query.execution_options(stream_results=True).yield_per(batch_size)
+
+
+def iter_batches(iterable, batch_size=STREAM_BATCH_SIZE):
+    """Group an iterable into lists of at most `batch_size` elements."""
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
+
+
+def ndjson_response(records, encode=None):
+    """Stream an iterable of records, one JSON document per line.
+
+    Rows are written as they are produced, so memory stays flat and the first
+    bytes reach the client before the query has been fully consumed. `encode`
+    turns a record into JSON text and defaults to the app's JSON provider;
+    its time counts as serialization in the request metrics.
+    """
+    encode = encode or json.dumps
+
+    def generate():
+        elapsed = 0.0
+        try:
+            for record in records:
+                start = time.perf_counter()
+                line = encode(record) + '\n'
+                elapsed += time.perf_counter() - start
+                yield line
+        finally:
+            record_timing('serialize', elapsed)
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
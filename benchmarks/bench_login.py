@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Cost of building the login token: the old reflection based identity against the user id claim.
+
+    python benchmarks/bench_login.py --repeat 5000
+"""
+
+import argparse
+import json
+import os
+import tempfile
+
+from common import load_app, measure, seed, write_report
+
+
+class ReflectionEncoder(json.JSONEncoder):
+    """The encoder previously used for token identities, kept here for comparison."""
+
+    def default(self, obj):
+        if hasattr(type(obj), '__mapper__'):
+            fields = {}
+            for field in [x for x in dir(obj) if not x.startswith('_') and x != 'metadata']:
+                data = obj.__getattribute__(field)
+                try:
+                    json.dumps(data)
+                    fields[field] = data
+                except TypeError:
+                    fields[field] = None
+            return fields
+        return json.JSONEncoder.default(self, obj)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', help='defaults to a temporary SQLite file')
+    parser.add_argument('--repeat', type=int, default=2000)
+    parser.add_argument('--output', help='write the JSON report to this file')
+    args = parser.parse_args()
+
+    database_url = args.database_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    app = load_app(database_url)
+
+    from flask_jwt_extended import create_access_token
+    from app.auth import create_user_token
+    from app.db import db
+    from app.models.user import UserModel
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        seed(db, stores=1, items=0, users=1)
+        user = UserModel.find_by_username('user-0')
+        client = app.test_client()
+        body = json.dumps({'username': 'user-0', 'password': 'pass-0'})
+
+        legacy_token = create_access_token(identity=json.dumps(user, cls=ReflectionEncoder))
+        results = {
+            'reflection_identity': measure(lambda: json.dumps(user, cls=ReflectionEncoder), repeat=args.repeat),
+            'reflection_token': measure(
+                lambda: create_access_token(identity=json.dumps(user, cls=ReflectionEncoder)), repeat=args.repeat),
+            'id_claim_token': measure(lambda: create_user_token(user), repeat=args.repeat),
+            'login_request': measure(
+                lambda: client.post('/user', data=body, content_type='application/json'), repeat=args.repeat),
+            'token_bytes': {'reflection': len(legacy_token), 'id_claim': len(create_user_token(user))},
+        }
+
+    write_report('login', results, args.output, database=database_url.split(':')[0])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Lookup latency of the find_by_* queries as the tables grow.
+
+    python benchmarks/bench_lookups.py --sizes 1000 100000 1000000
+    python benchmarks/bench_lookups.py --no-index   # same, with the indexes dropped
+
+The lookup cache is disabled so every call reaches the database.
+"""
+
+import argparse
+import os
+import random
+import tempfile
+
+from common import load_app, measure, seed, write_report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', help='defaults to a temporary SQLite file')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=2000)
+    parser.add_argument('--no-index', action='store_true', help='drop the lookup indexes before measuring')
+    parser.add_argument('--output', help='write the JSON report to this file')
+    args = parser.parse_args()
+
+    database_url = args.database_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    app = load_app(database_url, CACHE_TYPE='null')
+
+    from app.db import db
+    from app.models.item import ItemModel
+    from app.models.store import StoreModel
+    from app.models.user import UserModel
+
+    results = []
+    with app.app_context():
+        for size in args.sizes:
+            db.drop_all()
+            db.create_all()
+            if args.no_index:
+                for table in db.metadata.sorted_tables:
+                    for index in table.indexes:
+                        index.drop(db.engine)
+            seed(db, stores=max(1, size // 100), items=size, users=size)
+
+            names = [f'item-{random.randrange(size)}' for _ in range(args.repeat)]
+            usernames = [f'user-{random.randrange(size)}' for _ in range(args.repeat)]
+            name_iter, username_iter = iter(names * 2), iter(usernames * 2)
+
+            def find_item():
+                assert ItemModel.find_by_name(next(name_iter)) is not None
+                db.session.remove()
+
+            def find_user():
+                assert UserModel.find_by_username(next(username_iter)) is not None
+                db.session.remove()
+
+            def find_store():
+                assert StoreModel.find_by_name('store-0') is not None
+                db.session.remove()
+
+            results.append({
+                'rows': size,
+                'ItemModel.find_by_name': measure(find_item, repeat=args.repeat),
+                'UserModel.find_by_username': measure(find_user, repeat=args.repeat),
+                'StoreModel.find_by_name': measure(find_store, repeat=args.repeat),
+            })
+
+    write_report('lookups', results, args.output, database=database_url.split(':')[0], indexes=not args.no_index)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Microbenchmarks of the model and encoder hot paths, in pytest-benchmark style.
+
+Not collected by the test suite; run explicitly (needs `pip install pytest-benchmark`):
+
+    pytest benchmarks/bench_micro.py --benchmark-json=micro.json
+    pytest benchmarks/bench_micro.py --benchmark-compare   # against the last saved run
+"""
+
+import json
+import os
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:///:memory:')
+
+ITEMS = int(os.environ.get('BENCH_ITEMS', 10000))
+
+
+@pytest.fixture(scope='module')
+def app():
+    from app.app import create_app
+    from app.db import db
+    from benchmarks.common import seed
+
+    flask_app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:', 'JWT_SECRET_KEY': 'bench-secret'})
+    with flask_app.app_context():
+        db.create_all()
+        seed(db, stores=max(1, ITEMS // 100), items=ITEMS, users=1)
+        yield flask_app
+
+
+@pytest.fixture
+def item(app):
+    from app.models.item import ItemModel
+    return ItemModel.find_by_name('item-1')
+
+
+def test_item_json(benchmark, item):
+    benchmark(item.json)
+
+
+def test_item_row_encoder(benchmark, item):
+    from app.models.item import ItemModel
+    row = (item.name, item.price, item.store_id, item.id)
+    benchmark(ItemModel.row_encoder.encode, row)
+
+
+def test_alchemy_encoder(benchmark, app):
+    from app.models.user import UserModel
+    from app.util.encoder import AlchemyEncoder
+    user = UserModel.find_by_username('user-0')
+    benchmark(json.dumps, user, cls=AlchemyEncoder)
+
+
+def test_find_by_name_uncached(benchmark, app):
+    from app.db import db
+    from app.models.item import ItemModel
+
+    def lookup():
+        app.extensions['cache'].clear()
+        db.session.remove()
+        return ItemModel.find_by_name(f'item-{ITEMS // 2}')
+
+    assert benchmark(lookup) is not None
+
+
+def test_find_by_name_cached(benchmark, app):
+    from app.db import db
+    from app.models.item import ItemModel
+
+    def lookup():
+        db.session.remove()
+        return ItemModel.find_by_name(f'item-{ITEMS // 2}')
+
+    assert benchmark(lookup) is not None
+
+
+def test_store_encode_many(benchmark, app):
+    from app.db import db
+    from app.models.store import StoreModel
+    stores = db.session.query(StoreModel.id, StoreModel.name).order_by(StoreModel.id).limit(100).all()
+    benchmark(StoreModel.encode_many, stores)
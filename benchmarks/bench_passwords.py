@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Password verification cost at each hash setting.
+
+For every --methods entry (werkzeug method strings), reports the time of one
+verification, the logins per second one core sustains, and the throughput of
+--threads concurrent verifications, which shows whether the hash releases
+the GIL and how many cores PASSWORD_WORKERS can put to use. The last column
+is a full POST /user login through the app.
+
+    python benchmarks/bench_passwords.py --methods pbkdf2:sha256:600000 scrypt:32768:8:1 --threads 1 2 4
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+
+from common import load_app, measure, write_report
+
+DEFAULT_METHODS = ('pbkdf2:sha256:100000', 'pbkdf2:sha256:600000', 'pbkdf2:sha256:1000000',
+                   'scrypt:16384:8:1', 'scrypt:32768:8:1', 'scrypt:65536:8:1')
+
+
+def concurrent_rate(fn, threads, duration):
+    """Calls per second of `fn` run by `threads` threads for `duration` seconds."""
+    counts = [0] * threads
+    deadline = time.perf_counter() + duration
+
+    def worker(index):
+        while time.perf_counter() < deadline:
+            fn()
+            counts[index] += 1
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return round(sum(counts) / (time.perf_counter() - start), 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', help='defaults to a temporary SQLite file')
+    parser.add_argument('--methods', nargs='+', default=DEFAULT_METHODS)
+    parser.add_argument('--threads', type=int, nargs='+', default=(1, 2, 4))
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=2, help='seconds per concurrent run')
+    parser.add_argument('--output', help='write the JSON report to this file')
+    args = parser.parse_args()
+
+    database_url = args.database_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    from app.util.passwords import hash_password, verify_password
+
+    results = {}
+    for method in args.methods:
+        stored = hash_password('correct horse', method)
+        verify = measure(lambda: verify_password(stored, 'correct horse'), repeat=args.repeat, warmup=2)
+
+        app = load_app(database_url, PASSWORD_HASH_METHOD=method)
+        from app.db import db
+        from app.models.user import UserModel
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            UserModel('bench', 'correct horse').save_to_db()
+        client = app.test_client()
+        body = json.dumps({'username': 'bench', 'password': 'correct horse'})
+        login = measure(lambda: client.post('/user', data=body, content_type='application/json'),
+                        repeat=args.repeat, warmup=2)
+
+        results[method] = {
+            'verify': verify,
+            'logins_per_sec_per_core': round(1e6 / verify['median_us'], 1),
+            'verify_per_sec_by_threads': {
+                str(threads): concurrent_rate(lambda: verify_password(stored, 'correct horse'), threads,
+                                              args.duration)
+                for threads in args.threads
+            },
+            'login_request': login,
+        }
+
+    write_report('passwords', results, args.output, cpus=os.cpu_count())
+
+
+if __name__ == '__main__':
+    main()
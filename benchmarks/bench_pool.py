@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Connection pool behavior under more concurrent requests than connections.
+
+Each worker thread runs requests that hold a pooled connection for --hold-ms,
+like a slow query would. With more workers than pool_size + max_overflow,
+requests queue for a connection and fail once they wait longer than
+pool_timeout.
+
+    DB_POOL_SIZE=4 DB_MAX_OVERFLOW=0 DB_POOL_TIMEOUT=0.5 python benchmarks/bench_pool.py --workers 16
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+from common import load_app, write_report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', help='defaults to a temporary SQLite file')
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=50, help='requests per worker')
+    parser.add_argument('--hold-ms', type=float, default=20)
+    parser.add_argument('--output', help='write the JSON report to this file')
+    args = parser.parse_args()
+
+    database_url = args.database_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    app = load_app(database_url)
+
+    from sqlalchemy import text
+    from sqlalchemy.exc import TimeoutError
+    from app.config import engineSettings
+    from app.db import db, pool_stats
+
+    latencies = []
+    timeouts = []
+    peak_checked_out = [0]
+    lock = threading.Lock()
+
+    def worker():
+        for _ in range(args.requests):
+            start = time.perf_counter()
+            try:
+                with app.app_context():
+                    db.session.execute(text('SELECT 1'))
+                    with lock:
+                        peak_checked_out[0] = max(peak_checked_out[0], pool_stats().get('checkedout', 0))
+                    time.sleep(args.hold_ms / 1000)
+            except TimeoutError:
+                with lock:
+                    timeouts.append(time.perf_counter() - start)
+                continue
+            with lock:
+                latencies.append((time.perf_counter() - start) * 1000)
+
+    threads = [threading.Thread(target=worker) for _ in range(args.workers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    with app.app_context():
+        final = pool_stats()
+    results = {
+        'settings': engineSettings(),
+        'workers': args.workers,
+        'requests': args.workers * args.requests,
+        'completed': len(latencies),
+        'timed_out': len(timeouts),
+        'throughput_rps': round(len(latencies) / elapsed, 1),
+        'latency_ms': {
+            'median': round(statistics.median(latencies), 2) if latencies else None,
+            'p95': round(latencies[int(len(latencies) * 0.95) - 1], 2) if latencies else None,
+            'max': round(latencies[-1], 2) if latencies else None,
+        },
+        'peak_checked_out': peak_checked_out[0],
+        'pool': final,
+    }
+    write_report('pool', results, args.output, database=database_url.split(':')[0])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Serialization cost of large /items and /stores responses.
+
+Compares the previous path (ORM objects -> json() dicts -> jsonify) with the
+column rows encoded by RowEncoder, for a page of --rows items.
+
+    python benchmarks/bench_serialization.py --rows 100000
+"""
+
+import argparse
+import os
+import tempfile
+
+from common import load_app, measure, seed, write_report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', help='defaults to a temporary SQLite file')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--stores', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='write the JSON report to this file')
+    args = parser.parse_args()
+
+    database_url = args.database_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    app = load_app(database_url)
+
+    from flask import jsonify
+    from app.db import db
+    from app.models.item import ItemModel
+    from app.models.store import StoreModel
+    from app.util import json_provider
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        seed(db, stores=args.stores, items=args.rows)
+        db.session.remove()
+
+    def run(fn):
+        def wrapped():
+            with app.test_request_context():
+                fn()
+                db.session.remove()
+        return measure(wrapped, repeat=args.repeat, warmup=1)
+
+    def orm_items():
+        jsonify({'items': [item.json() for item in ItemModel.query.order_by(ItemModel.id)]})
+
+    def row_items():
+        rows = db.session.query(*ItemModel.json_columns()).order_by(ItemModel.id).all()
+        json_provider.raw_json_response(json_provider.encode_document(
+            [('items', ItemModel.row_encoder.encode_many(rows))]))
+
+    def encode_only_dicts(dicts):
+        return lambda: app.json.response({'items': dicts})
+
+    def orm_stores():
+        jsonify({'stores': [store.json() for store in StoreModel.query.order_by(StoreModel.id)]})
+
+    def json_many_stores():
+        # The items of all stores in one IN query, built into json() dicts
+        stores = StoreModel.query.order_by(StoreModel.id).all()
+        items_by_store = {store.id: [] for store in stores}
+        for item in ItemModel.query.filter(ItemModel.store_id.in_(items_by_store)).order_by(ItemModel.id):
+            items_by_store[item.store_id].append(item.json())
+        jsonify({'stores': [{'id': store.id, 'name': store.name, 'items': items_by_store[store.id]}
+                            for store in stores]})
+
+    def encoded_stores():
+        stores = db.session.query(StoreModel.id, StoreModel.name).order_by(StoreModel.id)
+        json_provider.raw_json_response('{"stores":[' + ','.join(StoreModel.encode_many(stores)) + ']}')
+
+    with app.app_context():
+        dicts = [item.json() for item in ItemModel.query]
+        db.session.remove()
+
+    results = {
+        'orjson_available': json_provider.orjson is not None,
+        'items_orm_jsonify': run(orm_items),
+        'items_rows_encoded': run(row_items),
+        'items_dicts_provider_only': run(encode_only_dicts(dicts)),
+        'stores_per_store_query': run(orm_stores),
+        'stores_json_many': run(json_many_stores),
+        'stores_rows_encoded': run(encoded_stores),
+    }
+    write_report('serialization', results, args.output, rows=args.rows, stores=args.stores,
+                 database=database_url.split(':')[0])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Worker startup time: importing the package, building the app and serving the first request.
+
+Every run happens in a fresh interpreter, as it would for a new worker.
+
+    python benchmarks/bench_startup.py --runs 20
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from common import ROOT, write_report
+
+PROBE = r'''
+import json, time
+start = time.perf_counter()
+import app.app
+imported = time.perf_counter()
+application = app.app.create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:'})
+created = time.perf_counter()
+from app.db import db
+with application.app_context():
+    db.create_all()
+    response = application.test_client().get('/stores')
+    assert response.status_code == 200
+served = time.perf_counter()
+print(json.dumps({'import_ms': (imported - start) * 1000,
+                  'create_app_ms': (created - imported) * 1000,
+                  'first_request_ms': (served - created) * 1000}))
+'''
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--output', help='write the JSON report to this file')
+    args = parser.parse_args()
+
+    env = dict(os.environ, DATABASE_URL='sqlite:///:memory:')
+    samples = []
+    for _ in range(args.runs):
+        output = subprocess.run([sys.executable, '-c', PROBE], cwd=ROOT, env=env,
+                                check=True, capture_output=True, text=True).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+
+    results = {}
+    for key in samples[0]:
+        values = sorted(sample[key] for sample in samples)
+        results[key] = {'median': round(statistics.median(values), 2), 'min': round(values[0], 2),
+                        'max': round(values[-1], 2)}
+    write_report('startup', results, args.output, runs=args.runs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Write throughput: a commit per save vs unit_of_work() vs group commit.
+
+Three measurements, each in writes per second:
+
+  saves         ItemModel.save_to_db() committing every row, then the same
+                rows saved inside unit_of_work() blocks of --batch rows
+  puts          --threads clients sending PUT /item/<name> for --duration
+                seconds, with group commit off and at each --windows-ms
+
+The default SQLite file syncs on every commit, as a real database would;
+pass --database-url to measure PostgreSQL.
+
+    python benchmarks/bench_writes.py --rows 2000 --batch 100 --threads 16 --windows-ms 1 5
+"""
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from common import load_app, write_report
+
+
+def reset(app, stores=10):
+    from app.db import db
+    from app.models.store import StoreModel
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        for i in range(stores):
+            StoreModel(f'store-{i}').save_to_db()
+
+
+def bench_saves(database_url, rows, batch):
+    from app.db import db, unit_of_work
+    from app.models.item import ItemModel
+
+    app = load_app(database_url)
+    results = {}
+    for mode in ('commit_per_save', 'unit_of_work'):
+        reset(app)
+        with app.app_context():
+            start = time.perf_counter()
+            if mode == 'commit_per_save':
+                for i in range(rows):
+                    ItemModel(f'item-{i}', i, i % 10 + 1).save_to_db()
+            else:
+                for first in range(0, rows, batch):
+                    with unit_of_work():
+                        for i in range(first, min(first + batch, rows)):
+                            ItemModel(f'item-{i}', i, i % 10 + 1).save_to_db()
+            elapsed = time.perf_counter() - start
+            assert ItemModel.query.count() == rows
+            db.session.remove()
+        results[mode] = {'rows': rows, 'seconds': round(elapsed, 3), 'writes_per_sec': round(rows / elapsed, 1)}
+    results['unit_of_work']['batch'] = batch
+    return results
+
+
+def bench_puts(database_url, threads, duration, window_ms, names):
+    from app.auth import create_user_token
+    from app.db import db
+    from app.models.user import UserModel
+
+    app = load_app(database_url, GROUP_COMMIT_WINDOW_MS=window_ms, PASSWORD_HASH_METHOD='pbkdf2:sha256:1000')
+    reset(app)
+    with app.app_context():
+        user = UserModel('bench', 'bench')
+        user.save_to_db()
+        headers = {'Authorization': f'Bearer {create_user_token(user)}'}
+        db.session.remove()
+
+    counts, errors = [0] * threads, [0] * threads
+    deadline = time.perf_counter() + duration
+
+    def worker(index):
+        client = app.test_client()
+        n = index
+        while time.perf_counter() < deadline:
+            n += threads
+            response = client.put(f'/item/item-{n % names}', json={'price': n, 'store_id': n % 10 + 1},
+                                  headers=headers)
+            counts[index] += 1
+            errors[index] += response.status_code != 200
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    result = {'requests': sum(counts), 'errors': sum(errors), 'writes_per_sec': round(sum(counts) / elapsed, 1)}
+    committer = app.extensions.get('item_group_commit')
+    if committer is not None:
+        result['transactions'] = committer.batches
+        result['mean_group'] = round(committer.writes / max(1, committer.batches), 1)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', help='defaults to a temporary SQLite file')
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--batch', type=int, default=100, help='rows per unit_of_work()')
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--names', type=int, default=10000, help='distinct item names the PUTs cycle through')
+    parser.add_argument('--windows-ms', type=float, nargs='+', default=(1, 5))
+    parser.add_argument('--output', help='write the JSON report to this file')
+    args = parser.parse_args()
+
+    database_url = args.database_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    results = {'saves': bench_saves(database_url, args.rows, args.batch), 'puts': {}}
+    for window_ms in (0, *args.windows_ms):
+        label = 'no_group_commit' if not window_ms else f'group_commit_{window_ms:g}ms'
+        results['puts'][label] = bench_puts(database_url, args.threads, args.duration, window_ms, args.names)
+
+    write_report('writes', results, args.output, database=database_url.split(':')[0], threads=args.threads)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Helpers shared by the benchmark scripts."""
+
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def load_app(database_url, **config):
+    """Create an application instance against `database_url`."""
+    from app.app import create_app
+    return create_app(dict(config, SQLALCHEMY_DATABASE_URI=database_url))
+
+
+def seed(db, stores=10, items=1000, users=0, batch_size=10000):
+    """Insert `stores` stores, `items` items spread over them and `users` users."""
+    from sqlalchemy import insert
+    from app.models.item import ItemModel
+    from app.models.store import StoreModel
+    from app.models.user import UserModel
+
+    def insert_batches(model, rows):
+        for start in range(0, len(rows), batch_size):
+            db.session.execute(insert(model), rows[start:start + batch_size])
+
+    insert_batches(StoreModel, [{'id': i + 1, 'name': f'store-{i}'} for i in range(stores)])
+    insert_batches(ItemModel, [{'name': f'item-{i}', 'price': round(i % 1000 + 0.99, 2), 'store_id': i % stores + 1}
+                               for i in range(items)])
+    insert_batches(UserModel, [{'username': f'user-{i}', 'password': f'pass-{i}'} for i in range(users)])
+    db.session.commit()
+
+
+def measure(fn, repeat=1000, warmup=10):
+    """Call `fn` `repeat` times and return latency statistics in microseconds."""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1e6)
+    samples.sort()
+    return {
+        'runs': repeat,
+        'min_us': round(samples[0], 2),
+        'median_us': round(statistics.median(samples), 2),
+        'p95_us': round(samples[int(len(samples) * 0.95) - 1], 2),
+        'mean_us': round(statistics.fmean(samples), 2),
+        'ops_per_sec': round(repeat / (sum(samples) / 1e6), 1),
+    }
+
+
+def write_report(name, results, path=None, **metadata):
+    """Print the results and write them as a JSON report comparable between runs."""
+    report = {
+        'benchmark': name,
+        'created': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        **metadata,
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if path:
+        with open(path, 'w') as f:
+            f.write(text + '\n')
+    return report
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Compare two benchmark reports and flag regressions.
+
+Walks both JSON reports written with --output, matches every throughput
+(`rps`, `ops_per_sec`) and latency (`*_us`, `*_ms`, percentiles) value by its
+path and prints the change. Exits with status 1 when any value regressed by
+more than --threshold percent, so it can gate a CI job.
+
+    python benchmarks/compare.py baseline.json current.json --threshold 10
+"""
+
+import argparse
+import json
+import sys
+
+HIGHER_IS_BETTER = ('rps', 'ops_per_sec')
+LATENCY_KEYS = ('p50', 'p95', 'p99', 'max', 'min', 'median', 'mean')
+
+
+def direction(path):
+    """Return 1 when a larger value is better, -1 when smaller is, None to skip."""
+    key = path[-1]
+    if key in HIGHER_IS_BETTER:
+        return 1
+    if key.endswith(('_us', '_ms', '_s')) or key in LATENCY_KEYS or 'latency' in path[:-1]:
+        return -1
+    return None
+
+
+def flatten(value, path=()):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from flatten(item, path + (str(key),))
+    elif isinstance(value, list):
+        for index, item in enumerate(value):
+            yield from flatten(item, path + (str(index),))
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield path, value
+
+
+def compare(baseline, current, threshold):
+    """Return (path, old, new, change %, regressed) for every comparable value."""
+    old_values = dict(flatten(baseline.get('results', {})))
+    rows = []
+    for path, new in flatten(current.get('results', {})):
+        sign = direction(path)
+        old = old_values.get(path)
+        if sign is None or not old:
+            continue
+        change = (new - old) / old * 100
+        rows.append(('.'.join(path), old, new, change, change * sign < -threshold))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--threshold', type=float, default=10, help='allowed regression in percent (default: 10)')
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    if baseline.get('benchmark') != current.get('benchmark'):
+        raise SystemExit(f"Reports are from different benchmarks: {baseline.get('benchmark')} and {current.get('benchmark')}")
+
+    rows = compare(baseline, current, args.threshold)
+    width = max((len(row[0]) for row in rows), default=10)
+    for name, old, new, change, regressed in rows:
+        print(f"{name:<{width}}  {old:>12}  {new:>12}  {change:+7.1f}%{'  REGRESSION' if regressed else ''}")
+    regressions = sum(row[4] for row in rows)
+    print(f'\n{len(rows)} values compared, {regressions} regressed by more than {args.threshold:g}%')
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -108,6 +108,11 @@ with app.app_context():
     db.create_all()
     print("✓ Tables created successfully")
 
+    # Bring databases created by older versions up to date
+    from app.schema import upgrade_schema
+    changed = upgrade_schema()
+    print(f"✓ Upgraded {len(changed)} indexes and columns")
+
     # Check what tables exist
     inspector = db.inspect(db.engine)
     tables = inspector.get_table_names()
@@ -108,6 +108,8 @@ Environment Variables:
     DATABASE_URL             Override database URL
     FLASK_ENV                Flask environment (development/production)
     LOGLEVEL                 Logging level (DEBUG/INFO/WARNING/ERROR)
+    LOG_MODE                 console (default) or queue (log from a background thread)
+    LOG_FORMAT               rich (default) or json
 
 EOF
     exit 0
@@ -249,10 +251,10 @@ $PYTHON_CMD -c "
 import sys
 sys.path.insert(0, '.')
 from app.app import app
-from app.db import db
+from app.schema import upgrade_schema
 
 with app.app_context():
-    db.create_all()
+    upgrade_schema()
 print('✓ Database tables ready')
 " 2>&1 | grep -E '✓|Error|Exception' || true
 
@@ -295,6 +297,7 @@ echo "  GET    /item/<name>        - Get item details (requires auth)"
 echo "  PUT    /item/<name>        - Update/create item (requires auth)"
 echo "  DELETE /item/<name>        - Delete item (requires auth)"
 echo "  GET    /items              - List all items (requires auth)"
+echo "  PUT    /items              - Bulk create/update items (requires auth)"
 echo ""
 echo -e "${YELLOW}────────────────────────────────────────${NC}"
 echo ""
@@ -4,7 +4,6 @@
 
 import os
 import pytest
-from flask_jwt_extended import create_access_token
 
 # Set test database URL before importing app
 os.environ['DATABASE_URL'] = 'sqlite:///:memory:'
@@ -13,14 +12,16 @@ os.environ['DATABASE_URL'] = 'sqlite:///:memory:'
 @pytest.fixture(scope='function')
 def app():
     """Create application for testing."""
-    from app.app import app as flask_app
+    from app.app import create_app
     from app.db import db as _db
 
-    flask_app.config.update({
+    flask_app = create_app({
         'TESTING': True,
         'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',
         'SQLALCHEMY_TRACK_MODIFICATIONS': False,
         'JWT_SECRET_KEY': 'test-secret-key',
+        # Cheap hashing keeps the tests fast, the default costs ~50ms per hash
+        'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000',
     })
 
     with flask_app.app_context():
@@ -46,10 +47,9 @@ def db(app):
 @pytest.fixture(scope='function')
 def auth_headers(app):
     """Create JWT token for authenticated requests."""
+    from app.auth import create_user_token
     from app.db import db as _db
     from app.models.user import UserModel
-    from app.util.encoder import AlchemyEncoder
-    import json
 
     with app.app_context():
         # Create a test user
@@ -58,9 +58,7 @@ def auth_headers(app):
         _db.session.commit()
 
         # Create access token
-        access_token = create_access_token(
-            identity=json.dumps(user, cls=AlchemyEncoder)
-        )
+        access_token = create_user_token(user)
 
         return {
             'Authorization': f'Bearer {access_token}',
@@ -99,3 +97,18 @@ def sample_item(db, sample_store):
     db.session.add(item)
     db.session.commit()
     return item
+
+
+@pytest.fixture(scope='function')
+def query_counter(db):
+    """Collect the SQL statements issued against the engine."""
+    from sqlalchemy import event
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    yield statements
+    event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
@@ -2,10 +2,15 @@
 # -*- coding: utf-8 -*-
 """Tests for database models."""
 
+import json
+
 import pytest
-from app.models.user import UserModel
+from app.db import insert_unique, unit_of_work
+from app.models.user import TokenPrincipal, UserModel
 from app.models.item import ItemModel
 from app.models.store import StoreModel
+from app.models.table_version import TableVersionModel
+from app.schema import SchemaUpgradeError, upgrade_schema, widen_column_ddl
 
 
 class TestUserModel:
@@ -19,7 +24,8 @@ class TestUserModel:
 
         assert user.id is not None
         assert user.username == 'testuser'
-        assert user.password == 'testpass'
+        assert user.password.startswith('pbkdf2:sha256:1000$')
+        assert 'testpass' not in user.password
 
     def test_find_by_username(self, db, sample_user):
         """Test finding user by username."""
@@ -38,6 +44,18 @@ class TestUserModel:
         assert user is not None
         assert user.id == sample_user.id
 
+    def test_password_not_cached(self, app, db, sample_user):
+        """Test the cached user row leaves out the password hash, which is loaded when needed."""
+        from app.util.cache import cache_key
+
+        user_id = sample_user.id
+        db.session.expunge_all()
+        UserModel.find_by_id(user_id)
+        db.session.expunge_all()
+
+        assert 'password' not in app.extensions['cache'].get(cache_key(UserModel, 'id', user_id))
+        assert UserModel.find_by_id(user_id).check_password('samplepass')
+
     def test_find_by_id_not_found(self, db):
         """Test finding user by non-existent ID."""
         user = UserModel.find_by_id(999)
@@ -52,11 +70,40 @@ class TestUserModel:
         assert saved_user is not None
         assert saved_user.username == 'newuser'
 
+    def test_token_principal_loads_user(self, db, sample_user):
+        """Test a token principal loads the full user on demand."""
+        principal = TokenPrincipal(sample_user.id, 'sampleuser')
+        assert principal.user.id == sample_user.id
+
     def test_check_password(self, db, sample_user):
         """Test password checking."""
         assert sample_user.check_password('samplepass') is True
         assert sample_user.check_password('wrongpass') is False
 
+    def test_password_salted(self, db):
+        """Test the same password hashes differently for two users."""
+        first = UserModel(username='first', password='same')
+        second = UserModel(username='second', password='same')
+
+        assert first.password != second.password
+        assert first.check_password('same') and second.check_password('same')
+
+    def test_legacy_plaintext_password(self, db, sample_user):
+        """Test passwords stored before hashing still verify and need a rehash."""
+        sample_user.password = 'samplepass'
+
+        assert sample_user.check_password('samplepass') is True
+        assert sample_user.check_password('wrongpass') is False
+        assert sample_user.password_needs_rehash()
+
+    def test_needs_rehash_after_method_change(self, app, db, sample_user):
+        """Test a change of hash parameters flags existing hashes."""
+        assert not sample_user.password_needs_rehash()
+
+        app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:2000'
+
+        assert sample_user.password_needs_rehash()
+
 
 class TestStoreModel:
     """Tests for StoreModel."""
@@ -98,6 +145,26 @@ class TestStoreModel:
         deleted_store = StoreModel.query.filter_by(id=store_id).first()
         assert deleted_store is None
 
+    def test_find_by_name_cached(self, db, sample_store, query_counter):
+        """Test a repeated lookup is answered from the cache."""
+        StoreModel.find_by_name('Test Store')
+        db.session.remove()
+        query_counter.clear()
+
+        store = StoreModel.find_by_name('Test Store')
+
+        assert query_counter == []
+        assert store.id == sample_store.id
+
+    def test_find_by_name_invalidated_on_rename(self, db, sample_store):
+        """Test renaming a store invalidates the old name."""
+        store = StoreModel.find_by_name('Test Store')
+        store.name = 'Renamed Store'
+        store.save_to_db()
+
+        assert StoreModel.find_by_name('Test Store') is None
+        assert StoreModel.find_by_name('Renamed Store').id == sample_store.id
+
     def test_json(self, db, sample_store, sample_item):
         """Test store JSON representation."""
         json_data = sample_store.json()
@@ -116,6 +183,50 @@ class TestStoreModel:
         assert json_data['name'] == 'Empty Store'
         assert json_data['items'] == []
 
+    def test_encode_many(self, db, sample_store, sample_item, query_counter):
+        """Test encoding several stores at once matches json(), with one query for all the items."""
+        empty = StoreModel(name='Empty Store')
+        empty.save_to_db()
+        stores = StoreModel.query.order_by(StoreModel.id).all()
+        query_counter.clear()
+
+        encoded = StoreModel.encode_many(stores)
+
+        assert len(query_counter) == 1
+        assert [json.loads(text) for text in encoded] == [store.json() for store in stores]
+
+    def test_encode_many_no_stores(self, db, query_counter):
+        """Test encoding no stores does not query items."""
+        assert StoreModel.encode_many([]) == []
+        assert query_counter == []
+
+    def test_encode_with_items(self, db, sample_store, sample_item):
+        """Test stores are encoded with the item rows of items_of() given."""
+        stores = db.session.query(*StoreModel.json_columns()).order_by(StoreModel.id).all()
+        rows = db.session.execute(StoreModel.items_of(stores)).all()
+
+        encoded = StoreModel.encode_with_items(stores, rows)
+
+        assert [json.loads(text) for text in encoded] == [sample_store.json()]
+
+    def test_json_fields(self, db, sample_store, sample_item, query_counter):
+        """Test json() with a subset of the fields loads only the item columns written."""
+        assert sample_store.json(('name',)) == {'name': 'Test Store'}
+        assert not any('FROM items' in statement for statement in query_counter)
+
+        assert sample_store.json(('id', 'items'), ('price',)) == {'id': sample_store.id, 'items': [{'price': 19.99}]}
+        assert 'items.name' not in query_counter[-1]
+
+    def test_encode_many_fields(self, db, sample_store, sample_item, query_counter):
+        """Test encoding a subset of the fields matches json() and skips the items query without items."""
+        stores = StoreModel.query.order_by(StoreModel.id).all()
+        query_counter.clear()
+
+        assert StoreModel.encode_many(stores, ('id', 'name')) == [f'{{"id":{sample_store.id},"name":"Test Store"}}']
+        assert query_counter == []
+        encoded = StoreModel.encode_many(stores, ('items',), ('name', 'price'))
+        assert [json.loads(text) for text in encoded] == [store.json(('items',), ('name', 'price')) for store in stores]
+
 
 class TestItemModel:
     """Tests for ItemModel."""
@@ -168,8 +279,454 @@ class TestItemModel:
         assert json_data['price'] == 19.99
         assert json_data['store_id'] == sample_store.id
 
+    def test_json_fields(self, db, sample_item):
+        """Test json() and the column encoders with a subset of the fields."""
+        assert sample_item.json(('price',)) == {'price': 19.99}
+
+        fields = ('name', 'store_id')
+        row = db.session.execute(db.select(*ItemModel.json_columns(fields))).one()
+        assert len(row) == 3
+        assert json.loads(ItemModel.encoder_for(fields).encode(row)) == sample_item.json(fields)
+        assert ItemModel.encoder_for(fields) is ItemModel.encoder_for(fields)
+        assert ItemModel.encoder_for(ItemModel.FIELDS) is ItemModel.row_encoder
+
+    def test_find_by_name_cached(self, app, db, sample_item, query_counter):
+        """Test a repeated lookup is answered from the cache."""
+        assert ItemModel.find_by_name('Test Item') is not None
+        query_counter.clear()
+
+        db.session.remove()
+        item = ItemModel.find_by_name('Test Item')
+
+        assert query_counter == []
+        assert item.price == 19.99
+        assert item in db.session
+        assert app.extensions['cache'].stats()['namespaces']['items:name']['hits'] >= 1
+
+    def test_find_by_name_not_cached_when_invalidated_meanwhile(self, app, db, sample_item):
+        """Test a row invalidated while its lookup query runs is not put back in the cache."""
+        from sqlalchemy import event
+        from app.util.cache import MISSING, cache_key
+        cache = app.extensions['cache']
+        key = cache_key(ItemModel, 'name', 'Test Item')
+
+        def invalidate(conn, cursor, statement, parameters, context, executemany):
+            # A write to the item committing in another request
+            cache.delete(key)
+
+        cache.clear()
+        event.listen(db.engine, 'before_cursor_execute', invalidate)
+        try:
+            assert ItemModel.find_by_name('Test Item') is not None
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', invalidate)
+
+        assert cache.get(key) is MISSING
+        db.session.expunge_all()
+        assert ItemModel.find_by_name('Test Item') is not None
+        assert cache.get(key) is not MISSING
+
+    def test_find_by_name_keeps_pending_changes(self, db, sample_item):
+        """Test a cached lookup of a row changed in the session returns it unchanged."""
+        ItemModel.find_by_name('Test Item')
+        item = ItemModel.find_by_name('Test Item')
+        item.price = 99.0
+
+        assert ItemModel.find_by_name('Test Item') is item
+        assert item.price == 99.0
+        db.session.commit()
+        db.session.remove()
+        assert db.session.scalar(db.select(ItemModel.price)) == 99.0
+
+    def test_find_by_name_reads_uncommitted_writes(self, db, sample_item, sample_store):
+        """Test a lookup inside a unit of work sees its own bulk write, not the cached row."""
+        store_id = sample_store.id
+        ItemModel.find_by_name('Test Item')
+        db.session.remove()
+
+        with unit_of_work():
+            ItemModel.upsert('Test Item', 42.0, store_id)
+            assert ItemModel.find_by_name('Test Item').price == 42.0
+
+    def test_find_by_name_invalidated_on_save(self, db, sample_item):
+        """Test saving an item drops its cached lookup."""
+        item = ItemModel.find_by_name('Test Item')
+        item.price = 5.0
+        item.save_to_db()
+        db.session.remove()
+
+        assert ItemModel.find_by_name('Test Item').price == 5.0
+
+    def test_find_by_name_invalidated_on_delete(self, db, sample_item):
+        """Test deleting an item drops its cached lookup."""
+        ItemModel.find_by_name('Test Item').delete_from_db()
+
+        assert ItemModel.find_by_name('Test Item') is None
+
+    def test_upsert_many(self, db, sample_item, sample_store):
+        """Test inserting and updating items in one call."""
+        existing = ItemModel.upsert_many([
+            {'name': 'Test Item', 'price': 1.0, 'store_id': 999},
+            {'name': 'Other Item', 'price': 2.0, 'store_id': sample_store.id},
+        ])
+
+        assert existing == {'Test Item'}
+        item = ItemModel.find_by_name('Test Item')
+        assert item.price == 1.0
+        assert item.store_id == sample_store.id
+        assert ItemModel.find_by_name('Other Item').price == 2.0
+
+    def test_upsert_many_writes_in_name_order(self, db, sample_store):
+        """Test rows are written sorted by name, so concurrent batches lock them in the same order."""
+        from sqlalchemy import event
+        written = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('INSERT INTO items'):
+                written.extend(params[0] for params in parameters)
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            ItemModel.upsert_many([{'name': name, 'price': 1.0, 'store_id': sample_store.id}
+                                   for name in ('Charlie', 'Alpha', 'Bravo')])
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+        assert written == ['Alpha', 'Bravo', 'Charlie']
+
+    def test_upsert_many_generic_dialect(self, db, sample_item, sample_store, monkeypatch):
+        """Test the UPDATE + INSERT path used by databases without ON CONFLICT."""
+        monkeypatch.setattr(db.engine.dialect, 'name', 'generic')
+
+        existing = ItemModel.upsert_many([
+            {'name': 'Test Item', 'price': 1.0, 'store_id': sample_store.id},
+            {'name': 'Other Item', 'price': 2.0, 'store_id': sample_store.id},
+        ])
+
+        assert existing == {'Test Item'}
+        assert ItemModel.find_by_name('Test Item').price == 1.0
+        assert ItemModel.find_by_name('Other Item').price == 2.0
+
+    def test_upsert(self, db, sample_item, sample_store, query_counter):
+        """Test one statement creates or updates an item and returns the stored row."""
+        created = ItemModel.upsert('Other Item', 2.0, sample_store.id)
+        updated = ItemModel.upsert('Test Item', 1.0, 999)
+
+        assert created._asdict() == {'name': 'Other Item', 'price': 2.0, 'store_id': sample_store.id}
+        # Like PUT /item/<name>, only the price of an existing item changes
+        assert updated._asdict() == {'name': 'Test Item', 'price': 1.0, 'store_id': sample_store.id}
+        assert ItemModel.find_by_name('Test Item').price == 1.0
+        item_statements = [s for s in query_counter if 'items' in s and 'table_versions' not in s]
+        assert len(item_statements) == 3
+        assert all(s.startswith('INSERT') and 'ON CONFLICT' in s for s in item_statements[:2])
+
+    def test_upsert_generic_dialect(self, db, sample_item, sample_store, monkeypatch):
+        """Test the UPDATE, then INSERT, path used by databases without ON CONFLICT."""
+        monkeypatch.setattr(db.engine.dialect, 'name', 'generic')
+
+        assert ItemModel.upsert('Other Item', 2.0, sample_store.id).price == 2.0
+        assert ItemModel.upsert('Test Item', 1.0, sample_store.id).price == 1.0
+        assert ItemModel.find_by_name('Other Item') is not None
+        assert ItemModel.find_by_name('Test Item').price == 1.0
+
     def test_relationship_with_store(self, db, sample_item, sample_store):
         """Test item-store relationship."""
         assert sample_item.store is not None
         assert sample_item.store.id == sample_store.id
         assert sample_item.store.name == 'Test Store'
+
+
+class TestUnitOfWork:
+    """Tests for committing many model changes at once."""
+
+    @pytest.fixture
+    def commits(self, db):
+        from sqlalchemy import event
+        from sqlalchemy.orm import Session
+
+        count = [0]
+
+        def after_commit(session):
+            count[0] += 1
+
+        event.listen(Session, 'after_commit', after_commit)
+        yield count
+        event.remove(Session, 'after_commit', after_commit)
+
+    def test_single_commit(self, db, commits):
+        """Test saves inside the block are flushed right away and committed once."""
+        with unit_of_work():
+            store = StoreModel('Bulk Store')
+            store.save_to_db()
+            assert store.id is not None
+            for i in range(5):
+                ItemModel(f'bulk-{i}', i, store.id).save_to_db()
+            assert commits[0] == 0
+
+        assert commits[0] == 1
+        assert ItemModel.query.filter(ItemModel.name.startswith('bulk-')).count() == 5
+
+    def test_rolled_back_on_error(self, db, sample_store):
+        """Test an exception undoes every change of the block."""
+        with pytest.raises(RuntimeError):
+            with unit_of_work():
+                ItemModel('a', 1.0, sample_store.id).save_to_db()
+                sample_store.delete_from_db()
+                raise RuntimeError('job failed')
+
+        assert ItemModel.query.count() == 0
+        assert StoreModel.find_by_name('Test Store') is not None
+
+    def test_nested_block_is_savepoint(self, db, sample_store):
+        """Test a failed inner block only undoes its own changes."""
+        with unit_of_work():
+            ItemModel('kept', 1.0, sample_store.id).save_to_db()
+            try:
+                with unit_of_work():
+                    ItemModel('dropped', 1.0, sample_store.id).save_to_db()
+                    raise RuntimeError('skip this one')
+            except RuntimeError:
+                pass
+
+        assert [item.name for item in ItemModel.query] == ['kept']
+
+    def test_insert_unique_inside(self, db, sample_item, sample_store):
+        """Test a duplicate insert in a unit of work leaves the other changes in place."""
+        with unit_of_work():
+            ItemModel('new', 1.0, sample_store.id).save_to_db()
+            assert insert_unique(ItemModel('Test Item', 2.0, sample_store.id)) is False
+
+        assert sorted(item.name for item in ItemModel.query) == ['Test Item', 'new']
+
+    def test_decorator(self, db, sample_store, commits):
+        """Test unit_of_work() wraps a function, e.g. a bulk job."""
+        @unit_of_work()
+        def job():
+            for i in range(3):
+                ItemModel.upsert(f'job-{i}', i, sample_store.id)
+
+        job()
+
+        assert commits[0] == 1
+        assert ItemModel.query.count() == 3
+
+    def test_upsert_batch(self, db, sample_item, sample_store):
+        """Test one transaction writes every row, the last of a repeated name winning."""
+        rows = ItemModel.upsert_batch([
+            {'name': 'Test Item', 'price': 1.0, 'store_id': 999},
+            {'name': 'new', 'price': 2.0, 'store_id': sample_store.id},
+            {'name': 'new', 'price': 3.0, 'store_id': sample_store.id},
+        ])
+
+        assert [tuple(row) for row in rows] == [('Test Item', 1.0, sample_store.id),
+                                                ('new', 3.0, sample_store.id), ('new', 3.0, sample_store.id)]
+
+
+class TestTableVersionModel:
+    """Tests for the per-table change counters."""
+
+    def test_seeded_on_create(self, db):
+        """Test every table starts at version 0."""
+        versions = TableVersionModel.find_versions(('items', 'stores', 'users'))
+
+        assert [version for version, _ in versions.values()] == [0, 0, 0]
+
+    def test_unknown_table(self, db):
+        """Test tables without a counter report version 0 and no write time."""
+        assert TableVersionModel.find_versions(('missing',)) == {'missing': (0, None)}
+
+    def test_bumped_on_save_and_delete(self, db, sample_store):
+        """Test ORM writes bump the counter of the table they touch."""
+        stores, items = TableVersionModel.find_versions(('stores', 'items')).values()
+
+        item = ItemModel('New Item', 1.0, sample_store.id)
+        item.save_to_db()
+        item.delete_from_db()
+
+        versions = TableVersionModel.find_versions(('stores', 'items'))
+        assert versions['stores'] == stores
+        assert versions['items'][0] == items[0] + 2
+
+    def test_unchanged_object_not_bumped(self, db, sample_store):
+        """Test saving an object without changes leaves the counter alone."""
+        version = TableVersionModel.find_versions(('stores',))['stores']
+
+        sample_store.save_to_db()
+
+        assert TableVersionModel.find_versions(('stores',))['stores'] == version
+
+    def test_bumped_by_bulk_statements(self, db, sample_store):
+        """Test INSERT ... ON CONFLICT run outside the flush bumps the counter."""
+        version = TableVersionModel.find_versions(('items',))['items'][0]
+
+        ItemModel.upsert_many([{'name': 'Bulk Item', 'price': 1.0, 'store_id': sample_store.id}])
+
+        assert TableVersionModel.find_versions(('items',))['items'][0] == version + 1
+
+    def test_bumped_once_at_commit(self, db, sample_store):
+        """Test the writes of a transaction bump the counter once, as it commits."""
+        version = TableVersionModel.find_versions(('items',))['items'][0]
+
+        with unit_of_work():
+            ItemModel('First', 1.0, sample_store.id).save_to_db()
+            ItemModel('Second', 2.0, sample_store.id).save_to_db()
+            assert TableVersionModel.find_versions(('items',))['items'][0] == version
+
+        assert TableVersionModel.find_versions(('items',))['items'][0] == version + 1
+
+    def test_bumped_once_with_savepoints(self, db, sample_store, query_counter):
+        """Test savepoints released inside a unit of work do not bump the counter themselves."""
+        store_id = sample_store.id
+        version = TableVersionModel.find_versions(('items',))['items'][0]
+        query_counter.clear()
+
+        with unit_of_work():
+            for name in ('First', 'Second', 'Third'):
+                assert insert_unique(ItemModel(name, 1.0, store_id))
+
+        assert len([statement for statement in query_counter if 'table_versions.version +' in statement]) == 1
+        assert TableVersionModel.find_versions(('items',))['items'][0] == version + 1
+
+    def test_bump_creates_missing_counter(self, db):
+        """Test bumping a table without a counter row creates it, and bumps it from then on."""
+        with db.engine.begin() as connection:
+            TableVersionModel.bump(connection, {'new_table'})
+            TableVersionModel.bump(connection, {'new_table'})
+
+        assert TableVersionModel.find_versions(('new_table',))['new_table'][0] == 2
+
+    def test_bump_without_on_conflict(self, db, monkeypatch):
+        """Test the UPDATE then INSERT fallback for databases without ON CONFLICT."""
+        monkeypatch.setattr(TableVersionModel, '_bump_statement', classmethod(lambda cls, dialect: None))
+        with db.engine.begin() as connection:
+            TableVersionModel.bump(connection, {'new_table'})
+            TableVersionModel.bump(connection, {'new_table', 'items'})
+
+        versions = TableVersionModel.find_versions(('new_table', 'items'))
+        assert (versions['new_table'][0], versions['items'][0]) == (2, 1)
+
+    def test_unread_table_not_bumped(self, db):
+        """Test writes to a table no view is conditional on bump no counter."""
+        version = TableVersionModel.find_versions(('users',))['users']
+
+        UserModel('versionless', 'password').save_to_db()
+
+        assert TableVersionModel.find_versions(('users',))['users'] == version
+
+    def test_rolled_back_with_the_write(self, db, sample_store):
+        """Test a rolled back write leaves the counter unchanged."""
+        version = TableVersionModel.find_versions(('items',))['items']
+
+        db.session.add(ItemModel('Rolled Back', 1.0, sample_store.id))
+        db.session.flush()
+        db.session.rollback()
+
+        assert TableVersionModel.find_versions(('items',))['items'] == version
+
+
+class TestSchema:
+    """Tests for the indexes on the lookup columns and upgrade_schema."""
+
+    LEGACY_DDL = [
+        'CREATE TABLE stores (id INTEGER PRIMARY KEY, name VARCHAR(80))',
+        'CREATE TABLE items (id INTEGER PRIMARY KEY, name VARCHAR(80), price FLOAT, '
+        'store_id INTEGER REFERENCES stores (id))',
+        'CREATE TABLE users (id INTEGER PRIMARY KEY, username VARCHAR(80), password VARCHAR(80))',
+    ]
+
+    @pytest.fixture
+    def legacy_engine(self, tmp_path):
+        from sqlalchemy import create_engine
+        engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+        with engine.begin() as connection:
+            for ddl in self.LEGACY_DDL:
+                connection.exec_driver_sql(ddl)
+        yield engine
+        engine.dispose()
+
+    @staticmethod
+    def indexes(engine, table):
+        from sqlalchemy import inspect
+        from app.search import get_indexes
+        return {i['name']: i for i in get_indexes(inspect(engine), table)}
+
+    def test_lookup_columns_indexed(self, db):
+        """Test the lookup columns have (unique) indexes."""
+        assert self.indexes(db.engine, 'items')['ix_items_name']['unique']
+        assert not self.indexes(db.engine, 'items')['ix_items_store_id']['unique']
+        assert self.indexes(db.engine, 'stores')['ix_stores_name']['unique']
+        assert self.indexes(db.engine, 'users')['ix_users_username']['unique']
+
+    def test_insert_unique(self, db, sample_item, sample_store):
+        """Test a duplicate name is reported, and the session is usable afterwards."""
+        assert insert_unique(ItemModel('Test Item', 1.0, sample_store.id)) is False
+        assert insert_unique(ItemModel('Other Item', 1.0, sample_store.id)) is True
+        assert ItemModel.query.count() == 2
+
+    def test_duplicate_item_name_rejected(self, db, sample_item):
+        """Test the database refuses a second item with the same name."""
+        from sqlalchemy.exc import IntegrityError
+        db.session.add(ItemModel(name='Test Item', price=1.0, store_id=sample_item.store_id))
+        with pytest.raises(IntegrityError):
+            db.session.commit()
+        db.session.rollback()
+
+    def test_upgrade_schema_adds_indexes(self, legacy_engine):
+        """Test upgrading a database created without the indexes."""
+        created = upgrade_schema(legacy_engine)
+
+        assert set(created) == {'ix_items_name', 'ix_items_store_id', 'ix_stores_name', 'ix_users_username',
+                                'ix_items_name_lower', 'items_search'}
+        assert 'ix_items_name' in self.indexes(legacy_engine, 'items')
+        assert upgrade_schema(legacy_engine) == []
+
+    def test_upgrade_schema_no_reflection_warning(self, legacy_engine):
+        """Test reflecting the lower(name) expression index does not warn."""
+        import warnings
+        from sqlalchemy.exc import SAWarning
+        upgrade_schema(legacy_engine)
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', SAWarning)
+            assert upgrade_schema(legacy_engine) == []
+
+    def test_upgrade_schema_indexes_existing_items(self, legacy_engine):
+        """Test the search index added by upgrade_schema covers the items already stored."""
+        from app.search import search_tiers
+        with legacy_engine.begin() as connection:
+            connection.exec_driver_sql("INSERT INTO items (name, price) VALUES ('Old Lamp', 1.0)")
+        upgrade_schema(legacy_engine)
+
+        with legacy_engine.connect() as connection:
+            tiers = [connection.execute(tier).all() for tier in search_tiers('sqlite', 'lamp')]
+        assert [[row.name for row in rows] for rows in tiers] == [[], ['Old Lamp'], []]
+
+    def test_postgresql_prefix_tier_uses_index(self):
+        """Test the PostgreSQL prefix tier filters and sorts by the expression of the lower(name) index."""
+        from sqlalchemy.dialects import postgresql
+        from app.search import search_index_ddl, search_tiers
+
+        assert 'CREATE INDEX ix_items_name_lower ON items (lower(name) COLLATE "C")' in search_index_ddl(
+            postgresql.dialect())
+        sql = str(search_tiers('postgresql', 'ab')[0].compile(dialect=postgresql.dialect()))
+        assert '(lower(items.name) COLLATE "C") >= lower(' in sql
+        assert sql.endswith('ORDER BY lower(items.name) COLLATE "C", items.id')
+
+    def test_widen_column_ddl(self):
+        """Test the statements widening users.password for hashes."""
+        from sqlalchemy.dialects import mssql, postgresql, sqlite
+        column = UserModel.__table__.c.password
+
+        assert (widen_column_ddl(postgresql.dialect(), UserModel.__table__, column)
+                == 'ALTER TABLE users ALTER COLUMN password TYPE VARCHAR(255)')
+        assert (widen_column_ddl(mssql.dialect(), UserModel.__table__, column)
+                == 'ALTER TABLE users ALTER COLUMN password VARCHAR(255)')
+        assert widen_column_ddl(sqlite.dialect(), UserModel.__table__, column) is None
+
+    def test_upgrade_schema_refuses_duplicates(self, legacy_engine):
+        """Test a unique index is not created over duplicate values."""
+        with legacy_engine.begin() as connection:
+            connection.exec_driver_sql("INSERT INTO stores (name) VALUES ('dup'), ('dup')")
+
+        with pytest.raises(SchemaUpgradeError, match='ix_stores_name'):
+            upgrade_schema(legacy_engine)
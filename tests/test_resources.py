@@ -2,11 +2,16 @@
 # -*- coding: utf-8 -*-
 """Tests for API resources/endpoints."""
 
+import gzip
+import hashlib
 import json
+import zlib
 import pytest
 from app.models.user import UserModel
 from app.models.item import ItemModel
 from app.models.store import StoreModel
+from app.util.compression import compress_response
+from app.util.passwords import PasswordWorkers
 
 
 class TestUserRegister:
@@ -67,6 +72,28 @@ class TestUser:
         assert 'access_token' in data
         assert data['access_token'] is not None
 
+    def test_login_token_identity(self, app, client, db, sample_user):
+        """Test the token carries the user id and username but no password."""
+        from flask_jwt_extended import decode_token
+        response = client.post('/user',
+            data=json.dumps({'username': 'sampleuser', 'password': 'samplepass'}),
+            content_type='application/json')
+
+        claims = decode_token(json.loads(response.data)['access_token'])
+        assert claims['sub'] == str(sample_user.id)
+        assert claims['username'] == 'sampleuser'
+        assert 'samplepass' not in json.dumps(claims)
+
+    def test_legacy_token_identity(self, app, client, db, sample_user):
+        """Test tokens whose identity is a serialized user are still accepted."""
+        from flask_jwt_extended import create_access_token
+        token = create_access_token(identity=json.dumps({'id': sample_user.id, 'username': 'sampleuser'}))
+
+        response = client.get('/user', headers={'Authorization': f'Bearer {token}'})
+
+        assert response.status_code == 200
+        assert json.loads(response.data)['id'] == sample_user.id
+
     def test_login_wrong_password(self, client, db, sample_user):
         """Test login with wrong password."""
         response = client.post('/user',
@@ -85,6 +112,55 @@ class TestUser:
 
         assert response.status_code == 401
 
+    def login(self, client, password='samplepass'):
+        return client.post('/user', data=json.dumps({'username': 'sampleuser', 'password': password}),
+                           content_type='application/json')
+
+    def test_login_rehashes_legacy_password(self, client, db, sample_user):
+        """Test a plaintext password is replaced by a hash at the next login."""
+        sample_user.password = 'samplepass'
+        db.session.commit()
+
+        assert self.login(client).status_code == 200
+
+        db.session.refresh(sample_user)
+        assert sample_user.password.startswith('pbkdf2:sha256:1000$')
+        assert self.login(client).status_code == 200
+
+    def test_login_rehashes_on_method_change(self, app, client, db, sample_user):
+        """Test hashes are upgraded to new parameters at login, not before."""
+        app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:2000'
+
+        assert self.login(client, 'wrongpass').status_code == 401
+        db.session.refresh(sample_user)
+        assert sample_user.password.startswith('pbkdf2:sha256:1000$')
+
+        assert self.login(client).status_code == 200
+        db.session.refresh(sample_user)
+        assert sample_user.password.startswith('pbkdf2:sha256:2000$')
+
+    def test_login_on_password_workers(self, app, client, db, sample_user):
+        """Test logins verified on the password thread pool."""
+        app.extensions['password_workers'] = PasswordWorkers(2, 2)
+
+        assert self.login(client).status_code == 200
+        assert self.login(client, 'wrongpass').status_code == 401
+
+        app.extensions.pop('password_workers').shutdown()
+
+    def test_login_password_workers_busy(self, app, client, db, sample_user):
+        """Test logins are shed with a 503 while the password workers are saturated."""
+        workers = app.extensions['password_workers'] = PasswordWorkers(1, 0)
+        workers._slots.acquire()
+
+        response = self.login(client)
+
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '1'
+        workers._slots.release()
+        assert self.login(client).status_code == 200
+        app.extensions.pop('password_workers').shutdown()
+
     def test_get_user_authenticated(self, client, db, auth_headers):
         """Test getting user info when authenticated."""
         response = client.get('/user', headers=auth_headers)
@@ -93,6 +169,38 @@ class TestUser:
         data = json.loads(response.data)
         assert 'username' in data or 'id' in data
 
+    def test_user_lookup_cached(self, client, db, auth_headers, query_counter):
+        """Test authenticated requests reuse the cached user row."""
+        client.get('/user', headers=auth_headers)
+        query_counter.clear()
+
+        response = client.get('/user', headers=auth_headers)
+
+        assert response.status_code == 200
+        assert not [q for q in query_counter if 'users' in q]
+
+    def test_user_lookup_invalidated_on_change(self, client, db, auth_headers):
+        """Test a changed user is reloaded on the next request."""
+        client.get('/user', headers=auth_headers)
+        user = UserModel.find_by_username('testuser')
+        user.username = 'renamed'
+        user.save_to_db()
+
+        data = json.loads(client.get('/user', headers=auth_headers).data)
+        assert data['username'] == 'renamed'
+
+    def test_user_lookup_trust_claims(self, app, client, db, auth_headers, query_counter, monkeypatch):
+        """Test trusted token claims skip the user query entirely."""
+        monkeypatch.setitem(app.config, 'JWT_TRUST_CLAIMS', True)
+        app.extensions['cache'].clear()
+        query_counter.clear()
+
+        response = client.get('/user', headers=auth_headers)
+
+        assert response.status_code == 200
+        assert json.loads(response.data)['username'] == 'testuser'
+        assert query_counter == []
+
     def test_get_user_unauthenticated(self, client, db):
         """Test getting user info without authentication."""
         response = client.get('/user')
@@ -193,6 +301,86 @@ class TestStoreList:
         assert 'Test Store' in store_names
         assert 'Store 2' in store_names
 
+    def test_get_all_stores_constant_queries(self, client, db, query_counter):
+        """Test listing stores issues the same number of queries regardless of size."""
+        def count_queries():
+            query_counter.clear()
+            response = client.get('/stores')
+            assert response.status_code == 200
+            return len(query_counter)
+
+        StoreModel('Store 1').save_to_db()
+        small = count_queries()
+
+        for i in range(2, 12):
+            store = StoreModel(f'Store {i}')
+            store.save_to_db()
+            for j in range(3):
+                ItemModel(f'Item {i}-{j}', 1.0, store.id).save_to_db()
+        large = count_queries()
+
+        # The table versions for the ETag, the stores page and their items
+        assert small == large == 3
+        data = json.loads(client.get('/stores').data)
+        assert len(data['stores']) == 11
+        assert sum(len(s['items']) for s in data['stores']) == 30
+
+    def test_get_stores_matches_model_json(self, client, db, sample_store, sample_item):
+        """Test the encoded stores match StoreModel.json()."""
+        StoreModel('Ünïcode').save_to_db()
+
+        data = json.loads(client.get('/stores').data)
+
+        assert data['stores'] == [store.json() for store in StoreModel.query.order_by(StoreModel.id)]
+
+    def test_get_stores_paginated(self, client, db):
+        """Test paging through stores with limit and after."""
+        for i in range(5):
+            StoreModel(f'Store {i}').save_to_db()
+
+        response = client.get('/stores?limit=2')
+        data = json.loads(response.data)
+        assert [s['name'] for s in data['stores']] == ['Store 0', 'Store 1']
+        assert data['next_cursor'] == data['stores'][-1]['id']
+        assert 'rel="next"' in response.headers['Link']
+
+        names = []
+        url = '/stores?limit=2'
+        while url:
+            data = json.loads(client.get(url).data)
+            names.extend(s['name'] for s in data['stores'])
+            url = data['next']
+        assert names == [f'Store {i}' for i in range(5)]
+
+    def test_get_stores_name_prefix(self, client, db):
+        """Test filtering stores by name prefix."""
+        StoreModel('Alpha').save_to_db()
+        StoreModel('Beta').save_to_db()
+        StoreModel('Al_pha').save_to_db()
+
+        data = json.loads(client.get('/stores?name_prefix=Al').data)
+        assert sorted(s['name'] for s in data['stores']) == ['Al_pha', 'Alpha']
+        data = json.loads(client.get('/stores?name_prefix=Al_').data)
+        assert [s['name'] for s in data['stores']] == ['Al_pha']
+
+    def test_get_stores_stream(self, client, db, sample_item, sample_store):
+        """Test streaming stores as NDJSON with their items."""
+        StoreModel('Store 2').save_to_db()
+
+        response = client.get('/stores', headers={'Accept': 'application/x-ndjson'})
+
+        assert response.status_code == 200
+        assert response.mimetype == 'application/x-ndjson'
+        lines = [json.loads(line) for line in response.data.decode().splitlines()]
+        assert [s['name'] for s in lines] == ['Test Store', 'Store 2']
+        assert lines[0]['items'][0]['name'] == sample_item.name
+        assert lines[1]['items'] == []
+
+    def test_get_stores_invalid_limit(self, client, db):
+        """Test an out of range limit is rejected."""
+        assert client.get('/stores?limit=0').status_code == 400
+        assert client.get('/stores?limit=abc').status_code == 400
+
 
 class TestItem:
     """Tests for Item resource."""
@@ -325,6 +513,73 @@ class TestItem:
 class TestItemList:
     """Tests for ItemList resource."""
 
+    def test_bulk_upsert(self, client, db, sample_item, sample_store, auth_headers, query_counter):
+        """Test creating and updating items in one request."""
+        ItemModel.find_by_name(sample_item.name)  # warm the cache
+        rows = [
+            {'name': sample_item.name, 'price': 1.5, 'store_id': sample_store.id},
+            {'name': 'Bulk 1', 'price': '2.5', 'store_id': sample_store.id},
+            {'name': 'Bulk 2', 'price': 3, 'store_id': str(sample_store.id)},
+        ]
+        query_counter.clear()
+
+        response = client.put('/items', data=json.dumps(rows), headers=auth_headers)
+
+        assert response.status_code == 200
+        results = json.loads(response.data)['results']
+        assert [r['status'] for r in results] == ['updated', 'created', 'created']
+        assert len([q for q in query_counter if q.lstrip().upper().startswith('INSERT INTO ITEMS')]) == 1
+        assert ItemModel.find_by_name(sample_item.name).price == 1.5
+        assert ItemModel.find_by_name('Bulk 1').price == 2.5
+        assert ItemModel.find_by_name('Bulk 2').store_id == sample_store.id
+
+    def test_bulk_upsert_ndjson(self, client, db, sample_store, auth_headers):
+        """Test a bulk request sent as NDJSON."""
+        body = '\n'.join(json.dumps({'name': f'Line {i}', 'price': i, 'store_id': sample_store.id})
+                         for i in range(3))
+        headers = dict(auth_headers, **{'Content-Type': 'application/x-ndjson'})
+
+        response = client.put('/items', data=body + '\n', headers=headers)
+
+        assert response.status_code == 200
+        assert ItemModel.query.count() == 3
+
+    def test_bulk_upsert_reports_invalid_rows(self, client, db, sample_store, auth_headers):
+        """Test invalid rows are reported and the valid ones still applied."""
+        rows = [
+            {'name': 'Good', 'price': 1, 'store_id': sample_store.id},
+            {'name': 'No price', 'store_id': sample_store.id},
+            {'name': 'Bad price', 'price': 'cheap', 'store_id': sample_store.id},
+            {'price': 1, 'store_id': sample_store.id},
+            {'name': 'Good', 'price': 2, 'store_id': sample_store.id},
+            'not an object',
+        ]
+
+        response = client.put('/items', data=json.dumps({'items': rows}), headers=auth_headers)
+
+        results = json.loads(response.data)['results']
+        assert [r['status'] for r in results] == ['created', 'invalid', 'invalid', 'invalid', 'invalid', 'invalid']
+        assert results[4]['message'] == 'Duplicate of row 0'
+        assert ItemModel.find_by_name('Good').price == 1
+
+    def test_bulk_upsert_nothing_valid(self, client, db, auth_headers):
+        """Test a body without valid rows is rejected."""
+        assert client.put('/items', data=json.dumps([{'name': 'x'}]), headers=auth_headers).status_code == 400
+        assert client.put('/items', data=json.dumps({'name': 'x'}), headers=auth_headers).status_code == 400
+
+    def test_bulk_upsert_too_large(self, app, client, db, auth_headers, monkeypatch):
+        """Test bodies over BULK_MAX_ROWS are refused."""
+        monkeypatch.setitem(app.config, 'BULK_MAX_ROWS', 2)
+        rows = [{'name': f'n{i}', 'price': 1, 'store_id': 1} for i in range(3)]
+
+        assert client.put('/items', data=json.dumps(rows), headers=auth_headers).status_code == 413
+
+    def test_bulk_upsert_unauthenticated(self, client, db):
+        """Test bulk upsert without authentication."""
+        response = client.put('/items', data='[]', content_type='application/json')
+
+        assert response.status_code == 401
+
     def test_get_all_items_empty(self, client, db, auth_headers):
         """Test getting all items when none exist."""
         response = client.get('/items', headers=auth_headers)
@@ -350,8 +605,1175 @@ class TestItemList:
         assert 'Test Item' in item_names
         assert 'Item 2' in item_names
 
+    def test_get_items_matches_model_json(self, client, db, sample_store, auth_headers):
+        """Test the column fast path returns the same objects as ItemModel.json()."""
+        ItemModel('Ünïcode "quoted"', 0.1, sample_store.id).save_to_db()
+        ItemModel('No store', 2.0, None).save_to_db()
+
+        data = json.loads(client.get('/items', headers=auth_headers).data)
+
+        assert data['items'] == [item.json() for item in ItemModel.query.order_by(ItemModel.id)]
+
+    def test_get_items_paginated(self, client, db, sample_store, auth_headers):
+        """Test paging through items with limit and after."""
+        for i in range(5):
+            ItemModel(f'Item {i}', float(i), sample_store.id).save_to_db()
+
+        names = []
+        url = '/items?limit=2'
+        pages = 0
+        while url:
+            response = client.get(url, headers=auth_headers)
+            assert response.status_code == 200
+            data = json.loads(response.data)
+            assert len(data['items']) <= 2
+            names.extend(i['name'] for i in data['items'])
+            url = data['next']
+            pages += 1
+        assert names == [f'Item {i}' for i in range(5)]
+        assert pages == 3
+
+    def test_get_items_last_page_has_no_next(self, client, db, sample_item, auth_headers):
+        """Test a page that holds the rest of the rows has no next link."""
+        response = client.get('/items?limit=1', headers=auth_headers)
+        data = json.loads(response.data)
+        assert len(data['items']) == 1
+        assert data['next'] is None
+        assert data['next_cursor'] is None
+        assert 'Link' not in response.headers
+
+    def test_get_items_filters(self, client, db, sample_store, auth_headers):
+        """Test filtering items by store, price range and name prefix."""
+        other = StoreModel('Other Store')
+        other.save_to_db()
+        ItemModel('Apple', 1.0, sample_store.id).save_to_db()
+        ItemModel('Apricot', 5.0, sample_store.id).save_to_db()
+        ItemModel('Banana', 3.0, sample_store.id).save_to_db()
+        ItemModel('Avocado', 4.0, other.id).save_to_db()
+
+        def names(query):
+            response = client.get(f'/items?{query}', headers=auth_headers)
+            return sorted(i['name'] for i in json.loads(response.data)['items'])
+
+        assert names(f'store_id={other.id}') == ['Avocado']
+        assert names('min_price=3&max_price=4.5') == ['Avocado', 'Banana']
+        assert names('name_prefix=Ap') == ['Apple', 'Apricot']
+        assert names(f'name_prefix=A&store_id={sample_store.id}&max_price=2') == ['Apple']
+
+    def test_get_items_stream(self, client, db, sample_store, auth_headers):
+        """Test streaming every item as NDJSON, ignoring the page size."""
+        for i in range(5):
+            ItemModel(f'Item {i}', float(i), sample_store.id).save_to_db()
+
+        response = client.get('/items?stream=1&limit=2&min_price=1', headers=auth_headers)
+
+        assert response.status_code == 200
+        assert response.mimetype == 'application/x-ndjson'
+        lines = [json.loads(line) for line in response.data.decode().splitlines()]
+        assert [i['name'] for i in lines] == ['Item 1', 'Item 2', 'Item 3', 'Item 4']
+
+    def test_get_items_stream_accept_header(self, client, db, sample_item, auth_headers):
+        """Test the NDJSON export is selected through the Accept header."""
+        headers = dict(auth_headers, Accept='application/x-ndjson')
+        response = client.get('/items', headers=headers)
+
+        assert response.mimetype == 'application/x-ndjson'
+        assert json.loads(response.data) == sample_item.json()
+
+    def test_get_items_invalid_filter(self, client, db, auth_headers):
+        """Test invalid paging and filter values are rejected."""
+        assert client.get('/items?min_price=cheap', headers=auth_headers).status_code == 400
+        assert client.get('/items?limit=5000', headers=auth_headers).status_code == 400
+        assert client.get('/items?after=x', headers=auth_headers).status_code == 400
+
     def test_get_all_items_unauthenticated(self, client, db):
         """Test getting all items without authentication."""
         response = client.get('/items')
 
         assert response.status_code == 401
+
+
+class TestItemSearch:
+    """Tests for GET /items/search."""
+
+    @pytest.fixture
+    def catalog(self, db, sample_store):
+        for name in ('Desk Lamp', 'Lamp Shade', 'Floor Lamp Stand', 'Office Chair', 'lampshade_50%'):
+            ItemModel(name, 10.0, sample_store.id).save_to_db()
+
+    @staticmethod
+    def search(client, auth_headers, query):
+        response = client.get(f'/items/search?{query}', headers=auth_headers)
+        return response, json.loads(response.data)
+
+    def test_substring_prefix_first(self, client, catalog, auth_headers, query_counter):
+        """Test names containing the query match, case insensitive, those starting with it first."""
+        response, data = self.search(client, auth_headers, 'q=LAMP')
+
+        assert response.status_code == 200
+        assert data['match'] == 'substring'
+        assert [item['name'] for item in data['items']] == ['Lamp Shade', 'lampshade_50%', 'Desk Lamp',
+                                                            'Floor Lamp Stand']
+        assert data['items'][0] == ItemModel.find_by_name('Lamp Shade').json()
+        assert any('MATCH' in statement for statement in query_counter)
+
+    def test_inner_matches_last(self, client, catalog, auth_headers):
+        """Test names containing the query inside a word come after those with a word starting with it."""
+        _, data = self.search(client, auth_headers, 'q=shade')
+        assert [item['name'] for item in data['items']] == ['Lamp Shade', 'lampshade_50%']
+
+    def test_fuzzy_fallback(self, client, catalog, auth_headers):
+        """Test a query without substring matches finds names sharing trigrams, the closest first."""
+        _, data = self.search(client, auth_headers, 'q=desk lammp')
+
+        assert data['match'] == 'fuzzy'
+        assert data['items'][0]['name'] == 'Desk Lamp'
+
+    def test_fuzzy_candidates_capped(self, client, catalog, auth_headers, monkeypatch):
+        """Test only the names sharing the rarest trigrams of the query are ranked."""
+        monkeypatch.setattr('app.search.FUZZY_CANDIDATES', 1)
+        _, data = self.search(client, auth_headers, 'q=offise chare')
+
+        assert [item['name'] for item in data['items']] == ['Office Chair']
+
+    def test_no_match(self, client, catalog, auth_headers):
+        """Test a query sharing nothing with any name."""
+        _, data = self.search(client, auth_headers, 'q=xyzzy')
+
+        assert data['items'] == []
+        assert data['next_cursor'] is None
+
+    def test_short_query_prefix(self, client, catalog, auth_headers):
+        """Test one or two characters match name prefixes."""
+        _, data = self.search(client, auth_headers, 'q=la')
+
+        assert data['match'] == 'prefix'
+        assert [item['name'] for item in data['items']] == ['Lamp Shade', 'lampshade_50%']
+
+    def test_special_characters(self, client, catalog, auth_headers):
+        """Test quotes and LIKE wildcards are searched literally."""
+        _, data = self.search(client, auth_headers, 'q=50%25')
+        assert [item['name'] for item in data['items']] == ['lampshade_50%']
+
+        response, data = self.search(client, auth_headers, 'q=a"b')
+        assert response.status_code == 200
+
+    def test_paginated(self, client, catalog, auth_headers):
+        """Test `after` counts the results already returned and the last page has no next link."""
+        response, data = self.search(client, auth_headers, 'q=lamp&limit=3&fields=name')
+
+        assert data['items'] == [{'name': 'Lamp Shade'}, {'name': 'lampshade_50%'}, {'name': 'Desk Lamp'}]
+        assert data['next_cursor'] == 3
+        assert 'rel="next"' in response.headers['Link']
+        _, data = self.search(client, auth_headers, data['next'].partition('?')[2])
+        assert data['match'] == 'substring'
+        assert data['items'] == [{'name': 'Floor Lamp Stand'}]
+        assert data['next'] is None
+
+        # Past the first tier, and past every match
+        _, data = self.search(client, auth_headers, 'q=lamp&after=2&limit=1')
+        assert [item['name'] for item in data['items']] == ['Desk Lamp']
+        _, data = self.search(client, auth_headers, 'q=lamp&after=10')
+        assert (data['items'], data['match']) == ([], 'substring')
+
+    def test_index_follows_writes(self, client, db, catalog, auth_headers):
+        """Test new, renamed and deleted items are searched as they are now."""
+        client.delete('/item/Desk Lamp', headers=auth_headers)
+        item = ItemModel.find_by_name('Office Chair')
+        item.name = 'Office Lamp'
+        item.save_to_db()
+        client.post('/item/Reading Lamp', json={'price': 5.0, 'store_id': item.store_id}, headers=auth_headers)
+
+        _, data = self.search(client, auth_headers, 'q=lamp&limit=10')
+        names = {item['name'] for item in data['items']}
+        assert names == {'Lamp Shade', 'lampshade_50%', 'Floor Lamp Stand', 'Office Lamp', 'Reading Lamp'}
+        assert self.search(client, auth_headers, 'q=chair')[1]['match'] == 'fuzzy'
+
+    def test_like_fallback(self, client, catalog, auth_headers, monkeypatch):
+        """Test databases without a search index get the same substring matches from LIKE."""
+        _, indexed = self.search(client, auth_headers, 'q=lamp')
+        monkeypatch.setattr('app.resources.item.search_backend', lambda connection: 'like')
+        _, data = self.search(client, auth_headers, 'q=lamp')
+
+        assert data['items'] == indexed['items']
+
+    @pytest.mark.parametrize('query', ['', 'q=', 'q=%20', 'q=lamp&after=-1', 'q=lamp&fields=owner'])
+    def test_invalid(self, client, db, auth_headers, query):
+        """Test a missing query and invalid parameters are rejected."""
+        response, data = self.search(client, auth_headers, query)
+
+        assert response.status_code == 400
+        assert 'message' in data
+
+    def test_unauthenticated(self, client, db):
+        """Test searching requires a token."""
+        assert client.get('/items/search?q=lamp').status_code == 401
+
+
+class TestStoreSummary:
+    """Tests for the per-store item count and price aggregates."""
+
+    @pytest.fixture
+    def stores(self, db):
+        for name, prices in (('a', [1.0, 2.0, 6.0]), ('b', []), ('c', [10.0])):
+            store = StoreModel(name)
+            store.save_to_db()
+            for index, price in enumerate(prices):
+                ItemModel(f'{name}-{index}', price, store.id).save_to_db()
+
+    def test_store_summary(self, client, stores, query_counter):
+        """Test one GROUP BY query gives the aggregates of a store."""
+        response = client.get('/store/a/summary')
+
+        assert response.status_code == 200
+        assert json.loads(response.data) == {'id': 1, 'name': 'a', 'item_count': 3,
+                                             'min_price': 1.0, 'max_price': 6.0, 'avg_price': 3.0}
+        # table versions for the ETag, then the summary
+        assert len(query_counter) == 2
+        assert 'GROUP BY' in query_counter[1]
+
+    def test_store_without_items(self, client, stores):
+        """Test a store without items has a zero count and no prices."""
+        data = json.loads(client.get('/store/b/summary').data)
+
+        assert data == {'id': 2, 'name': 'b', 'item_count': 0, 'min_price': None, 'max_price': None,
+                        'avg_price': None}
+
+    def test_store_summary_not_found(self, client, db):
+        """Test a missing store gives 404."""
+        response = client.get('/store/missing/summary')
+
+        assert response.status_code == 404
+        assert json.loads(response.data)['message'] == 'Store not found'
+
+    def test_stores_summary(self, client, stores, query_counter):
+        """Test the summaries of every store come from a single query, without items."""
+        data = json.loads(client.get('/stores/summary').data)
+
+        assert [(s['name'], s['item_count'], s['max_price']) for s in data['stores']] == [
+            ('a', 3, 6.0), ('b', 0, None), ('c', 1, 10.0)]
+        assert data['next'] is None
+        assert len(query_counter) == 2
+
+    def test_stores_summary_paginated(self, client, stores):
+        """Test keyset pagination and the name prefix filter."""
+        response = client.get('/stores/summary?limit=2')
+        data = json.loads(response.data)
+
+        assert [s['name'] for s in data['stores']] == ['a', 'b']
+        assert data['next_cursor'] == 2
+        assert 'rel="next"' in response.headers['Link']
+        data = json.loads(client.get(data['next']).data)
+        assert [s['name'] for s in data['stores']] == ['c']
+
+        data = json.loads(client.get('/stores/summary?name_prefix=c').data)
+        assert [s['name'] for s in data['stores']] == ['c']
+
+    def test_summary_changes_with_items(self, client, stores, auth_headers):
+        """Test the aggregates and their ETag follow item writes."""
+        etag = client.get('/store/c/summary').headers['ETag']
+        client.put('/item/c-1', data=json.dumps({'price': 20.0, 'store_id': 3}), headers=auth_headers)
+
+        response = client.get('/store/c/summary', headers={'If-None-Match': etag})
+
+        assert response.status_code == 200
+        assert json.loads(response.data)['avg_price'] == 15.0
+
+    def test_invalid_limit(self, client, db):
+        """Test invalid paging arguments are rejected."""
+        assert client.get('/stores/summary?limit=0').status_code == 400
+
+
+class TestSparseFields:
+    """Tests for the `fields` and `include` query parameters."""
+
+    def test_items_fields(self, client, db, sample_item, auth_headers, query_counter):
+        """Test only the requested item columns are selected and returned."""
+        response = client.get('/items?fields=name,price', headers=auth_headers)
+
+        assert response.status_code == 200
+        assert json.loads(response.data)['items'] == [{'name': 'Test Item', 'price': 19.99}]
+        assert 'items.store_id' not in query_counter[-1]
+
+    def test_items_fields_stream(self, client, db, sample_item, auth_headers):
+        """Test the NDJSON stream writes the requested fields only."""
+        response = client.get('/items?stream=1&fields=store_id', headers=auth_headers)
+
+        assert [json.loads(line) for line in response.data.splitlines()] == [{'store_id': sample_item.store_id}]
+
+    def test_item_fields(self, client, db, sample_item, auth_headers):
+        """Test a single item narrowed to the requested fields."""
+        response = client.get('/item/Test Item?fields=price', headers=auth_headers)
+
+        assert json.loads(response.data) == {'price': 19.99}
+
+    def test_stores_without_items(self, client, db, sample_store, sample_item, query_counter):
+        """Test leaving items out of the fields does not query them."""
+        data = json.loads(client.get('/stores?fields=name').data)
+
+        assert data['stores'] == [{'name': 'Test Store'}]
+        assert not any('FROM items' in statement for statement in query_counter)
+
+    def test_stores_item_fields(self, client, db, sample_store, sample_item):
+        """Test `items.<field>` narrows the embedded items, and `include` adds all of them."""
+        data = json.loads(client.get('/stores?fields=name,items.price').data)
+        assert data['stores'] == [{'name': 'Test Store', 'items': [{'price': 19.99}]}]
+
+        data = json.loads(client.get('/stores?fields=id&include=items').data)
+        assert data['stores'] == [{'id': sample_store.id, 'items': [sample_item.json()]}]
+
+    def test_store_fields(self, client, db, sample_store, sample_item):
+        """Test a single store narrowed to the requested fields."""
+        data = json.loads(client.get('/store/Test Store?fields=id,name').data)
+
+        assert data == {'id': sample_store.id, 'name': 'Test Store'}
+
+    def test_default_unchanged(self, client, db, sample_store, sample_item):
+        """Test without `fields` every field is returned."""
+        data = json.loads(client.get('/stores').data)
+
+        assert data['stores'] == [sample_store.json()]
+
+    @pytest.mark.parametrize('path', ['/stores?fields=owner', '/stores?fields=items.owner',
+                                      '/stores?include=owner', '/stores?fields=,', '/store/Test Store?fields=owner',
+                                      '/items?fields=items', '/items?include=store'])
+    def test_unknown_field(self, client, db, sample_store, auth_headers, path):
+        """Test unknown fields and relations are rejected."""
+        response = client.get(path, headers=auth_headers)
+
+        assert response.status_code == 400
+        assert 'message' in json.loads(response.data)
+
+
+class TestConditionalGet:
+    """Tests for ETag and Last-Modified handling on the catalog reads."""
+
+    def test_etag_and_last_modified(self, client, db, sample_store):
+        """Test listings carry a strong ETag and Last-Modified."""
+        response = client.get('/stores')
+
+        assert response.status_code == 200
+        etag, weak = response.get_etag()
+        assert etag and not weak
+        assert response.last_modified is not None
+        assert response.cache_control.no_cache
+
+    def test_not_modified(self, client, db, sample_store, query_counter):
+        """Test a matching If-None-Match gets a 304 without loading any row."""
+        etag = client.get('/store/Test Store').headers['ETag']
+        query_counter.clear()
+
+        response = client.get('/store/Test Store', headers={'If-None-Match': etag})
+
+        assert response.status_code == 304
+        assert response.data == b''
+        assert response.headers['ETag'] == etag
+        assert {'Accept', 'Accept-Encoding'} <= set(response.vary)
+        assert len(query_counter) == 1
+        assert 'table_versions' in query_counter[0]
+
+    def test_if_modified_since(self, client, db, sample_store):
+        """Test If-Modified-Since is honored when no ETag is sent."""
+        last_modified = client.get('/stores').headers['Last-Modified']
+
+        response = client.get('/stores', headers={'If-Modified-Since': last_modified})
+
+        assert response.status_code == 304
+
+    def test_changed_after_write(self, client, db, sample_store, sample_item, auth_headers):
+        """Test writing an item changes the ETag of items and stores."""
+        items_etag = client.get('/items', headers=auth_headers).headers['ETag']
+        store_etag = client.get('/store/Test Store').headers['ETag']
+
+        client.put('/item/Test Item', data=json.dumps({'price': 5.0, 'store_id': sample_store.id}),
+                   content_type='application/json', headers=auth_headers)
+
+        response = client.get('/items', headers=dict(auth_headers, **{'If-None-Match': items_etag}))
+        assert response.status_code == 200
+        assert json.loads(response.data)['items'][0]['price'] == 5.0
+        response = client.get('/store/Test Store', headers={'If-None-Match': store_etag})
+        assert response.status_code == 200
+        assert response.headers['ETag'] != store_etag
+
+    def test_etag_depends_on_query(self, client, db, sample_store):
+        """Test different filters and pages get different ETags."""
+        first = client.get('/stores').headers['ETag']
+
+        response = client.get('/stores?name_prefix=Test', headers={'If-None-Match': first})
+
+        assert response.status_code == 200
+        assert response.headers['ETag'] != first
+
+    def test_not_found_has_no_etag(self, client, db):
+        """Test error responses are not tagged."""
+        response = client.get('/store/Missing')
+
+        assert response.status_code == 404
+        assert 'ETag' not in response.headers
+
+    def test_disabled(self, app, client, db, sample_store):
+        """Test CONDITIONAL_GET = False turns the headers off."""
+        app.config['CONDITIONAL_GET'] = False
+
+        response = client.get('/stores')
+
+        assert response.status_code == 200
+        assert 'ETag' not in response.headers
+
+
+class TestCompression:
+    """Tests for negotiated response compression."""
+
+    @pytest.fixture
+    def many_stores(self, db):
+        """Enough stores for /stores to exceed the compression threshold."""
+        db.session.add_all(StoreModel(f'Store {i}') for i in range(150))
+        db.session.commit()
+
+    def test_gzip(self, client, many_stores):
+        """Test large JSON responses are gzipped for clients accepting it."""
+        plain = client.get('/stores')
+        response = client.get('/stores', headers={'Accept-Encoding': 'gzip, deflate'})
+
+        assert response.status_code == 200
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert 'Accept-Encoding' in response.headers['Vary']
+        assert int(response.headers['Content-Length']) == len(response.data) < len(plain.data)
+        assert gzip.decompress(response.data) == plain.data
+
+    def test_deflate(self, client, many_stores):
+        """Test gzip refused with q=0 falls back to deflate."""
+        response = client.get('/stores', headers={'Accept-Encoding': 'gzip;q=0, deflate'})
+
+        assert response.headers['Content-Encoding'] == 'deflate'
+        assert json.loads(zlib.decompress(response.data))['stores']
+
+    def test_identity(self, client, many_stores):
+        """Test clients without Accept-Encoding get the body as it is."""
+        response = client.get('/stores')
+
+        assert 'Content-Encoding' not in response.headers
+        assert 'Accept-Encoding' in response.headers['Vary']
+        assert json.loads(response.data)['stores']
+
+    def test_below_threshold(self, client, db, sample_store):
+        """Test small bodies are not compressed."""
+        response = client.get('/store/Test Store', headers={'Accept-Encoding': 'gzip'})
+
+        assert 'Content-Encoding' not in response.headers
+        assert json.loads(response.data)['name'] == 'Test Store'
+
+    def test_stream(self, client, db, sample_store, auth_headers):
+        """Test NDJSON exports are compressed while streaming."""
+        ItemModel.upsert_many([{'name': f'Item {i}', 'price': 1.0, 'store_id': sample_store.id}
+                               for i in range(100)])
+
+        response = client.get('/items?stream=1', headers=dict(auth_headers, **{'Accept-Encoding': 'gzip'}))
+
+        assert response.is_streamed
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert 'Content-Length' not in response.headers
+        lines = gzip.decompress(response.data).decode().splitlines()
+        assert len(lines) == 100
+
+    def test_etag_weakened(self, client, many_stores):
+        """Test compressed responses carry a weak ETag that still validates."""
+        response = client.get('/stores', headers={'Accept-Encoding': 'gzip'})
+        etag, weak = response.get_etag()
+        assert weak
+
+        response = client.get('/stores', headers={'Accept-Encoding': 'gzip',
+                                                  'If-None-Match': response.headers['ETag']})
+
+        assert response.status_code == 304
+
+    def test_cached_body_reused(self, client, many_stores, query_counter):
+        """Test a payload compressed once is served again without loading rows."""
+        first = client.get('/stores', headers={'Accept-Encoding': 'gzip'})
+        query_counter.clear()
+
+        second = client.get('/stores', headers={'Accept-Encoding': 'gzip'})
+
+        assert second.data == first.data
+        assert second.headers['Content-Encoding'] == 'gzip'
+        assert second.headers['ETag'] == first.headers['ETag']
+        assert second.headers['Link'] == first.headers['Link']
+        assert len(query_counter) == 1
+
+    def test_cached_body_invalidated(self, client, many_stores):
+        """Test a write makes the next response compress fresh rows."""
+        client.get('/stores', headers={'Accept-Encoding': 'gzip'})
+        StoreModel('Store 00').save_to_db()
+
+        response = client.get('/stores?limit=1000', headers={'Accept-Encoding': 'gzip'})
+
+        names = [store['name'] for store in json.loads(gzip.decompress(response.data))['stores']]
+        assert 'Store 00' in names
+
+    def test_disabled(self):
+        """Test COMPRESS_ENABLED = False leaves responses alone."""
+        from app.app import create_app
+
+        flask_app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',
+                                'COMPRESS_ENABLED': False})
+
+        assert 'compression_cache' not in flask_app.extensions
+        assert compress_response not in flask_app.after_request_funcs[None]
+
+
+class TestAsyncReads:
+    """Tests for the async read endpoints served by app/asgi.py."""
+
+    @pytest.fixture
+    def asgi_app(self, tmp_path):
+        """An ASGI app on a SQLite file shared by the sync and async engines."""
+        pytest.importorskip('aiosqlite')
+        pytest.importorskip('asgiref')
+        from sqlalchemy.pool import NullPool
+        from app.asgi import create_asgi_app
+        from app.db import db as _db
+
+        asgi_app = create_asgi_app({
+            'TESTING': True,
+            'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'async.db'}",
+            'SQLALCHEMY_ASYNC_ENGINE_OPTIONS': {'poolclass': NullPool},
+            'JWT_SECRET_KEY': 'test-secret-key',
+        })
+        with asgi_app.flask_app.app_context():
+            _db.create_all()
+            store = StoreModel('Async Store')
+            store.save_to_db()
+            for i in range(3):
+                ItemModel(f'Async Item {i}', 1.5 + i, store.id).save_to_db()
+            yield asgi_app
+            _db.session.remove()
+            _db.drop_all()
+
+    @pytest.fixture
+    def token_headers(self, asgi_app):
+        from app.auth import create_user_token
+
+        user = UserModel(username='asyncuser', password='asyncpass')
+        user.save_to_db()
+        return {'Authorization': f'Bearer {create_user_token(user)}'}
+
+    @staticmethod
+    def request(asgi_app, path, method='GET', headers=None, body=b''):
+        """Send one request through the ASGI interface and return (status, headers, body)."""
+        import asyncio
+
+        path, _, query = path.partition('?')
+        scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query.encode(),
+                 'headers': [(key.lower().encode(), value.encode()) for key, value in (headers or {}).items()],
+                 'http_version': '1.1', 'scheme': 'http', 'server': ('localhost', 80),
+                 'client': ('127.0.0.1', 1234), 'root_path': ''}
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        asyncio.run(asgi_app(scope, receive, send))
+        headers = {key.decode(): value.decode() for key, value in messages[0]['headers']}
+        return messages[0]['status'], headers, b''.join(m.get('body', b'') for m in messages[1:])
+
+    def test_get_stores_matches_sync(self, asgi_app):
+        """Test the async stores listing returns what the sync view does."""
+        status, headers, body = self.request(asgi_app, '/stores')
+
+        assert status == 200
+        assert body == asgi_app.flask_app.test_client().get('/stores').data
+        assert len(json.loads(body)['stores'][0]['items']) == 3
+
+    def test_get_store(self, asgi_app):
+        """Test fetching one store and a missing one."""
+        status, _, body = self.request(asgi_app, '/store/Async Store')
+        assert status == 200
+        assert body == asgi_app.flask_app.test_client().get('/store/Async Store').data
+
+        status, _, body = self.request(asgi_app, '/store/Missing')
+        assert status == 404
+        assert json.loads(body)['message'] == 'Store not found'
+
+    def test_summaries_match_sync(self, asgi_app):
+        """Test the async summary endpoints return what the sync views do."""
+        client = asgi_app.flask_app.test_client()
+        for path in ('/stores/summary', '/store/Async Store/summary', '/store/Missing/summary'):
+            status, _, body = self.request(asgi_app, path)
+            sync = client.get(path)
+            assert (status, body) == (sync.status_code, sync.data)
+
+    def test_fields_match_sync(self, asgi_app, token_headers):
+        """Test the async views apply `fields` and `include` like the sync views."""
+        client = asgi_app.flask_app.test_client()
+        for path in ('/stores?fields=name', '/stores?fields=id,items.price', '/store/Async Store?fields=items',
+                     '/items?fields=price', '/item/Async Item 0?fields=name', '/items?fields=owner'):
+            status, _, body = self.request(asgi_app, path, headers=token_headers)
+            sync = client.get(path, headers=token_headers)
+            assert (status, body) == (sync.status_code, sync.data)
+
+    def test_get_item_requires_token(self, asgi_app, token_headers):
+        """Test the JWT check and the cached item lookup."""
+        status, _, _ = self.request(asgi_app, '/item/Async Item 0')
+        assert status == 401
+
+        for _ in range(2):
+            status, _, body = self.request(asgi_app, '/item/Async Item 0', headers=token_headers)
+            assert status == 200
+            assert json.loads(body) == {'name': 'Async Item 0', 'price': 1.5, 'store_id': 1}
+
+    def test_user_loaded_async(self, asgi_app, token_headers):
+        """Test the token's user is loaded through the async engine, and a deleted user is rejected."""
+        from sqlalchemy import event
+        from app.db import db as _db
+        from app.util.cache import get_cache
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        get_cache().clear()
+        event.listen(_db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            status, _, _ = self.request(asgi_app, '/items', headers=token_headers)
+        finally:
+            event.remove(_db.engine, 'before_cursor_execute', before_cursor_execute)
+        assert status == 200
+        assert not [statement for statement in statements if 'FROM users' in statement]
+
+        _db.session.delete(UserModel.query.filter_by(username='asyncuser').one())
+        _db.session.commit()
+        status, _, _ = self.request(asgi_app, '/items', headers=token_headers)
+        assert status == 401
+
+    def test_get_items_paginated(self, asgi_app, token_headers):
+        """Test keyset pagination and filters on the async items listing."""
+        status, headers, body = self.request(asgi_app, '/items?limit=2&min_price=2', headers=token_headers)
+
+        assert status == 200
+        data = json.loads(body)
+        assert [item['name'] for item in data['items']] == ['Async Item 1', 'Async Item 2']
+        assert data['next_cursor'] is None
+
+        status, headers, body = self.request(asgi_app, '/items?limit=1', headers=token_headers)
+        assert json.loads(body)['next_cursor'] == 1
+        assert 'rel="next"' in headers['link']
+
+    def test_conditional_get(self, asgi_app):
+        """Test async views answer If-None-Match with 304."""
+        _, headers, _ = self.request(asgi_app, '/stores')
+
+        status, _, body = self.request(asgi_app, '/stores', headers={'If-None-Match': headers['etag']})
+
+        assert status == 304
+        assert body == b''
+
+    def test_compressed(self, asgi_app):
+        """Test after_request hooks such as compression still apply."""
+        for i in range(20):
+            StoreModel(f'Async Store {i}').save_to_db()
+
+        status, headers, body = self.request(asgi_app, '/stores', headers={'Accept-Encoding': 'gzip'})
+
+        assert status == 200
+        assert headers['content-encoding'] == 'gzip'
+        assert json.loads(gzip.decompress(body))['stores']
+
+    def test_other_routes_delegated(self, asgi_app, token_headers):
+        """Test writes and NDJSON exports go to the sync views."""
+        status, _, body = self.request(asgi_app, '/store/New Store', method='POST', headers=token_headers)
+        assert status == 201
+        assert json.loads(body)['name'] == 'New Store'
+
+        status, headers, body = self.request(asgi_app, '/items?stream=1', headers=token_headers)
+        assert status == 200
+        assert headers['content-type'] == 'application/x-ndjson'
+        assert len(body.decode().splitlines()) == 3
+
+
+class TestIdempotency:
+    """Tests for the Idempotency-Key header on the write endpoints."""
+
+    @staticmethod
+    def post_item(client, headers, key, price=10.0, store_id=1):
+        return client.post('/item/NewItem', data=json.dumps({'price': price, 'store_id': store_id}),
+                           headers=dict(headers, **{'Idempotency-Key': key}))
+
+    def test_retry_replayed(self, client, db, sample_store, auth_headers, query_counter):
+        """Test a retry with the same key gets the first response without writing again."""
+        first = self.post_item(client, auth_headers, 'abc', store_id=sample_store.id)
+        del query_counter[:]
+        retry = self.post_item(client, auth_headers, 'abc', store_id=sample_store.id)
+
+        assert first.status_code == retry.status_code == 201
+        assert retry.data == first.data
+        assert retry.headers['Idempotent-Replayed'] == 'true'
+        assert 'Idempotent-Replayed' not in first.headers
+        assert not [s for s in query_counter if 'items' in s]
+        assert ItemModel.query.count() == 1
+
+    def test_without_key(self, client, db, sample_store, auth_headers):
+        """Test a repeated create without a key reports the duplicate."""
+        client.post('/item/NewItem', data=json.dumps({'price': 10.0, 'store_id': sample_store.id}),
+                    headers=auth_headers)
+        response = client.post('/item/NewItem', data=json.dumps({'price': 10.0, 'store_id': sample_store.id}),
+                               headers=auth_headers)
+
+        assert response.status_code == 400
+        assert 'already exists' in json.loads(response.data)['message']
+
+    def test_key_reused_with_other_body(self, client, db, sample_store, auth_headers):
+        """Test reusing a key for a different request is refused."""
+        self.post_item(client, auth_headers, 'abc', store_id=sample_store.id)
+
+        response = self.post_item(client, auth_headers, 'abc', price=20.0, store_id=sample_store.id)
+
+        assert response.status_code == 422
+
+    def test_in_progress(self, app, client, db, sample_store, auth_headers):
+        """Test a retry arriving while the first request runs gets 409."""
+        from app.util.idempotency import _store_key
+        headers = dict(auth_headers, **{'Idempotency-Key': 'abc'})
+        body = json.dumps({'price': 10.0, 'store_id': sample_store.id})
+        with app.test_request_context('/item/NewItem', method='POST', headers=headers, data=body):
+            key = _store_key('abc')
+        app.extensions['idempotency'].add(key, {'fingerprint': hashlib.sha256(body.encode()).hexdigest()})
+
+        response = client.post('/item/NewItem', data=body, headers=headers)
+
+        assert response.status_code == 409
+        assert response.headers['Retry-After'] == '1'
+        assert ItemModel.query.count() == 0
+
+    def test_abandoned_claim_expires(self, app, client, db, sample_store, auth_headers, monkeypatch):
+        """Test a claim left by a dead worker only blocks its key for IDEMPOTENCY_CLAIM_TTL."""
+        import app.resources.item as item_module
+        import app.util.cache as cache_module
+        now = [1000.0]
+        monkeypatch.setattr(cache_module.time, 'monotonic', lambda: now[0])
+        store = app.extensions['idempotency']
+        # The worker dies before it can release its claim
+        with monkeypatch.context() as m:
+            m.setattr(store, 'delete', lambda key: None)
+            m.setattr(item_module, 'insert_unique', lambda item: 1 / 0)
+            assert self.post_item(client, auth_headers, 'abc', store_id=sample_store.id).status_code == 500
+
+        assert self.post_item(client, auth_headers, 'abc', store_id=sample_store.id).status_code == 409
+        now[0] += app.config['IDEMPOTENCY_CLAIM_TTL'] + 1
+        response = self.post_item(client, auth_headers, 'abc', store_id=sample_store.id)
+
+        assert response.status_code == 201
+        assert ItemModel.query.count() == 1
+
+    def test_keys_scoped_per_user(self, app, client, db, sample_store, auth_headers, sample_user):
+        """Test the same key sent by another user is a new request."""
+        from app.auth import create_user_token
+        other = {'Authorization': f'Bearer {create_user_token(sample_user)}', 'Content-Type': 'application/json'}
+        self.post_item(client, auth_headers, 'abc', store_id=sample_store.id)
+
+        response = self.post_item(client, other, 'abc', store_id=sample_store.id)
+
+        assert response.status_code == 400
+        assert 'Idempotent-Replayed' not in response.headers
+
+    def test_server_errors_not_kept(self, client, db, sample_store, auth_headers, monkeypatch):
+        """Test a failed request can be retried with the same key."""
+        def fail(*args):
+            raise RuntimeError('database went away')
+        monkeypatch.setattr(ItemModel, 'upsert', fail)
+        headers = dict(auth_headers, **{'Idempotency-Key': 'abc'})
+        body = json.dumps({'price': 10.0, 'store_id': sample_store.id})
+
+        assert client.put('/item/NewItem', data=body, headers=headers).status_code == 500
+        monkeypatch.undo()
+        response = client.put('/item/NewItem', data=body, headers=headers)
+
+        assert response.status_code == 200
+        assert 'Idempotent-Replayed' not in response.headers
+
+    def test_register_replayed(self, client, db):
+        """Test a retried registration is answered like the first one."""
+        headers = {'Idempotency-Key': 'signup-1'}
+        body = json.dumps({'username': 'newuser', 'password': 'newpass'})
+        responses = [client.post('/register', data=body, content_type='application/json', headers=headers)
+                     for _ in range(2)]
+
+        assert [r.status_code for r in responses] == [201, 201]
+        assert responses[1].headers['Idempotent-Replayed'] == 'true'
+
+    def test_invalid_key(self, client, db, auth_headers):
+        """Test overlong keys are refused."""
+        response = self.post_item(client, auth_headers, 'x' * 256)
+
+        assert response.status_code == 400
+
+    def test_shared_storage(self, app, client, db, sample_store, auth_headers):
+        """Test responses kept in the shared store are replayed."""
+        from app.util.cache import LocalSharedClient, SharedCache
+        app.extensions['idempotency'] = SharedCache(LocalSharedClient())
+
+        first = self.post_item(client, auth_headers, 'abc', store_id=sample_store.id)
+        retry = self.post_item(client, auth_headers, 'abc', store_id=sample_store.id)
+
+        assert retry.headers['Idempotent-Replayed'] == 'true'
+        assert json.loads(retry.data) == json.loads(first.data)
+
+
+class TestRateLimiting:
+    """Tests for the per route and identity rate limits."""
+
+    @pytest.fixture
+    def limited_client(self):
+        from app.app import create_app
+        from app.db import db as _db
+
+        flask_app = create_app({
+            'TESTING': True,
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',
+            'JWT_SECRET_KEY': 'test-secret-key',
+            'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000',
+            'METRICS_ENABLED': True,
+            'RATELIMIT_ENABLED': True,
+            'RATELIMIT_RULES': {'user.login': '2/minute', 'user': '3/minute', '*': '1000/second'},
+        })
+        with flask_app.app_context():
+            _db.create_all()
+            for name in ('first', 'second'):
+                UserModel(name, 'password').save_to_db()
+            yield flask_app.test_client()
+            _db.session.remove()
+            _db.drop_all()
+
+    @staticmethod
+    def login(client, username='first', address='10.0.0.1'):
+        return client.post('/user', data=json.dumps({'username': username, 'password': 'password'}),
+                           content_type='application/json', environ_base={'REMOTE_ADDR': address})
+
+    def test_login_throttled(self, limited_client):
+        """Test logins beyond the limit get 429 with Retry-After."""
+        assert self.login(limited_client).status_code == 200
+        assert self.login(limited_client, 'second').status_code == 200
+
+        response = self.login(limited_client)
+
+        assert response.status_code == 429
+        assert 20 <= int(response.headers['Retry-After']) <= 30
+        assert 'Too many requests' in json.loads(response.data)['message']
+
+    def test_per_address(self, limited_client):
+        """Test anonymous clients are limited per address."""
+        for _ in range(2):
+            self.login(limited_client)
+
+        assert self.login(limited_client, address='10.0.0.2').status_code == 200
+
+    def test_per_token_subject(self, limited_client):
+        """Test authenticated clients are limited per user, whatever their address."""
+        tokens = [json.loads(self.login(limited_client, name, address=name).data)['access_token']
+                  for name in ('first', 'second')]
+
+        def get_user(token, address):
+            return limited_client.get('/user', headers={'Authorization': f'Bearer {token}'},
+                                      environ_base={'REMOTE_ADDR': address}).status_code
+
+        assert [get_user(tokens[0], f'10.0.1.{i}') for i in range(4)] == [200, 200, 200, 429]
+        assert get_user(tokens[1], '10.0.1.0') == 200
+
+    def test_rejections_in_metrics(self, limited_client):
+        """Test rejected requests are counted on /metrics."""
+        for _ in range(3):
+            self.login(limited_client)
+
+        text = limited_client.get('/metrics').data.decode()
+
+        assert 'ratelimit_rejected_total{endpoint="user.login"} 1' in text
+        assert 'endpoint="user.login",method="POST",status="429"' in text
+
+    def test_disabled_by_default(self, app):
+        """Test no limiter is installed unless RATELIMIT_ENABLED is set."""
+        assert 'rate_limiter' not in app.extensions
+
+
+class TestReplicaRouting:
+    """Tests for reading GET requests from a replica."""
+
+    @pytest.fixture
+    def replica_app(self, tmp_path):
+        from sqlalchemy import insert
+        from app.app import create_app
+        from app.db import db as _db
+        from app.replicas import use_primary
+
+        def make(replica_uri=None):
+            flask_app = create_app({
+                'TESTING': True,
+                'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'primary.db'}",
+                'SQLALCHEMY_REPLICA_URIS': [replica_uri or f"sqlite:///{tmp_path / 'replica.db'}"],
+                'JWT_SECRET_KEY': 'test-secret-key',
+                'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000',
+                'METRICS_ENABLED': True,
+            })
+            flask_app.add_url_rule('/primary/<string:name>', 'primary_store',
+                                   use_primary(lambda name: {'found': StoreModel.find_by_name(name) is not None}))
+            ctx = flask_app.app_context()
+            ctx.push()
+            _db.create_all()
+            UserModel('writer', 'password').save_to_db()
+            if replica_uri is None:
+                # Not replicated: each database gets a store of its own
+                StoreModel('primary-only').save_to_db()
+                replica = _db.engines['replica0']
+                _db.metadata.create_all(replica)
+                with replica.begin() as connection:
+                    connection.execute(insert(StoreModel.__table__).values(name='replica-only'))
+            apps.append((flask_app, ctx))
+            return flask_app
+
+        apps = []
+        yield make
+        for flask_app, ctx in apps:
+            _db.session.remove()
+            for engine in _db.engines.values():
+                engine.dispose()
+            ctx.pop()
+
+    @staticmethod
+    def writer_headers():
+        from app.auth import create_user_token
+        token = create_user_token(UserModel.find_by_username('writer'))
+        return {'Authorization': f'Bearer {token}'}
+
+    def test_reads_from_replica(self, replica_app):
+        """Test GET requests are answered from the replica."""
+        client = replica_app().test_client()
+
+        names = [store['name'] for store in json.loads(client.get('/stores').data)['stores']]
+
+        assert names == ['replica-only']
+        assert client.get('/store/primary-only').status_code == 404
+
+    def test_writes_go_to_primary(self, replica_app):
+        """Test writes and the reads of write requests use the primary."""
+        client = replica_app().test_client()
+
+        response = client.post('/store/new', headers=self.writer_headers())
+
+        assert response.status_code == 201
+        assert StoreModel.query.filter_by(name='new').count() == 1
+
+    def test_read_your_writes(self, replica_app):
+        """Test the client that wrote reads from the primary, other clients from the replica."""
+        app = replica_app()
+        client = app.test_client()
+        headers = self.writer_headers()
+        client.post('/store/new', headers=headers)
+
+        def names(**kwargs):
+            return [store['name'] for store in json.loads(client.get('/stores', **kwargs).data)['stores']]
+
+        assert 'new' in names(headers=headers)
+        assert 'new' not in names(environ_base={'REMOTE_ADDR': '10.0.0.9'})
+
+        app.extensions['replicas'].sticky.clear()
+        assert 'new' not in names(headers=headers)
+
+    def test_use_primary(self, replica_app):
+        """Test a view marked with use_primary reads from the primary on GET."""
+        client = replica_app().test_client()
+
+        assert json.loads(client.get('/primary/primary-only').data) == {'found': True}
+
+    def test_replica_down(self, replica_app, tmp_path):
+        """Test an unreachable replica is skipped and the request retried on the primary."""
+        app = replica_app(f"sqlite:///{tmp_path / 'missing' / 'replica.db'}")
+        client = app.test_client()
+        StoreModel('primary-only').save_to_db()
+
+        response = client.get('/store/primary-only')
+
+        assert response.status_code == 200
+        assert app.extensions['replicas'].healthy('replica0') is False
+        assert client.get('/stores').status_code == 200
+        assert 'db_replica_up{bind="replica0"} 0' in client.get('/metrics').data.decode()
+
+    def test_replica_reads_not_cached(self, replica_app):
+        """Test rows read from a replica do not fill the lookup cache."""
+        app = replica_app()
+        client = app.test_client()
+
+        assert client.get('/store/replica-only').status_code == 200
+        assert app.extensions['cache'].stats()['size'] == 0
+
+
+class TestGroupCommit:
+    """Tests for PUT /item/<name> with group commit enabled."""
+
+    def test_concurrent_puts(self, tmp_path):
+        """Test concurrent PUTs are all applied, in fewer transactions than requests."""
+        import threading
+        from app.app import create_app
+        from app.auth import create_user_token
+        from app.db import db as _db
+
+        app = create_app({
+            'TESTING': True,
+            'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'group.db'}",
+            'JWT_SECRET_KEY': 'test-secret-key',
+            'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000',
+            'GROUP_COMMIT_WINDOW_MS': 100,
+        })
+        with app.app_context():
+            _db.create_all()
+            user = UserModel('writer', 'password')
+            user.save_to_db()
+            StoreModel('store').save_to_db()
+            headers = {'Authorization': f'Bearer {create_user_token(user)}'}
+            _db.session.remove()
+
+        statuses = []
+
+        def put(i):
+            response = app.test_client().put(f'/item/item-{i}', json={'price': i, 'store_id': 1}, headers=headers)
+            statuses.append((response.status_code, response.get_json()))
+
+        threads = [threading.Thread(target=put, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert sorted(statuses, key=lambda status: status[1]['price']) == [
+            (200, {'name': f'item-{i}', 'price': i, 'store_id': 1}) for i in range(8)]
+        committer = app.extensions['item_group_commit']
+        assert committer.writes == 8
+        assert committer.batches < 8
+        with app.app_context():
+            assert ItemModel.query.count() == 8
+            for engine in _db.engines.values():
+                engine.dispose()
+
+    def test_failed_row_isolated(self, tmp_path):
+        """Test a row failing in the row by row retry neither fails nor loses the rows after it."""
+        import threading
+        from sqlalchemy import event
+        from app.app import create_app
+        from app.auth import create_user_token
+        from app.db import db as _db
+
+        app = create_app({
+            'TESTING': True,
+            'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'group.db'}",
+            'JWT_SECRET_KEY': 'test-secret-key',
+            'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000',
+            'GROUP_COMMIT_WINDOW_MS': 200,
+        })
+        with app.app_context():
+            # Check the store_id foreign key at commit, so a bad row fails the transaction
+            # it is in, as it does on PostgreSQL
+            event.listen(_db.engine, 'connect',
+                         lambda connection, record: connection.execute('PRAGMA foreign_keys=ON'))
+            event.listen(_db.engine, 'begin',
+                         lambda connection: connection.exec_driver_sql('PRAGMA defer_foreign_keys=ON'))
+            _db.create_all()
+            user = UserModel('writer', 'password')
+            user.save_to_db()
+            StoreModel('store').save_to_db()
+            headers = {'Authorization': f'Bearer {create_user_token(user)}'}
+            _db.session.remove()
+
+        statuses = {}
+
+        def put(name, store_id):
+            response = app.test_client().put(f'/item/{name}', json={'price': 1, 'store_id': store_id}, headers=headers)
+            statuses[name] = response.status_code
+
+        threads = [threading.Thread(target=put, args=args) for args in (('first', 1), ('bad', 99), ('third', 1))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert statuses == {'first': 200, 'bad': 500, 'third': 200}
+        assert app.extensions['item_group_commit'].batches == 1
+        with app.app_context():
+            assert sorted(item.name for item in ItemModel.query) == ['first', 'third']
+            for engine in _db.engines.values():
+                engine.dispose()
+
+    def test_disabled_by_default(self, app):
+        """Test PUTs commit on their own unless GROUP_COMMIT_WINDOW_MS is set."""
+        assert 'item_group_commit' not in app.extensions
+
+
+class TestMetrics:
+    """Tests for the request instrumentation and /metrics endpoint."""
+
+    @pytest.fixture
+    def metrics_client(self):
+        from app.app import create_app
+        from app.db import db as _db
+
+        flask_app = create_app({
+            'TESTING': True,
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',
+            'JWT_SECRET_KEY': 'test-secret-key',
+            'METRICS_ENABLED': True,
+        })
+        with flask_app.app_context():
+            _db.create_all()
+            StoreModel('Metered').save_to_db()
+            yield flask_app.test_client()
+            _db.session.remove()
+            _db.drop_all()
+
+    def test_server_timing_header(self, metrics_client):
+        """Test responses report database and serialization time."""
+        response = metrics_client.get('/stores')
+
+        timing = response.headers['Server-Timing']
+        assert 'db;dur=' in timing
+        assert 'desc="3 queries"' in timing
+        assert 'ser;dur=' in timing
+        assert 'app;dur=' in timing
+
+    def test_store_serialization_timed(self, metrics_client):
+        """Test stores encoded with their items, and store summaries, count as serialization time."""
+        import re
+        for path in ('/stores', '/store/Metered/summary'):
+            timing = metrics_client.get(path).headers['Server-Timing']
+            assert float(re.search(r'ser;dur=([0-9.]+)', timing).group(1)) > 0
+
+    def test_stream_observed_when_sent(self, metrics_client):
+        """Test an NDJSON export is observed once streamed, with its encoding time."""
+        response = metrics_client.get('/stores?stream=1')
+        assert response.get_data(as_text=True).count('\n') == 1
+        response.close()
+
+        serialization = metrics_client.application.extensions['metrics'].serialization
+        assert serialization[('store.get_stores', 'GET')].sum > 0
+
+    def test_metrics_endpoint(self, metrics_client):
+        """Test /metrics exposes route, cache and pool metrics."""
+        metrics_client.get('/stores')
+        metrics_client.get('/store/Metered')
+        metrics_client.get('/store/Metered')
+
+        response = metrics_client.get('/metrics')
+
+        assert response.status_code == 200
+        assert response.mimetype == 'text/plain'
+        text = response.data.decode()
+        assert 'http_request_duration_seconds_count{endpoint="store.get_stores",method="GET",status="200"} 1' in text
+        assert 'http_request_db_queries_sum{endpoint="store.get_stores",method="GET"} 3.0' in text
+        assert 'cache_hits_total{namespace="stores:name"} 1' in text
+        assert 'db_pool_checkouts_total{bind="default"}' in text
+
+    def test_disabled_by_default(self, client, db):
+        """Test nothing is instrumented unless METRICS_ENABLED is set."""
+        response = client.get('/stores')
+
+        assert 'Server-Timing' not in response.headers
+        assert client.get('/metrics').status_code == 404
@@ -5,9 +5,18 @@
 import json
 import logging
 import pytest
-from app.util.encoder import AlchemyEncoder
-from app.util.logz import create_logger
+from app.config import asyncDatabaseUri, engineOptions, engineSettings
+from app.db import instrument_pool, pool_stats
+from app.util.cache import MISSING, LRUCache, LocalSharedClient, NullCache, SharedCache
+from app.util.json_provider import FastJSONProvider, RowEncoder, encode_document
+from app.util.encoder import AlchemyEncoder, model_columns, serialize
+from app.models.item import ItemModel
+from app.util.logz import (DeferredQueueHandler, JsonFormatter, SamplingFilter, configure_logging,
+                           create_logger, parse_sample_rates)
 from app.models.user import UserModel
+from app.util.group_commit import GroupCommitter
+from app.util.ratelimit import Limit, MemoryBucketStore, SharedBucketStore, parse_limit
+from app.util.passwords import PasswordWorkers, PasswordWorkersBusy, hash_password, needs_rehash, verify_password
 
 
 class TestAlchemyEncoder:
@@ -20,7 +29,7 @@ class TestAlchemyEncoder:
 
         assert 'username' in data
         assert data['username'] == 'sampleuser'
-        assert 'password' in data
+        assert 'password' not in data
         assert 'id' in data
 
     def test_encode_regular_object(self):
@@ -41,6 +50,16 @@ class TestAlchemyEncoder:
         assert data['name'] == 'Test Item'
         assert 'price' in data
         assert 'store_id' in data
+        assert 'store' not in data
+
+    def test_columns_introspected_once(self, db, sample_item):
+        """Test the column list is computed once per model class."""
+        model_columns.cache_clear()
+        serialize(sample_item)
+        serialize(sample_item)
+
+        assert model_columns(ItemModel) == ('id', 'name', 'price', 'store_id')
+        assert model_columns.cache_info().misses == 1
 
 
 class TestCreateLogger:
@@ -72,3 +91,575 @@ class TestCreateLogger:
 
         # Check that something was logged
         assert len(caplog.records) > 0
+
+
+class TestLoggingPipeline:
+    """Tests for the queue based, structured logging mode."""
+
+    @pytest.fixture
+    def restore_root_logger(self):
+        import app.util.logz as logz
+        root = logging.getLogger()
+        handlers, level = root.handlers[:], root.level
+        yield
+        logz._stop_listener()
+        root.handlers[:] = handlers
+        root.setLevel(level)
+
+    @staticmethod
+    def record(name='rich', level=logging.INFO, msg='hello %s', args=('world',), **extra):
+        record = logging.LogRecord(name, level, __file__, 1, msg, args, None)
+        record.__dict__.update(extra)
+        return record
+
+    def test_json_formatter(self):
+        """Test records become JSON objects with their extra fields."""
+        entry = json.loads(JsonFormatter().format(self.record(request_id='abc')))
+
+        assert entry['message'] == 'hello world'
+        assert entry['level'] == 'INFO'
+        assert entry['logger'] == 'rich'
+        assert entry['request_id'] == 'abc'
+        assert 'args' not in entry
+
+    def test_sampling_filter(self, monkeypatch):
+        """Test sampling uses the closest configured logger and spares warnings."""
+        import app.util.logz as logz
+        sampler = SamplingFilter(parse_sample_rates('rich=0.25, sqlalchemy=0'))
+        monkeypatch.setattr(logz.random, 'random', lambda: 0.5)
+
+        assert sampler.rate_for('rich') == 0.25
+        assert sampler.rate_for('sqlalchemy.engine.Engine') == 0
+        assert sampler.rate_for('werkzeug') == 1.0
+        assert not sampler.filter(self.record())
+        assert sampler.filter(self.record(level=logging.WARNING))
+        assert sampler.filter(self.record(name='werkzeug'))
+
+    def test_deferred_queue_handler(self):
+        """Test records are queued unformatted and dropped when the queue is full."""
+        import queue
+        handler = DeferredQueueHandler(queue.Queue(1))
+        record = self.record()
+
+        handler.handle(record)
+        handler.handle(self.record())
+
+        queued = handler.queue.get_nowait()
+        assert queued is record
+        assert queued.args == ('world',)
+        assert handler.dropped == 1
+
+    def test_queue_mode(self, restore_root_logger, capsys):
+        """Test queue mode writes JSON lines from the listener thread."""
+        import app.util.logz as logz
+        configure_logging(mode='queue', log_format='json', force=True)
+        logging.getLogger('rich').warning('queued %d', 42)
+        logz._stop_listener()
+
+        lines = [json.loads(line) for line in capsys.readouterr().err.splitlines()]
+        assert [line['message'] for line in lines] == ['queued 42']
+
+    def test_unknown_mode(self, restore_root_logger):
+        """Test an unknown mode is rejected."""
+        with pytest.raises(ValueError):
+            configure_logging(mode='carrier-pigeon', log_format='json', force=True)
+
+
+class TestLRUCache:
+    """Tests for LRUCache."""
+
+    def test_get_set(self):
+        """Test storing and reading back a value."""
+        cache = LRUCache()
+        assert cache.get('items:name:a') is MISSING
+        cache.set('items:name:a', {'id': 1})
+        assert cache.get('items:name:a') == {'id': 1}
+
+        stats = cache.stats()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
+        assert stats['size'] == 1
+
+    def test_evicts_least_recently_used(self):
+        """Test the oldest entry is evicted when full."""
+        cache = LRUCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        assert cache.get('b') is MISSING
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+
+    def test_entries_expire(self, monkeypatch):
+        """Test entries are dropped after the TTL."""
+        import app.util.cache as cache_module
+        now = [1000.0]
+        monkeypatch.setattr(cache_module.time, 'monotonic', lambda: now[0])
+
+        cache = LRUCache(ttl=10)
+        cache.set('a', 1)
+        now[0] += 9
+        assert cache.get('a') == 1
+        now[0] += 2
+        assert cache.get('a') is MISSING
+
+    def test_add_only_if_absent(self, monkeypatch):
+        """Test add() keeps a live entry and replaces an expired one."""
+        import app.util.cache as cache_module
+        now = [1000.0]
+        monkeypatch.setattr(cache_module.time, 'monotonic', lambda: now[0])
+
+        cache = LRUCache(ttl=10)
+        assert cache.add('a', 1) is True
+        assert cache.add('a', 2) is False
+        assert cache.get('a') == 1
+        now[0] += 11
+        assert cache.add('a', 3) is True
+        assert cache.get('a') == 3
+
+    def test_lease_and_fill(self):
+        """Test a lease reads as a miss and a fill only lands while the lease is held."""
+        cache = LRUCache()
+        lease = cache.lease('a')
+        assert lease is not None
+        assert cache.lease('a') is None
+        assert cache.get('a') is MISSING
+        assert cache.fill('a', lease, 1) is True
+        assert cache.get('a') == 1
+        assert cache.lease('a') is None
+
+        lease = cache.lease('b')
+        cache.delete('b')
+        assert cache.fill('b', lease, 2) is False
+        assert cache.get('b') is MISSING
+
+    def test_delete_and_clear(self):
+        """Test entries can be removed."""
+        cache = LRUCache()
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.delete('a', 'missing')
+        assert cache.get('a') is MISSING
+        cache.clear()
+        assert cache.get('b') is MISSING
+
+
+class TestSharedCache:
+    """Tests for SharedCache backed by the local stand-in client."""
+
+    def test_round_trip(self):
+        """Test values are encoded into and read back from the client."""
+        client = LocalSharedClient()
+        cache = SharedCache(client, prefix='test:')
+        cache.set('stores:name:a', {'id': 1, 'name': 'a'})
+
+        assert client.get('test:stores:name:a') is not None
+        assert cache.get('stores:name:a') == {'id': 1, 'name': 'a'}
+        cache.delete('stores:name:a')
+        assert cache.get('stores:name:a') is MISSING
+        assert cache.stats()['misses'] == 1
+
+    def test_shared_between_instances(self):
+        """Test two caches over one client see each other's writes."""
+        client = LocalSharedClient()
+        SharedCache(client).set('k', [1, 2])
+        assert SharedCache(client).get('k') == [1, 2]
+
+    def test_add_only_if_absent(self):
+        """Test add() maps to SET NX on the client."""
+        cache = SharedCache(LocalSharedClient())
+
+        assert cache.add('k', 1) is True
+        assert cache.add('k', 2) is False
+        assert cache.get('k') == 1
+
+    def test_lease_and_fill(self):
+        """Test fill() sets the key only while it holds the lease taken with SET NX."""
+        cache = SharedCache(LocalSharedClient())
+        lease = cache.lease('a')
+        assert lease is not None
+        assert cache.lease('a') is None
+        assert cache.get('a') is MISSING
+        assert cache.fill('a', lease, {'id': 1}) is True
+        assert cache.get('a') == {'id': 1}
+
+        lease = cache.lease('b')
+        cache.delete('b')
+        assert cache.fill('b', lease, {'id': 2}) is False
+        assert cache.get('b') is MISSING
+
+    def test_null_cache(self):
+        """Test the null cache never stores values."""
+        cache = NullCache()
+        cache.set('k', 1)
+        assert cache.get('k') is MISSING
+
+
+class TestEngineOptions:
+    """Tests for the environment driven engine configuration."""
+
+    def test_profile_defaults(self):
+        """Test the development profile is used by default."""
+        assert engineSettings({})['pool_size'] == 5
+        assert engineSettings({'DB_PROFILE': 'production'})['statement_timeout_ms'] == 30000
+
+    def test_environment_overrides(self):
+        """Test single settings are overridden from the environment."""
+        settings = engineSettings({'DB_PROFILE': 'production', 'DB_POOL_SIZE': '32', 'DB_POOL_PRE_PING': 'false'})
+        assert settings['pool_size'] == 32
+        assert settings['pool_pre_ping'] is False
+        assert settings['max_overflow'] == 10
+
+    def test_unknown_profile(self):
+        """Test an unknown profile is rejected."""
+        with pytest.raises(ValueError, match='DB_PROFILE'):
+            engineSettings({'DB_PROFILE': 'staging'})
+
+    def test_postgresql_options(self):
+        """Test PostgreSQL gets pool sizing, a statement timeout and libpq options."""
+        options = engineOptions('postgresql+psycopg2://u:p@host/db', {'DB_PROFILE': 'production'})
+        assert options['pool_size'] == 10
+        assert options['pool_pre_ping'] is True
+        assert options['connect_args']['options'] == '-c statement_timeout=30000'
+        assert options['connect_args']['connect_timeout'] == 5
+
+    def test_sqlite_memory_options(self):
+        """Test in-memory SQLite gets no pool sizing or driver options."""
+        assert engineOptions('sqlite:///:memory:', {}) == {'pool_pre_ping': True}
+        assert 'pool_size' in engineOptions('sqlite:////tmp/data.db', {})
+        assert 'connect_args' not in engineOptions('sqlite:////tmp/data.db', {})
+
+    def test_asyncpg_options(self):
+        """Test asyncpg gets its own spelling of the timeouts."""
+        options = engineOptions('postgresql+asyncpg://u:p@host/db', {'DB_PROFILE': 'production'})
+        assert options['connect_args'] == {'timeout': 5, 'server_settings': {
+            'application_name': 'flask-restful', 'statement_timeout': '30000'}}
+
+    def test_async_database_uri(self):
+        """Test sync URIs are mapped to their asyncio drivers."""
+        assert asyncDatabaseUri('sqlite:////tmp/data.db') == 'sqlite+aiosqlite:////tmp/data.db'
+        assert asyncDatabaseUri('postgresql+psycopg2://u:p@host/db') == 'postgresql+asyncpg://u:p@host/db'
+        assert asyncDatabaseUri('postgresql+asyncpg://u:p@host/db') == 'postgresql+asyncpg://u:p@host/db'
+
+
+class TestPoolStats:
+    """Tests for the connection pool metrics."""
+
+    @pytest.fixture
+    def engine(self, tmp_path):
+        from sqlalchemy import create_engine
+        engine = create_engine(f"sqlite:///{tmp_path / 'pool.db'}", pool_size=1, max_overflow=0, pool_timeout=0.1)
+        instrument_pool(engine)
+        yield engine
+        engine.dispose()
+
+    def test_counts_checkouts(self, engine):
+        """Test checkouts and connects are counted."""
+        for _ in range(3):
+            with engine.connect():
+                pass
+
+        stats = pool_stats(engine)
+        assert stats['pool'] == 'QueuePool'
+        assert stats['checkouts'] == 3
+        assert stats['connects'] == 1
+        assert stats['checkedout'] == 0
+
+    def test_pool_exhaustion(self, engine):
+        """Test a checkout beyond pool_size + max_overflow times out."""
+        from sqlalchemy.exc import TimeoutError
+        with engine.connect():
+            assert pool_stats(engine)['checkedout'] == 1
+            with pytest.raises(TimeoutError):
+                engine.connect()
+        assert pool_stats(engine)['checkedout'] == 0
+
+    def test_app_engine_instrumented(self, app, db):
+        """Test the application engine reports counters."""
+        db.session.execute(db.text('SELECT 1'))
+        assert pool_stats()['checkouts'] >= 1
+
+
+class TestCreateApp:
+    """Tests for the application factory."""
+
+    def test_config_override(self, app):
+        """Test the given config wins over the defaults."""
+        assert app.config['TESTING'] is True
+        assert app.config['SQLALCHEMY_DATABASE_URI'] == 'sqlite:///:memory:'
+        assert app.config['SQLALCHEMY_ENGINE_OPTIONS'] == {'pool_pre_ping': True}
+        assert 'item' in app.blueprints
+
+    def test_isolated_apps(self, tmp_path):
+        """Test two apps keep separate databases and caches."""
+        from app.app import create_app
+        from app.db import db
+        from app.models.store import StoreModel
+
+        apps = [create_app({'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / f'{i}.db'}"}) for i in range(2)]
+        for app in apps:
+            with app.app_context():
+                db.create_all()
+        with apps[0].app_context():
+            StoreModel('Only here').save_to_db()
+            assert StoreModel.find_by_name('Only here') is not None
+        with apps[1].app_context():
+            assert StoreModel.find_by_name('Only here') is None
+        assert apps[0].extensions['cache'] is not apps[1].extensions['cache']
+
+    def test_default_app_is_lazy(self):
+        """Test the module level app is only built when first accessed."""
+        import app.app as app_module
+
+        assert 'app' not in vars(app_module)
+        assert app_module.app is app_module.app
+
+
+class TestRowEncoder:
+    """Tests for the row to JSON fast path."""
+
+    def test_matches_json_dumps(self):
+        """Test encoded rows decode to the same objects as the dicts would."""
+        encoder = RowEncoder(('name', 'price', 'store_id'))
+        rows = [('plain', 1.5, 1), ('quote " and \\', 0.1, None), ('ünïcode ☃', 10.0, 2),
+                ('flags', True, False), ('%s %d', float('inf'), 3)]
+
+        for row in rows:
+            assert json.loads(encoder.encode(row)) == json.loads(json.dumps(dict(zip(encoder.keys, row))))
+        assert json.loads(encoder.encode_many(rows))[2]['name'] == 'ünïcode ☃'
+        assert encoder.encode_many([]) == '[]'
+
+    def test_extra_columns_ignored(self):
+        """Test values past the encoder keys are not written."""
+        assert json.loads(RowEncoder(('a',)).encode((1, 'cursor'))) == {'a': 1}
+
+    def test_encode_document(self):
+        """Test joining pre-encoded values into an object."""
+        assert json.loads(encode_document([('items', '[1,2]'), ('next', 'null')])) == {'items': [1, 2], 'next': None}
+
+
+class TestFastJSONProvider:
+    """Tests for the orjson backed JSON provider."""
+
+    PAYLOAD = {'b': [1, 2.5, None], 'a': 'ünï', 'when': __import__('datetime').date(2024, 1, 2)}
+
+    @pytest.fixture(params=['orjson', 'stdlib'])
+    def provider(self, request, app, monkeypatch):
+        import app.util.json_provider as module
+        if request.param == 'orjson':
+            pytest.importorskip('orjson')
+        else:
+            monkeypatch.setattr(module, 'orjson', None)
+        return FastJSONProvider(app)
+
+    def test_app_uses_provider(self, app):
+        """Test the factory installs the provider."""
+        assert isinstance(app.json, FastJSONProvider)
+
+    def test_dumps_like_default(self, app, provider):
+        """Test output keeps sorted keys and Flask's date format."""
+        from flask.json.provider import DefaultJSONProvider
+        text = provider.dumps(self.PAYLOAD)
+
+        assert list(json.loads(text)) == ['a', 'b', 'when']
+        assert json.loads(text) == json.loads(DefaultJSONProvider(app).dumps(self.PAYLOAD))
+
+    def test_loads(self, provider):
+        """Test decoding text and bytes."""
+        assert provider.loads('{"a": [1, 2]}') == {'a': [1, 2]}
+        assert provider.loads(b'{"a": 1}') == {'a': 1}
+
+    def test_response(self, app, provider):
+        """Test jsonify style responses."""
+        response = provider.response({'a': 1})
+        assert response.mimetype == 'application/json'
+        assert json.loads(response.data) == {'a': 1}
+
+
+class TestHistogram:
+    """Tests for the Prometheus histogram."""
+
+    def test_render_cumulative_buckets(self):
+        """Test buckets are cumulative and end with +Inf."""
+        from app.util.metrics import Histogram
+        histogram = Histogram((1, 5))
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(value)
+
+        lines = histogram.render('x', 'a="b"')
+
+        assert lines == [
+            'x_bucket{a="b",le="1"} 2',
+            'x_bucket{a="b",le="5"} 3',
+            'x_bucket{a="b",le="+Inf"} 4',
+            'x_sum{a="b"} 14.5',
+            'x_count{a="b"} 4',
+        ]
+
+
+class TestPasswords:
+    """Tests for password hashing and the password thread pool."""
+
+    def test_hash_and_verify(self):
+        """Test hashing with explicit parameters."""
+        stored = hash_password('secret', 'pbkdf2:sha256:1000')
+
+        assert stored.startswith('pbkdf2:sha256:1000$')
+        assert verify_password(stored, 'secret')
+        assert not verify_password(stored, 'wrong')
+
+    def test_needs_rehash(self):
+        """Test plaintext and other parameters need a rehash, short method names are expanded."""
+        assert needs_rehash('plaintext', 'pbkdf2:sha256:1000')
+        assert needs_rehash(hash_password('x', 'pbkdf2:sha256:1000'), 'pbkdf2:sha256:2000')
+        assert not needs_rehash(hash_password('x', 'pbkdf2:sha256:1000'), 'pbkdf2:sha256:1000')
+        assert not needs_rehash(hash_password('x', 'scrypt:16384:8:1'), 'scrypt:16384:8:1')
+
+    def test_workers_bounded(self):
+        """Test calls beyond the workers and the queue are refused."""
+        import threading
+        release = threading.Event()
+        workers = PasswordWorkers(1, 1)
+        running = [threading.Thread(target=workers.run, args=(release.wait,)) for _ in range(2)]
+        for thread in running:
+            thread.start()
+        try:
+            # one call runs and one waits, so the slots take a moment to fill up
+            for _ in range(100):
+                if not workers._slots.acquire(blocking=False):
+                    break
+                workers._slots.release()
+                release.wait(0.01)
+            with pytest.raises(PasswordWorkersBusy):
+                workers.run(len, 'x')
+        finally:
+            release.set()
+            for thread in running:
+                thread.join()
+        assert workers.run(len, 'abc') == 3
+        workers.shutdown()
+
+
+class TestRateLimit:
+    """Tests for the token bucket stores."""
+
+    def test_parse_limit(self):
+        """Test the rate limit syntax."""
+        assert parse_limit('5/minute') == Limit(5 / 60, 5)
+        assert parse_limit('100/second burst 200') == Limit(100, 200)
+        assert parse_limit('10/30seconds') == Limit(10 / 30, 10)
+        with pytest.raises(ValueError, match='Invalid rate limit'):
+            parse_limit('often')
+
+    @pytest.fixture(params=['memory', 'shared'])
+    def store(self, request, monkeypatch):
+        """Each store, on a clock the test moves by hand."""
+        import time
+        clock = [1000.0]
+        monkeypatch.setattr(time, 'monotonic', lambda: clock[0])
+        monkeypatch.setattr(time, 'time', lambda: clock[0])
+        store = MemoryBucketStore() if request.param == 'memory' else SharedBucketStore(LocalSharedClient())
+        store.clock = clock
+        return store
+
+    def test_burst_then_refill(self, store):
+        """Test a full bucket allows the burst, then one request per interval."""
+        limit = Limit(rate=2, burst=3)
+
+        assert [store.take('k', limit)[0] for _ in range(4)] == [True, True, True, False]
+        allowed, retry_after = store.take('k', limit)
+        assert not allowed
+        assert retry_after == pytest.approx(0.5)
+
+        store.clock[0] += 0.5
+        assert store.take('k', limit)[0] is True
+        assert store.take('k', limit)[0] is False
+
+    def test_keys_independent(self, store):
+        """Test every key has its own bucket."""
+        limit = Limit(rate=1, burst=1)
+
+        assert store.take('a', limit)[0] is True
+        assert store.take('a', limit)[0] is False
+        assert store.take('b', limit)[0] is True
+
+    def test_memory_store_bounded(self):
+        """Test the least recently used buckets are dropped past max_keys."""
+        store = MemoryBucketStore(max_keys=2)
+        limit = Limit(rate=1, burst=1)
+        for key in ('a', 'b', 'c'):
+            store.take(key, limit)
+
+        assert list(store._tats) == ['b', 'c']
+
+
+class TestGroupCommitter:
+    """Tests for grouping concurrent writes."""
+
+    @staticmethod
+    def submit_all(committer, payloads):
+        import threading
+        results = {}
+
+        def submit(payload):
+            try:
+                results[payload] = committer.submit(payload)
+            except Exception as e:
+                results[payload] = e
+
+        threads = [threading.Thread(target=submit, args=(payload,)) for payload in payloads]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_writes_grouped(self):
+        """Test writes arriving within the window share one batch and each get their result."""
+        batches = []
+
+        def write_batch(payloads):
+            batches.append(list(payloads))
+            return [payload * 10 for payload in payloads]
+
+        committer = GroupCommitter(write_batch, None, window=0.2)
+        results = self.submit_all(committer, range(8))
+
+        assert results == {i: i * 10 for i in range(8)}
+        assert sorted(i for batch in batches for i in batch) == list(range(8))
+        assert len(batches) < 8
+        assert (committer.batches, committer.writes) == (len(batches), 8)
+
+    def test_max_batch(self):
+        """Test no group exceeds max_batch."""
+        batches = []
+
+        def write_batch(payloads):
+            batches.append(len(payloads))
+            return payloads
+
+        committer = GroupCommitter(write_batch, None, window=0.05, max_batch=3)
+        results = self.submit_all(committer, range(10))
+
+        assert results == {i: i for i in range(10)}
+        assert max(batches) <= 3
+        assert sum(batches) == 10
+
+    def test_failed_batch_retried_alone(self):
+        """Test a failing batch is written row by row, failing only the bad row."""
+        def write_batch(payloads):
+            raise ValueError('batch failed')
+
+        def write_one(payload):
+            if payload == 'bad':
+                raise ValueError('bad row')
+            return payload.upper()
+
+        committer = GroupCommitter(write_batch, write_one, window=0.1)
+        results = self.submit_all(committer, ['a', 'bad', 'c'])
+
+        assert results['a'] == 'A'
+        assert results['c'] == 'C'
+        assert str(results['bad']) == 'bad row'